@@ -0,0 +1,402 @@
+import BaseHTTPServer
+import SocketServer
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import threading
+import timeit
+import jwt
+from mock import patch
+from notification_backend.entrypoint import handler
+from notification_backend.http import storage_engine
+from notification_backend.http import encode_pagination_cursor
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.github import reset_github_rate_limits
+from notification_backend.github import reset_github_session
+from notification_backend.time import get_current_epoch_time
+from notification_backend.time import get_github_timestamp
+from benchmarks.dataset import generate_threads
+from benchmarks.dataset import user_metadata_item
+from benchmarks.dataset import write_items
+from benchmarks.dataset import write_threads
+
+
+ITERATIONS = 100  # per round
+ROUNDS = 5
+WARMUP = 20
+# With --compare, fail when a route's p50 or p95 latency got this much
+# slower than the baseline, on top of how far apart its rounds were (see
+# regressions)
+REGRESSION_THRESHOLD = 0.25
+NOISE_FACTOR = 2
+# Timings only compare on the machine they were taken on, so the baseline
+# is kept out of the repository
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+ENDPOINT_URL = "http://dynamodb.benchmark"
+THREADS_TABLE = "benchmark-user-notification"
+DATE_INDEX = "benchmark-user-notification-date"
+CHANGE_INDEX = "benchmark-user-notification-change"
+TAG_TABLE = "benchmark-user-notification-tag"
+JWT_SECRET = "benchmarksekret"
+USER_ID = 333333
+STORED_THREADS = 1000  # per user, --threads for more
+BULK_THREADS = 25
+SYNCED_THREADS = 50
+# Where the thread ids start that the routes deleting threads or fetching
+# them from GitHub use up (one per call), so that every call does the same
+# work
+DELETED_THREAD_IDS = 10 ** 6
+BULK_DELETED_THREAD_IDS = 2 * 10 ** 6
+GITHUB_THREAD_IDS = 3 * 10 ** 6
+REASONS = ["subscribed", "mention", "comment", "author", "assign", "manual"]
+TAGS = ["watching", "mentioned", "commented", "owner", "issue", "pullrequest"]
+
+
+def github_thread(thread_id, updated_at):
+    return {
+        "id": str(thread_id),
+        "url": "https://api.github.com/notifications/threads/%s" % thread_id,  # NOQA
+        "subscription_url": "https://api.github.com/notifications/threads/%s/subscription" % thread_id,  # NOQA
+        "reason": "mention",
+        "updated_at": get_github_timestamp(updated_at),
+        "subject": {
+            "title": "Benchmark issue %s" % thread_id,
+            "url": "https://api.github.com/repos/tidycat/notification-backend/issues/%s" % thread_id,  # NOQA
+            "type": "Issue"
+        },
+        "repository": {
+            "name": "notification-backend",
+            "owner": {"login": "tidycat"}
+        }
+    }
+
+
+class GitHubStandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers the GitHub API calls the routes make, over a keep-alive
+    # connection like api.github.com does
+    protocol_version = "HTTP/1.1"
+    # Headers go out in a write each, don't let them wait for ACKs
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        now = get_current_epoch_time()
+        if self.path.startswith("/notifications/threads/"):
+            thread_id = int(self.path.rsplit("/", 1)[-1])
+            body = github_thread(thread_id, now)
+        else:
+            body = [github_thread(GITHUB_THREAD_IDS - t, now)
+                    for t in range(1, SYNCED_THREADS + 1)]
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GitHubStandInServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_github_stand_in():
+    server = GitHubStandInServer(("127.0.0.1", 0), GitHubStandIn)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return server
+
+
+def create_tables():
+    engine = storage_engine(ENDPOINT_URL)
+    engine.create_table(THREADS_TABLE, [("user_id", "N"), ("thread_id", "N")],
+                        indexes={
+                            DATE_INDEX: ("updated_at", "N"),
+                            CHANGE_INDEX: ("change_version", "N")
+                        })
+    engine.create_table(TAG_TABLE, [("index_key", "S"), ("thread_id", "N")])
+
+
+def seed_threads(thread_ids):
+    # Threads the routes can count on to be there, so none are deleted
+    items = generate_threads(USER_ID, thread_ids=thread_ids,
+                             deleted_share=0)
+    write_threads(ENDPOINT_URL, THREADS_TABLE, items, TAG_TABLE)
+    return items
+
+
+# The threads the deleting routes use up get stored right before they run,
+# so the routes before them don't have to wade through them
+ROUTE_SEEDS = {
+    "delete": lambda calls: seed_threads(
+        range(DELETED_THREAD_IDS, DELETED_THREAD_IDS + calls)
+    ),
+    "delete-bulk": lambda calls: seed_threads(
+        range(BULK_DELETED_THREAD_IDS,
+              BULK_DELETED_THREAD_IDS + calls * BULK_THREADS)
+    )
+}
+
+
+def base_event(resource_path, http_method, bearer_token, **kwargs):
+    event = {
+        "resource-path": resource_path,
+        "http-method": http_method,
+        "payload": {},
+        "jwt_signing_secret": JWT_SECRET,
+        "bearer_token": bearer_token,
+        "notification_dynamodb_endpoint_url": ENDPOINT_URL,
+        "notification_user_notification_dynamodb_table_name": THREADS_TABLE,  # NOQA
+        "notification_user_notification_date_dynamodb_index_name": DATE_INDEX,  # NOQA
+        "notification_user_notification_change_dynamodb_index_name": CHANGE_INDEX,  # NOQA
+        "notification_user_notification_tag_dynamodb_table_name": TAG_TABLE  # NOQA
+    }
+    event.update(kwargs)
+    return event
+
+
+def thread_payload(thread_id, i):
+    return {
+        "id": thread_id,
+        "type": "threads",
+        "attributes": {
+            "reason": REASONS[i % len(REASONS)],
+            "updated-at": get_current_epoch_time(),
+            "tags": [TAGS[i % len(TAGS)], "benchmark"]
+        }
+    }
+
+
+def route_events(bearer_token, stored_threads):
+    # Builds the event for the i-th call of every route, in the order the
+    # routes get benchmarked in (the ones deleting threads go last)
+    def event(resource_path, http_method, **kwargs):
+        return base_event(resource_path, http_method, bearer_token, **kwargs)
+
+    threads = "/notification/threads"
+    thread = "/notification/threads/{thread-id}"
+    # A client that last synced 100 changes ago
+    change_token = encode_pagination_cursor({
+        "user_id": USER_ID,
+        "user_version": stored_threads - 100,
+        "issued_at": get_current_epoch_time()
+    })
+    return [
+        ("ping", lambda i: event("/notification/ping", "GET")),
+        ("list", lambda i: event(threads, "GET")),
+        ("list-since", lambda i: event(threads, "GET", qs_since=change_token)),
+        ("list-ids", lambda i: event(threads, "GET", qs_filter_id=",".join(str(1 + (i * 100 + t) % stored_threads) for t in range(100)))),  # NOQA
+        ("list-tag", lambda i: event(threads, "GET", qs_filter_tag=TAGS[i % len(TAGS)])),  # NOQA
+        ("export", lambda i: event(threads + "/export", "GET")),
+        ("find", lambda i: event(thread, "GET", threadid=str(1 + i % stored_threads))),  # NOQA
+        ("find-github", lambda i: event(thread, "GET", threadid=str(GITHUB_THREAD_IDS + i))),  # NOQA
+        ("patch", lambda i: event(thread, "PATCH", threadid=str(1 + i % stored_threads), payload={"data": thread_payload(1 + i % stored_threads, i)})),  # NOQA
+        ("patch-bulk", lambda i: event(threads, "PATCH", payload={"data": [thread_payload(1 + (i * BULK_THREADS + t) % stored_threads, i) for t in range(BULK_THREADS)]})),  # NOQA
+        ("sync", lambda i: event("/notification/sync", "POST")),
+        ("delete", lambda i: event(thread, "DELETE", threadid=str(DELETED_THREAD_IDS + i))),  # NOQA
+        ("delete-bulk", lambda i: event(threads, "DELETE", payload={"data": [{"id": BULK_DELETED_THREAD_IDS + i * BULK_THREADS + t, "type": "threads"} for t in range(BULK_THREADS)]})),  # NOQA
+    ]
+
+
+def percentile(sorted_timings, fraction):
+    index = int(round(fraction * (len(sorted_timings) - 1)))
+    return sorted_timings[index]
+
+
+def time_calls(events):
+    timings = []
+    # Python 2 has no tracemalloc. With the collector off, generation 0's
+    # count goes up for every container object allocated and down for every
+    # one freed, so it ends up at what the calls left allocated (caches,
+    # queues, leaks).
+    gc.collect()
+    gc.disable()
+    allocated = gc.get_count()[0]
+    try:
+        for event in events:
+            started = timeit.default_timer()
+            handler(event, {})
+            timings.append(timeit.default_timer() - started)
+        allocated = gc.get_count()[0] - allocated
+    finally:
+        gc.enable()
+
+    timings.sort()
+    return {
+        "p50": percentile(timings, 0.50) * 1000,
+        "p95": percentile(timings, 0.95) * 1000,
+        "p99": percentile(timings, 0.99) * 1000,
+        "throughput": len(timings) / sum(timings),
+        "objects": float(allocated) / len(events)
+    }
+
+
+def calibration_time():
+    # A fixed amount of plain Python work, timed along with every round so
+    # comparisons can tell a machine that got busier from slower code
+    return min(timeit.repeat(
+        "sorted(json.dumps(i) for i in items)",
+        setup="import json; items = [{'id': i, 'tags': [str(i)]} for i in range(1000)]",  # NOQA
+        number=5,
+        repeat=3
+    )) * 1000
+
+
+def run_route(build_event, iterations):
+    # Anything but a 200 raises, like it does for API Gateway
+    for i in range(WARMUP):
+        handler(build_event(i), {})
+
+    # Like timeit, the best of a few rounds is what the code can do, the
+    # rest is noise from whatever else the machine was busy with
+    rounds = []
+    for r in range(ROUNDS):
+        first = WARMUP + r * iterations
+        events = [build_event(i) for i in range(first, first + iterations)]
+        rounds.append(dict(time_calls(events), calibration=calibration_time()))  # NOQA
+    best = dict((measure, min(r[measure] for r in rounds))
+                for measure in ["p50", "p95", "p99", "objects", "calibration"])  # NOQA
+    best["throughput"] = max(r["throughput"] for r in rounds)
+    # How much slower the rounds got than the best one, leaving out the
+    # slowest round in case something else took the machine over for it
+    p95s = sorted(r["p95"] for r in rounds)
+    best["noise"] = p95s[-2] / p95s[0] - 1
+    return best
+
+
+def regressions(name, result, baseline, threshold):
+    # The rounds of a run are as far apart as timings get on this machine
+    # anyway, slowdowns only count beyond that (taking whichever of the
+    # two runs was noisier). Timings are scaled by how much slower the
+    # calibration work got since the baseline.
+    if not baseline:
+        return []
+    found = []
+    noise = max(result["noise"], baseline.get("noise", 0))
+    speed = result["calibration"] / baseline.get("calibration", result["calibration"])  # NOQA
+    for measure in ["p50", "p95"]:
+        limit = baseline[measure] * speed * (1 + threshold + NOISE_FACTOR * noise)  # NOQA
+        if result[measure] > limit:
+            found.append("%s %s %.3f ms, baseline %.3f ms" % (name, measure, result[measure], baseline[measure]))  # NOQA
+    # Retained objects are mostly 0, a handful either way is noise
+    if result["objects"] > baseline["objects"] * (1 + threshold) + 1:
+        found.append("%s keeps %.1f objects per call, baseline %.1f" % (name, result["objects"], baseline["objects"]))  # NOQA
+    return found
+
+
+def load_baseline(path, stored_threads):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        baseline = json.load(f)
+    # Timings with more threads stored don't compare
+    if baseline.get("threads") != stored_threads:
+        return {}
+    return baseline.get("routes", {})
+
+
+def save_baseline(path, results, iterations, stored_threads):
+    routes = dict((name, dict((k, round(v, 3)) for k, v in result.items()))
+                  for name, result in results.items())
+    baseline = {
+        "iterations": iterations,
+        "threads": stored_threads,
+        "routes": routes
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True,
+                  separators=(",", ": "))
+        f.write("\n")
+
+
+def run_benchmarks(iterations, stored_threads):
+    token = jwt.encode({"sub": str(USER_ID), "github_token": "benchmark"},
+                       JWT_SECRET, algorithm='HS256')
+    create_tables()
+    items = seed_threads(range(1, stored_threads + 1))
+    write_items(ENDPOINT_URL, THREADS_TABLE, [
+        user_metadata_item(USER_ID, items, get_current_epoch_time())
+    ])
+    for name, build_event in route_events("Bearer %s" % token,
+                                          stored_threads):
+        if name in ROUTE_SEEDS:
+            ROUTE_SEEDS[name](WARMUP + ROUNDS * iterations)
+        yield name, run_route(build_event, iterations)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every route of entrypoint.handler"
+    )
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--threads", type=int, default=STORED_THREADS,
+                        help="threads stored for the user, at least 100")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--compare", action="store_true",
+                        help="fail when a route got slower than the baseline")  # NOQA
+    parser.add_argument("--threshold", type=float,
+                        default=REGRESSION_THRESHOLD,
+                        help="allowed slowdown on top of the noise between rounds, 0.25 being 25%%")  # NOQA
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store the results as the new baseline")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    baseline = load_baseline(args.baseline, args.threads)
+    logging.getLogger("notification_backend").setLevel(logging.WARNING)
+    github = start_github_stand_in()
+    patchers = [
+        patch('notification_backend.http.STORAGE_ENGINE', 'memory'),
+        patch('notification_backend.github.GITHUB_API_URL',
+              "http://127.0.0.1:%s" % github.server_address[1])
+    ]
+    for patcher in patchers:
+        patcher.start()
+    reset_dynamodb_connections()
+    reset_github_session()
+    reset_github_rate_limits()
+
+    print("%-12s %9s %9s %9s %10s %9s %9s" % ("", "p50 (ms)", "p95 (ms)", "p99 (ms)", "req/s", "objs/req", "p50 diff"))  # NOQA
+    results = {}
+    found = []
+    try:
+        for name, result in run_benchmarks(args.iterations, args.threads):
+            results[name] = result
+            diff = ""
+            if name in baseline:
+                diff = "%+.0f%%" % ((result["p50"] / baseline[name]["p50"] - 1) * 100)  # NOQA
+            print("%-12s %9.3f %9.3f %9.3f %10.1f %9.1f %9s" % (name, result["p50"], result["p95"], result["p99"], result["throughput"], result["objects"], diff))  # NOQA
+            found.extend(regressions(name, result, baseline.get(name),
+                                     args.threshold))
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+        reset_github_session()
+        github.shutdown()
+        github.server_close()
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results, args.iterations,
+                      args.threads)
+        print("Saved the baseline to %s" % args.baseline)
+    elif args.compare and not baseline:
+        print("\nNo baseline to compare with, record one with --save-baseline")  # NOQA
+        sys.exit(1)
+    elif args.compare and found:
+        print("\nSlower than the baseline by more than %.0f%% plus noise:" % (args.threshold * 100))  # NOQA
+        for regression in found:
+            print("  %s" % regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
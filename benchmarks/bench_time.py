@@ -0,0 +1,59 @@
+import datetime
+import timeit
+import iso8601
+import pytz
+from notification_backend.time import get_epoch_time
+from notification_backend.time import get_current_epoch_time
+
+
+SAMPLES = [
+    "2016-04-12T01:40:17Z",
+    "2016-02-29T23:59:59Z",
+    "2000-03-01T00:00:00Z",
+    "1969-12-31T23:59:59Z",
+    "2038-01-19T03:14:08Z",
+]
+ITERATIONS = 100000
+
+
+def reference_epoch_time(iso8601_str):
+    # The implementation get_epoch_time replaced, kept as the baseline
+    epoch_datetime = datetime.datetime(1970, 1, 1)
+    epoch_datetime = epoch_datetime.replace(tzinfo=pytz.UTC)
+    datetime_obj = iso8601.parse_date(iso8601_str)
+    return int((datetime_obj - epoch_datetime).total_seconds())
+
+
+def reference_current_epoch_time():
+    epoch_datetime = datetime.datetime(1970, 1, 1)
+    epoch_datetime = epoch_datetime.replace(tzinfo=pytz.UTC)
+    now_datetime = datetime.datetime.utcnow()
+    now_datetime = now_datetime.replace(tzinfo=pytz.UTC)
+    return int((now_datetime - epoch_datetime).total_seconds())
+
+
+def best_of(func, repeat=3):
+    return min(timeit.repeat(func, number=ITERATIONS, repeat=repeat))
+
+
+def main():
+    for sample in SAMPLES:
+        assert get_epoch_time(sample) == reference_epoch_time(sample), sample
+
+    print("%-24s %12s %12s %8s" % ("", "before (us)", "after (us)", "speedup"))  # NOQA
+    for name, before, after in [
+        ("get_epoch_time",
+         lambda: [reference_epoch_time(s) for s in SAMPLES],
+         lambda: [get_epoch_time(s) for s in SAMPLES]),
+        ("get_current_epoch_time",
+         reference_current_epoch_time,
+         get_current_epoch_time),
+    ]:
+        calls = ITERATIONS * (len(SAMPLES) if name == "get_epoch_time" else 1)  # NOQA
+        before_time = best_of(before) / calls * 1e6
+        after_time = best_of(after) / calls * 1e6
+        print("%-24s %12.3f %12.3f %7.1fx" % (name, before_time, after_time, before_time / after_time))  # NOQA
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import bisect
+import os
+import random
+import sys
+from notification_backend.http import STORAGE_ENGINE
+from notification_backend.http import dynamodb_batch_write
+from notification_backend.notification_threads import determine_list_of_tags
+from notification_backend.notification_threads import thread_index_changes
+from notification_backend.notification_threads import TOMBSTONE_TTL
+from notification_backend.notification_threads import USER_METADATA_THREAD_ID
+from notification_backend.time import get_current_epoch_time
+from server import create_storage_tables
+
+
+MAX_THREAD_ID = 2 ** 31
+# Most notifications were updated in the last few days, the rest are spread
+# out over the six months the listings look back at most
+RECENT_SHARE = 0.7
+RECENT_MEAN_AGE = 3 * 86400  # in seconds
+MAX_AGE = 2592000 * 6  # in seconds
+DELETED_SHARE = 0.02
+EDITED_SHARE = 0.1
+REPOSITORIES_PER_USER = 25
+WRITE_CHUNK_SIZE = 1000
+
+# Weights follow what GitHub users typically get notified about
+REASONS = [
+    ("subscribed", 45),
+    ("comment", 18),
+    ("mention", 10),
+    ("author", 9),
+    ("team_mention", 6),
+    ("assign", 5),
+    ("review_requested", 4),
+    ("manual", 2),
+    ("state_change", 1)
+]
+SUBJECT_TYPES = [
+    ("Issue", 55),
+    ("PullRequest", 40),
+    ("Commit", 3),
+    ("Release", 2)
+]
+REPOSITORY_OWNERS = ["tidycat", "octocat", "github", "rails", "django"]
+EDITED_TAGS = ["later", "important", "read", "blocked"]
+
+
+def cumulative_weights(choices):
+    totals = []
+    total = 0
+    for choice, weight in choices:
+        total += weight
+        totals.append(total)
+    return [c for c, _ in choices], totals
+
+
+def weighted_choice(rng, weighted):
+    choices, totals = weighted
+    return choices[bisect.bisect_right(totals, rng.random() * totals[-1])]
+
+
+REASON_WEIGHTS = cumulative_weights(REASONS)
+SUBJECT_TYPE_WEIGHTS = cumulative_weights(SUBJECT_TYPES)
+
+
+def user_repositories(rng, user_id):
+    # A user hears about a handful of repositories a lot, and about most of
+    # them every now and then
+    owners = REPOSITORY_OWNERS + ["user%s" % user_id]
+    repositories = [
+        ((rng.choice(owners), "project-%02d" % r), 1.0 / (r + 1))
+        for r in range(REPOSITORIES_PER_USER)
+    ]
+    return cumulative_weights(repositories)
+
+
+def thread_age(rng):
+    if rng.random() < RECENT_SHARE:
+        return min(int(rng.expovariate(1.0 / RECENT_MEAN_AGE)), MAX_AGE)
+    return rng.randint(0, MAX_AGE)
+
+
+def generate_thread(rng, user_id, thread_id, now, repositories):
+    owner, name = weighted_choice(rng, repositories)
+    number = rng.randint(1, 5000)
+    thread = {
+        "user_id": user_id,
+        "thread_id": thread_id,
+        "thread_url": "https://api.github.com/notifications/threads/%s" % thread_id,  # NOQA
+        "thread_subscription_url": "https://api.github.com/notifications/threads/%s/subscription" % thread_id,  # NOQA
+        "reason": weighted_choice(rng, REASON_WEIGHTS),
+        "updated_at": now - thread_age(rng),
+        "subject_title": "Synthetic notification %s" % number,
+        "subject_url": "https://api.github.com/repos/%s/%s/issues/%s" % (owner, name, number),  # NOQA
+        "subject_type": weighted_choice(rng, SUBJECT_TYPE_WEIGHTS),
+        "repository_owner": owner,
+        "repository_name": name
+    }
+    thread['tags'] = determine_list_of_tags(thread)
+    if rng.random() < EDITED_SHARE:
+        thread['tags'].append(rng.choice(EDITED_TAGS))
+    return thread
+
+
+def tombstone(rng, thread, now):
+    # Deleted some time after the last update, and not expired yet
+    deleted_at = rng.randint(max(thread['updated_at'], now - TOMBSTONE_TTL),
+                             now)
+    return {
+        "user_id": thread['user_id'],
+        "thread_id": thread['thread_id'],
+        "deleted_at": deleted_at,
+        "expires_at": deleted_at + TOMBSTONE_TTL
+    }
+
+
+def written_at(item):
+    return item.get('deleted_at') or item['updated_at']
+
+
+def generate_threads(user_id,
+                     count=None,
+                     seed=0,
+                     now=None,
+                     thread_ids=None,
+                     deleted_share=DELETED_SHARE):
+    # Returns the user's threads (random thread ids unless given) in the
+    # order they were last written in, stamped with change versions in that
+    # order. The same seed and time make the same threads for every user,
+    # however many other users get generated along with them.
+    rng = random.Random(seed * 1000003 + int(user_id))
+    if now is None:
+        now = get_current_epoch_time()
+    if thread_ids is None:
+        thread_ids = rng.sample(xrange(1, MAX_THREAD_ID), count)
+    repositories = user_repositories(rng, user_id)
+
+    items = []
+    for thread_id in thread_ids:
+        thread = generate_thread(rng, user_id, thread_id, now, repositories)
+        if rng.random() < deleted_share:
+            thread = tombstone(rng, thread, now)
+        items.append(thread)
+    items.sort(key=lambda i: (written_at(i), i['thread_id']))
+    for change_version, item in enumerate(items, 1):
+        item['change_version'] = change_version
+    return items
+
+
+def user_metadata_item(user_id, items, now):
+    return {
+        "user_id": user_id,
+        "thread_id": USER_METADATA_THREAD_ID,
+        "user_version": len(items),
+        "changed_at": now
+    }
+
+
+def write_items(endpoint_url, table_name, items):
+    unprocessed = dynamodb_batch_write(endpoint_url,
+                                       table_name,
+                                       put_items=items)
+    if unprocessed:
+        raise RuntimeError("%s items could not be written to %s" % (len(unprocessed), table_name))  # NOQA
+
+
+def write_threads(endpoint_url, table_name, items, tag_table_name=None):
+    # In chunks, so that the index rows of 100k threads don't all have to
+    # be kept around at once
+    for start in range(0, len(items), WRITE_CHUNK_SIZE):
+        chunk = items[start:start + WRITE_CHUNK_SIZE]
+        write_items(endpoint_url, table_name, chunk)
+        if tag_table_name:
+            put_rows, delete_keys = thread_index_changes([], chunk)
+            write_items(endpoint_url, tag_table_name, put_rows)
+
+
+def write_dataset(endpoint_url,
+                  table_name,
+                  user_ids,
+                  threads_per_user,
+                  seed=0,
+                  now=None,
+                  tag_table_name=None,
+                  deleted_share=DELETED_SHARE):
+    # Yields every user and the number of threads written for them, as
+    # they get written
+    if now is None:
+        now = get_current_epoch_time()
+    for user_id in user_ids:
+        items = generate_threads(user_id,
+                                 threads_per_user,
+                                 seed=seed,
+                                 now=now,
+                                 deleted_share=deleted_share)
+        write_threads(endpoint_url, table_name, items, tag_table_name)
+        write_items(endpoint_url, table_name,
+                    [user_metadata_item(user_id, items, now)])
+        yield user_id, len(items)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fill the tables named by the server's environment "
+                    "variables with synthetic notifications"
+    )
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--threads-per-user", type=int, default=10000)
+    parser.add_argument("--first-user-id", type=int, default=333333)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--now", type=int,
+                        help="epoch seconds the data is generated as of, "
+                             "defaults to the current time")
+    parser.add_argument("--deleted-share", type=float, default=DELETED_SHARE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if STORAGE_ENGINE != "dynamodb":
+        create_storage_tables()
+    user_ids = range(args.first_user_id, args.first_user_id + args.users)
+    for user_id, count in write_dataset(
+            os.environ['DYNAMODB_ENDPOINT_URL'],
+            os.environ['NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME'],
+            user_ids,
+            args.threads_per_user,
+            seed=args.seed,
+            now=args.now,
+            tag_table_name=os.environ.get('NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME'),  # NOQA
+            deleted_share=args.deleted_share):
+        sys.stdout.write("Wrote %s threads for user %s\n" % (count, user_id))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (entry[1] is not None and entry[1] <= now):
+                self.misses += 1
+                return None
+            # Re-inserting the entry marks it as the most recently used one
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at=None):
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries)
+            }
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+import threading
+import time
+from notification_backend.cache import LRUCache
+from notification_backend.invocation import current_invocation
+
+
+class CapacityUsage(object):
+
+    # DynamoDB capacity units consumed, by table. The route and user get
+    # filled in once the invocation knows them.
+    def __init__(self):
+        self.route = None
+        self.user_id = None
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def add(self, table_name, read_units=0.0, write_units=0.0):
+        with self._lock:
+            units = self.tables.setdefault(table_name, [0.0, 0.0])
+            units[0] += read_units
+            units[1] += write_units
+
+    def totals(self):
+        with self._lock:
+            return (sum(u[0] for u in self.tables.values()),
+                    sum(u[1] for u in self.tables.values()))
+
+    def summary(self):
+        read_units, write_units = self.totals()
+        with self._lock:
+            tables = dict(
+                (name, {"read-units": r, "write-units": w})
+                for name, (r, w) in self.tables.items()
+            )
+        return {
+            "read-units": read_units,
+            "write-units": write_units,
+            "tables": tables
+        }
+
+
+class CapacityAccounts(object):
+
+    # Capacity consumed by this process, by route and by user. Users are
+    # accounted for over fixed windows of 'window' seconds, and once they
+    # read more than 'read_budget' units in a window (if there is a budget)
+    # they are over budget until the window is over. Budgets are kept per
+    # process as well: every Lambda container (or prefork worker) gives a
+    # user a budget of their own, so it caps the bursts a user sends any
+    # one of them rather than what they read overall.
+    def __init__(self, read_budget, window, max_users):
+        self.read_budget = read_budget
+        self.window = window
+        self.routes = {}
+        self.unattributed = CapacityUsage()
+        self.rejected = 0
+        self._users = LRUCache(max_users)
+        self._lock = threading.Lock()
+
+    def record(self, usage):
+        read_units, write_units = usage.totals()
+        with self._lock:
+            if usage.route is not None:
+                totals = self.routes.setdefault(usage.route, {
+                    "invocations": 0,
+                    "read_units": 0.0,
+                    "write_units": 0.0
+                })
+                totals['invocations'] += 1
+                totals['read_units'] += read_units
+                totals['write_units'] += write_units
+            if usage.user_id is not None and (read_units or write_units):
+                window = self.user_window(usage.user_id)
+                window[1] += read_units
+                window[2] += write_units
+
+    def user_window(self, user_id):
+        # [started at, read units, write units]
+        window = self._users.get(user_id)
+        if window is None:
+            started_at = time.time()
+            window = [started_at, 0.0, 0.0]
+            self._users.set(user_id, window,
+                            expires_at=started_at + self.window)
+        return window
+
+    def retry_after(self, user_id):
+        # Seconds until the user is within budget again, None if they are
+        if not self.read_budget:
+            return None
+        with self._lock:
+            window = self._users.get(user_id)
+            if window is None or window[1] < self.read_budget:
+                return None
+            self.rejected += 1
+            return max(0, window[0] + self.window - time.time())
+
+    def reset(self):
+        with self._lock:
+            self.routes.clear()
+            self.unattributed = CapacityUsage()
+            self.rejected = 0
+            self._users.clear()
+
+    def stats(self):
+        read_units, write_units = self.unattributed.totals()
+        with self._lock:
+            return {
+                "routes": dict((r, dict(t)) for r, t in self.routes.items()),
+                "unattributed_read_units": read_units,
+                "unattributed_write_units": write_units,
+                "users": self._users.stats()['size'],
+                "rejected": self.rejected
+            }
+
+
+def current_usage():
+    return current_invocation().usage
+
+
+def start_metering(usage=None):
+    if usage is None:
+        usage = CapacityUsage()
+    current_invocation().usage = usage
+    return usage
+
+
+def stop_metering():
+    current_invocation().usage = None
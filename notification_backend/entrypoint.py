@@ -1,24 +1,188 @@
+import json
 import logging
+import os
+import random
+import timeit
 from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import write_behind_queue
 from notification_backend.http import format_response
 from notification_backend.http import format_error_payload
+from notification_backend.http import dynamodb_retry_policy
+from notification_backend.http import dynamodb_capacity
+from notification_backend.capacity import start_metering
+from notification_backend.capacity import stop_metering
+from notification_backend.tracing import start_trace
+from notification_backend.tracing import stop_trace
 
 __version__ = "0.0.1"
 logging.basicConfig()
 logger = logging.getLogger("notification_backend")
 logger.setLevel(logging.INFO)
+# Every invocation logs a line with its status and how long it took. A share
+# of them log where that time went instead, invocations with 'debug_timings'
+# set (the X-Debug-Timings header) always do.
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+
+
+def traced_invocation(event):
+    if event.get('debug_timings'):
+        return True
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
 
 
 def handler(event, context):
+    usage = start_metering()
+    streaming = False
+    try:
+        response = trace_event(event, context)
+        if isinstance(response, dict) and 'stream' in response:
+            response['stream'] = metered_stream(response['stream'], usage)
+            streaming = True
+        return response
+    finally:
+        stop_metering()
+        if not streaming:
+            account_capacity(usage)
+
+
+def metered_stream(lines, usage):
+    # Streamed responses keep reading from the datastore after the handler
+    # returned, that capacity still counts towards the invocation
+    start_metering(usage)
+    try:
+        for line in lines:
+            yield line
+    finally:
+        stop_metering()
+        account_capacity(usage)
+
+
+def account_capacity(usage):
+    dynamodb_capacity.record(usage)
+    if any(usage.totals()):
+        summary = usage.summary()
+        summary.update({"route": usage.route, "user-id": usage.user_id})
+        logger.info(json.dumps({"capacity": summary}))
+
+
+def error_status(e):
+    # Error responses are raised as TypeErrors, anything else is a bug
+    try:
+        return json.loads(str(e)).get('http_status')
+    except ValueError:
+        return 500
+
+
+def summarize_event(event, context):
+    started = timeit.default_timer()
+    http_status = 500
+    try:
+        response = handle_event(event, context)
+        http_status = response.get('http_status')
+        return response
+    except TypeError as e:
+        http_status = error_status(e)
+        raise
+    finally:
+        logger.info(json.dumps({
+            "invocation": {
+                "resource-path": event.get('resource-path'),
+                "http-method": event.get('http-method'),
+                "http-status": http_status,
+                "total-ms": round((timeit.default_timer() - started) * 1000, 3)  # NOQA
+            }
+        }))
+
+
+def trace_event(event, context):
+    if not traced_invocation(event):
+        return summarize_event(event, context)
+    trace = start_trace()
+    try:
+        response = handle_event(event, context)
+    except TypeError as e:
+        try:
+            response = json.loads(str(e))
+        except ValueError:
+            # Not an error response, but an actual bug
+            log_trace(trace, event, 500)
+            raise
+        raise TypeError(json.dumps(finish_trace(trace, event, response)))
+    finally:
+        stop_trace()
+    return finish_trace(trace, event, response)
+
+
+def handle_event(event, context):
+    # DynamoDB retries must not use up the time left to respond in
+    remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining_time is not None:
+        dynamodb_retry_policy.set_deadline(remaining_time() / 1000.0)
+    try:
+        return route_event(event)
+    finally:
+        # Unless something flushes them in the background (server.py does),
+        # queued writes need to go out before the invocation returns, and
+        # within its deadline
+        try:
+            if not write_behind_queue.running():
+                write_behind_queue.flush()
+        finally:
+            dynamodb_retry_policy.set_deadline(None)
+
+
+def log_trace(trace, event, http_status):
+    timings = trace.timings()
+    logger.info(json.dumps({
+        "trace": {
+            "resource-path": event.get('resource-path'),
+            "http-method": event.get('http-method'),
+            "http-status": http_status,
+            "total-ms": timings['total-ms'],
+            "spans": timings['spans']
+        }
+    }))
+    return timings
+
+
+def finish_trace(trace, event, response):
+    timings = log_trace(trace, event, response.get('http_status'))
+    # Streamed and 304 responses have no payload to add the timings to
+    payload = response.get('data')
+    if event.get('debug_timings') and isinstance(payload, dict) and \
+            response.get('http_status') != 304:
+        payload.setdefault('meta', {})['timings'] = timings
+    return response
+
+
+def list_threads_method(event):
+    if event.get('qs_filter_id'):
+        logger.debug("Getting threads: %s" % event.get('qs_filter_id'))
+        return "find_threads"
+    if event.get('qs_filter_tag') or event.get('qs_filter_reason'):
+        logger.debug("Getting threads tagged %s with reason %s" % (event.get('qs_filter_tag'), event.get('qs_filter_reason')))  # NOQA
+        return "find_filtered_threads"
+    if event.get('qs_since'):
+        logger.debug("Getting threads changed since: %s" % event.get('qs_since'))  # NOQA
+        return "find_changed_threads"
+    logger.debug("Getting a list of all threads")
+    return "find_all_threads"
+
+
+def route_event(event):
     logger.debug("Received event: %s" % event)
 
     resource_path = event.get('resource-path')
     http_method = event.get('http-method')
 
     if http_method == "GET" and resource_path == "/notification/threads":
-        logger.debug("Getting a list of all threads")
         t = NotificationThreads(event)
-        return t.process_thread_event("find_all_threads")
+        return t.process_thread_event(list_threads_method(event))
+
+    elif http_method == "GET" and resource_path == "/notification/threads/export":  # NOQA
+        logger.debug("Exporting all threads")
+        t = NotificationThreads(event)
+        return t.process_thread_event("export_threads")
 
     elif http_method == "GET" and resource_path == "/notification/threads/{thread-id}":  # NOQA
         logger.debug("Getting info about thread: %s" % event.get('threadid'))
@@ -35,6 +199,21 @@ def handler(event, context):
         t = NotificationThreads(event)
         return t.process_thread_event("delete_thread")
 
+    elif http_method == "PATCH" and resource_path == "/notification/threads":
+        logger.debug("Updating threads in bulk")
+        t = NotificationThreads(event)
+        return t.process_thread_event("update_threads")
+
+    elif http_method == "DELETE" and resource_path == "/notification/threads":
+        logger.debug("Deleting threads in bulk")
+        t = NotificationThreads(event)
+        return t.process_thread_event("delete_threads")
+
+    elif http_method == "POST" and resource_path == "/notification/sync":
+        logger.debug("Syncing threads from GitHub")
+        t = NotificationThreads(event)
+        return t.process_thread_event("sync_threads")
+
     elif http_method == "GET" and resource_path == "/notification/ping":
         payload = {
             "data": [],
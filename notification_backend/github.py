@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+import logging
+import os
+import threading
+import time
+import timeit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from notification_backend.cache import LRUCache
+from notification_backend.tracing import traced
+from notification_backend.metrics import Histogram
+
+
+logger = logging.getLogger("notification_backend")
+GITHUB_API_URL = os.environ.get('GITHUB_API_URL', "https://api.github.com")
+GITHUB_CONNECT_TIMEOUT = float(os.environ.get('GITHUB_CONNECT_TIMEOUT', 3.05))  # NOQA
+GITHUB_READ_TIMEOUT = float(os.environ.get('GITHUB_READ_TIMEOUT', 10))
+GITHUB_MAX_POOL_CONNECTIONS = int(os.environ.get('GITHUB_MAX_POOL_CONNECTIONS', 10))  # NOQA
+# Requests left alone on every token, for the user's other GitHub clients
+GITHUB_RATE_LIMIT_RESERVE = int(os.environ.get('GITHUB_RATE_LIMIT_RESERVE', 50))  # NOQA
+# The longest a request gets held back for before it is deferred instead
+GITHUB_MAX_PACING_DELAY = float(os.environ.get('GITHUB_MAX_PACING_DELAY', 1))  # NOQA
+GITHUB_RATE_LIMIT_TOKENS = 4096
+# Below this share of the hourly limit, requests get spread out evenly over
+# what is left of the rate limit window
+GITHUB_PACING_THRESHOLD = 0.1
+
+# How long GitHub takes to answer, by status ("error" when it didn't)
+github_latency = Histogram("notification_github_request_duration_seconds",
+                           "Time spent on GitHub API requests",
+                           ["status"])
+
+# A single keep-alive session per process so that warm Lambda containers and
+# server.py skip the TLS handshake to api.github.com on every lookup
+_session_lock = threading.Lock()
+_session = None
+
+
+def github_session():
+    global _session
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=GITHUB_MAX_POOL_CONNECTIONS)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+class GitHubRateLimited(RequestException):
+
+    def __init__(self, retry_after):
+        super(GitHubRateLimited, self).__init__(
+            "GitHub rate limit nearly used up, retry in %.0f seconds" % retry_after  # NOQA
+        )
+        self.retry_after = retry_after
+
+
+# The rate limit state GitHub last reported for each token
+_rate_limits_lock = threading.Lock()
+_rate_limits = LRUCache(GITHUB_RATE_LIMIT_TOKENS)
+
+
+def record_rate_limit(github_token, response):
+    headers = response.headers
+    if 'X-RateLimit-Remaining' not in headers:
+        return
+    with _rate_limits_lock:
+        state = _rate_limits.get(github_token) or {"requested_at": 0}
+        state.update({
+            "limit": int(headers.get('X-RateLimit-Limit', 5000)),
+            "remaining": int(headers.get('X-RateLimit-Remaining')),
+            "reset": int(headers.get('X-RateLimit-Reset', 0))
+        })
+        if 'X-Poll-Interval' in headers:
+            state['poll_interval'] = int(headers.get('X-Poll-Interval'))
+        _rate_limits.set(github_token, state)
+
+
+def reserve_github_request(github_token):
+    # Returns how long the next request with this token needs to be held
+    # back for (in seconds) and books it against the remaining budget
+    now = time.time()
+    with _rate_limits_lock:
+        state = _rate_limits.get(github_token)
+        if state is None or state['reset'] <= now:
+            return 0
+        window = state['reset'] - now
+        spare = state['remaining'] - GITHUB_RATE_LIMIT_RESERVE
+        if spare <= 0:
+            return window
+        delay = 0
+        if state['remaining'] < state['limit'] * GITHUB_PACING_THRESHOLD:
+            delay = max(0, state['requested_at'] + window / spare - now)
+        if delay <= GITHUB_MAX_PACING_DELAY:
+            state['remaining'] -= 1
+            state['requested_at'] = now + delay
+        return delay
+
+
+def release_github_request(github_token):
+    # Gives back a request booked by reserve_github_request that GitHub
+    # didn't count against the rate limit
+    with _rate_limits_lock:
+        state = _rate_limits.get(github_token)
+        if state is not None:
+            state['remaining'] = min(state['remaining'] + 1, state['limit'])
+
+
+def github_poll_interval(github_token):
+    state = _rate_limits.get(github_token) or {}
+    return state.get('poll_interval')
+
+
+def reset_github_rate_limits():
+    _rate_limits.clear()
+
+
+def reset_github_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+@traced("github_get")
+def github_get(path, github_token, headers=None, params=None):
+    request_headers = {
+        "Accept": "application/json",
+        "Authorization": "Bearer %s" % github_token
+    }
+    request_headers.update(headers or {})
+
+    delay = reserve_github_request(github_token)
+    if delay > GITHUB_MAX_PACING_DELAY:
+        raise GitHubRateLimited(delay)
+    if delay > 0:
+        logger.debug("Holding back GitHub request for %.2f seconds" % delay)
+        time.sleep(delay)
+
+    started = timeit.default_timer()
+    status = "error"
+    try:
+        response = github_session().get(
+            "%s%s" % (GITHUB_API_URL, path),
+            headers=request_headers,
+            params=params,
+            timeout=(GITHUB_CONNECT_TIMEOUT, GITHUB_READ_TIMEOUT)
+        )
+        status = str(response.status_code)
+    finally:
+        github_latency.observe(timeit.default_timer() - started, (status,))
+    if response.status_code == 304:
+        # Conditional requests GitHub answers with a 304 are free
+        release_github_request(github_token)
+    record_rate_limit(github_token, response)
+    return response
@@ -1,11 +1,77 @@
+from __future__ import absolute_import
+import Queue
+import base64
 import json
 import jwt
 import boto3
 import logging
+import os
 import re
+import threading
+from decimal import Decimal
+from botocore.config import Config
+from notification_backend.cache import LRUCache
+from notification_backend.retry import RetryPolicy
+from notification_backend.tracing import traced
+from notification_backend.capacity import CapacityAccounts
+from notification_backend.capacity import current_usage
+from notification_backend.invocation import bind_invocation
+from notification_backend.metrics import Histogram
+from notification_backend.storage import Storage
+from notification_backend.storage import MemoryStorage
+from notification_backend.storage import SQLiteStorage
 
 
 logger = logging.getLogger("notification_backend")
+DYNAMODB_MAX_POOL_CONNECTIONS = int(os.environ.get('DYNAMODB_MAX_POOL_CONNECTIONS', 10))  # NOQA
+DYNAMODB_BATCH_GET_LIMIT = 100  # Maximum number of keys per BatchGetItem
+DYNAMODB_BATCH_WRITE_LIMIT = 25  # Maximum number of items per BatchWriteItem
+DYNAMODB_BATCH_MAX_ATTEMPTS = 5
+# Items held between parallel scans and the consumer of their results
+DYNAMODB_SCAN_BUFFER_SIZE = 1000
+DYNAMODB_SEGMENT_DONE = object()
+DYNAMODB_MAX_ATTEMPTS = int(os.environ.get('DYNAMODB_MAX_ATTEMPTS', 8))
+DYNAMODB_BACKOFF = 0.05  # in seconds, doubled on every retry
+DYNAMODB_MAX_BACKOFF = float(os.environ.get('DYNAMODB_MAX_BACKOFF', 2))
+# Throttled tables never get less than this many requests per second
+DYNAMODB_MIN_REQUEST_RATE = float(os.environ.get('DYNAMODB_MIN_REQUEST_RATE', 5))  # NOQA
+# Time kept back from retries to still be able to respond in an invocation
+DYNAMODB_RETRY_TIME_RESERVE = float(os.environ.get('DYNAMODB_RETRY_TIME_RESERVE', 0.5))  # NOQA
+# Read capacity units each user may consume per budget window before their
+# list queries get turned away, 0 for no budget
+USER_READ_CAPACITY_BUDGET = float(os.environ.get('USER_READ_CAPACITY_BUDGET', 0))  # NOQA
+USER_CAPACITY_BUDGET_WINDOW = int(os.environ.get('USER_CAPACITY_BUDGET_WINDOW', 60))  # NOQA
+USER_CAPACITY_CACHE_SIZE = int(os.environ.get('USER_CAPACITY_CACHE_SIZE', 4096))  # NOQA
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', 1024))
+# "dynamodb", or "memory" / "sqlite" to run without a DynamoDB instance
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'dynamodb')
+SQLITE_DATABASE = os.environ.get('SQLITE_DATABASE', ':memory:')
+
+# Decoded claims of recently validated tokens, evicted at the token's 'exp'
+jwt_cache = LRUCache(JWT_CACHE_SIZE)
+
+# boto3 resources are expensive to build (session, endpoint and service model
+# loading, a fresh connection pool) so they are kept around for the lifetime
+# of the process, which lets warm Lambda containers and server.py reuse them
+_dynamodb_lock = threading.Lock()
+_dynamodb_resources = {}
+_dynamodb_tables = {}
+_storage_engines = {}
+
+# One retry policy for every DynamoDB request this process makes
+dynamodb_retry_policy = RetryPolicy(DYNAMODB_MAX_ATTEMPTS,
+                                    DYNAMODB_BACKOFF,
+                                    DYNAMODB_MAX_BACKOFF,
+                                    DYNAMODB_MIN_REQUEST_RATE,
+                                    DYNAMODB_RETRY_TIME_RESERVE)
+# How long the storage engine takes to answer, retries included
+dynamodb_latency = Histogram("notification_dynamodb_request_duration_seconds",
+                             "Time spent on storage engine requests",
+                             ["operation"])
+# Capacity consumed by every DynamoDB request this process makes
+dynamodb_capacity = CapacityAccounts(USER_READ_CAPACITY_BUDGET,
+                                     USER_CAPACITY_BUDGET_WINDOW,
+                                     USER_CAPACITY_CACHE_SIZE)
 
 
 def format_error_payload(http_status_code, message):
@@ -19,82 +85,578 @@ def format_error_payload(http_status_code, message):
     }
 
 
-def format_response(http_status_code, payload):
+def format_response(http_status_code, payload, headers=None):
     response = {
         "http_status": http_status_code,
         "data": payload
     }
+    if headers:
+        response['headers'] = headers
     logger.debug("Response: %s" % response)
     if http_status_code == 200:
         return response
     raise TypeError(json.dumps(response))
 
 
+def format_stream_response(lines, headers=None):
+    # Streamed responses carry an iterator over their body instead of a
+    # payload, for server.py to write out as it goes
+    response = {
+        "http_status": 200,
+        "stream": lines
+    }
+    if headers:
+        response['headers'] = headers
+    return response
+
+
+@traced("validate_jwt")
 def validate_jwt(token, secret):
+    cache_key = (token, secret)
+    claims = jwt_cache.get(cache_key)
+    if claims is not None:
+        return dict(claims)
+
     token_header = re.match('^Bearer (.+)', token)
     if not token_header:
         logger.debug("Could not match bearer token - Authorization header probably missing")  # NOQA
         return None
     try:
-        return jwt.decode(token_header.group(1), secret)
+        claims = jwt.decode(token_header.group(1), secret)
     except jwt.exceptions.InvalidTokenError as e:
         logger.debug("Invalid Token Error: %s" % str(e))
         return None
+    jwt_cache.set(cache_key, claims, expires_at=claims.get('exp'))
+    return dict(claims)
 
 
-def dynamodb_results(endpoint_url, table_name, key, index_name=None):
-    exclusive_start_key = None
-    more_results = True
-    dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
-    table = dynamodb.Table(table_name)
-    while more_results:
+def jwt_cache_stats():
+    return jwt_cache.stats()
+
+
+def dynamodb_resource(endpoint_url):
+    resource = _dynamodb_resources.get(endpoint_url)
+    if resource is not None:
+        return resource
+    with _dynamodb_lock:
+        resource = _dynamodb_resources.get(endpoint_url)
+        if resource is None:
+            config = Config(max_pool_connections=DYNAMODB_MAX_POOL_CONNECTIONS)  # NOQA
+            resource = boto3.resource('dynamodb',
+                                      endpoint_url=endpoint_url,
+                                      config=config)
+            # Throttles and transient errors are retried by
+            # dynamodb_retry_policy, retrying them in botocore as well would
+            # multiply the attempts
+            resource.meta.client.meta.events.unregister(
+                'needs-retry.dynamodb',
+                unique_id='retry-config-dynamodb'
+            )
+            _dynamodb_resources[endpoint_url] = resource
+    return resource
+
+
+def dynamodb_table(endpoint_url, table_name):
+    table = _dynamodb_tables.get((endpoint_url, table_name))
+    if table is not None:
+        return table
+    dynamodb = dynamodb_resource(endpoint_url)
+    with _dynamodb_lock:
+        table = _dynamodb_tables.get((endpoint_url, table_name))
+        if table is None:
+            table = dynamodb.Table(table_name)
+            _dynamodb_tables[(endpoint_url, table_name)] = table
+    return table
+
+
+def dynamodb_call(endpoint_url, table_name, operation, **kwargs):
+    return dynamodb_retry_policy.call((endpoint_url, table_name),
+                                      operation,
+                                      **kwargs)
+
+
+def dynamodb_retry_stats():
+    return dynamodb_retry_policy.stats()
+
+
+def record_consumed_capacity(results, writes=False):
+    # Counts towards the invocation the request was made for, if any
+    consumed = results.get('ConsumedCapacity')
+    if not consumed:
+        return
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    usage = current_usage() or dynamodb_capacity.unattributed
+    for c in consumed:
+        units = c.get('CapacityUnits', 0)
+        if writes:
+            usage.add(c.get('TableName'), write_units=units)
+        else:
+            usage.add(c.get('TableName'), read_units=units)
+
+
+def dynamodb_capacity_stats():
+    return dynamodb_capacity.stats()
+
+
+def reset_dynamodb_connections():
+    # Also drops whatever the in-process storage engines hold
+    with _dynamodb_lock:
+        _dynamodb_resources.clear()
+        _dynamodb_tables.clear()
+        _storage_engines.clear()
+
+
+def encode_pagination_cursor(last_evaluated_key):
+    key = {}
+    for name, value in last_evaluated_key.items():
+        if isinstance(value, Decimal):
+            value = int(value)
+        key[name] = value
+    return base64.urlsafe_b64encode(json.dumps(key, sort_keys=True)).rstrip("=")  # NOQA
+
+
+def decode_pagination_cursor(cursor):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(str(cursor) + padding))
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid pagination cursor: %s" % str(e))
+    if not isinstance(key, dict):
+        raise ValueError("Invalid pagination cursor: %s" % cursor)
+    return key
+
+
+class DynamoDBStorage(Storage):
+
+    # Every request goes through dynamodb_retry_policy, and the capacity it
+    # consumed gets recorded
+    def __init__(self, endpoint_url):
+        self.endpoint_url = endpoint_url
+
+    def call(self, table_name, operation, writes=False, **kwargs):
+        result = dynamodb_call(self.endpoint_url,
+                               table_name,
+                               operation,
+                               ReturnConsumedCapacity="TOTAL",
+                               **kwargs)
+        record_consumed_capacity(result, writes)
+        return result
+
+    def query(self, table_name, key, index_name=None, limit=None,
+              exclusive_start_key=None, projection=None,
+              scan_index_forward=True, filter_expression=None):
+        table = dynamodb_table(self.endpoint_url, table_name)
         kwargs = {"KeyConditionExpression": key}
         if index_name:
             kwargs.update({"IndexName": index_name})
+        if filter_expression is not None:
+            kwargs.update({"FilterExpression": filter_expression})
+        if limit:
+            kwargs.update({"Limit": limit})
+        if not scan_index_forward:
+            kwargs.update({"ScanIndexForward": False})
+        if exclusive_start_key:
+            kwargs.update({"ExclusiveStartKey": exclusive_start_key})
+        if projection:
+            kwargs.update(projection_arguments(projection))
+        results = self.call(table_name, table.query, **kwargs)
+        return results['Items'], results.get('LastEvaluatedKey')
+
+    def scan(self, table_name, filter_expression=None, segment=None,
+             total_segments=None, exclusive_start_key=None, projection=None):
+        table = dynamodb_table(self.endpoint_url, table_name)
+        kwargs = {}
+        if filter_expression is not None:
+            kwargs.update({"FilterExpression": filter_expression})
+        if total_segments:
+            kwargs.update({"Segment": segment, "TotalSegments": total_segments})  # NOQA
         if exclusive_start_key:
             kwargs.update({"ExclusiveStartKey": exclusive_start_key})
-        results = table.query(**kwargs)
-        for item in results['Items']:
+        if projection:
+            kwargs.update(projection_arguments(projection))
+        results = self.call(table_name, table.scan, **kwargs)
+        return results['Items'], results.get('LastEvaluatedKey')
+
+    def get_item(self, table_name, key, projection=None):
+        table = dynamodb_table(self.endpoint_url, table_name)
+        kwargs = {"Key": key}
+        if projection:
+            kwargs.update(projection_arguments(projection))
+        result = self.call(table_name, table.get_item, **kwargs)
+        return result.get('Item')
+
+    def put_item(self, table_name, item, condition_expression=None,
+                 return_values=None):
+        table = dynamodb_table(self.endpoint_url, table_name)
+        kwargs = {"Item": item}
+        if condition_expression:
+            kwargs.update({"ConditionExpression": condition_expression})
+        if return_values:
+            kwargs.update({"ReturnValues": return_values})
+        result = self.call(table_name, table.put_item, writes=True, **kwargs)
+        if return_values:
+            return result.get('Attributes', {})
+
+    def delete_item(self, table_name, key, condition_expression=None):
+        table = dynamodb_table(self.endpoint_url, table_name)
+        kwargs = {"Key": key}
+        if condition_expression:
+            kwargs.update({"ConditionExpression": condition_expression})
+        self.call(table_name, table.delete_item, writes=True, **kwargs)
+
+    def update_item(self, table_name, key, update_expression,
+                    expr_attribute_values, condition_expression=None,
+                    return_values="UPDATED_NEW"):
+        table = dynamodb_table(self.endpoint_url, table_name)
+        kwargs = {}
+        kwargs.update({"Key": key})
+        kwargs.update({"UpdateExpression": update_expression})
+        kwargs.update({"ExpressionAttributeValues": expr_attribute_values})
+        kwargs.update({"ReturnValues": return_values})
+        if condition_expression:
+            kwargs.update({"ConditionExpression": condition_expression})
+        return self.call(table_name, table.update_item, writes=True, **kwargs)  # NOQA
+
+    def batch_get(self, table_name, keys, projection=None,
+                  max_attempts=DYNAMODB_BATCH_MAX_ATTEMPTS,
+                  consistent_read=False):
+        dynamodb = dynamodb_resource(self.endpoint_url)
+        items = []
+        unprocessed_keys = []
+        for i in range(0, len(keys), DYNAMODB_BATCH_GET_LIMIT):
+            request = {"Keys": keys[i:i + DYNAMODB_BATCH_GET_LIMIT]}
+            if projection:
+                request.update(projection_arguments(projection))
+            if consistent_read:
+                request.update({"ConsistentRead": True})
+            responses, request_items = dynamodb_batch_retry(
+                self.endpoint_url,
+                table_name,
+                dynamodb.batch_get_item,
+                {table_name: request},
+                'UnprocessedKeys',
+                max_attempts
+            )
+            for results in responses:
+                record_consumed_capacity(results)
+                items.extend(results['Responses'].get(table_name, []))
+            if request_items:
+                unprocessed_keys.extend(request_items[table_name]['Keys'])
+        return items, unprocessed_keys
+
+    def batch_write(self, table_name, put_items=None, delete_keys=None,
+                    max_attempts=DYNAMODB_BATCH_MAX_ATTEMPTS):
+        dynamodb = dynamodb_resource(self.endpoint_url)
+        write_requests = [{"PutRequest": {"Item": i}} for i in put_items or []]  # NOQA
+        write_requests.extend(
+            [{"DeleteRequest": {"Key": k}} for k in delete_keys or []]
+        )
+        unprocessed_requests = []
+        for i in range(0, len(write_requests), DYNAMODB_BATCH_WRITE_LIMIT):
+            responses, request_items = dynamodb_batch_retry(
+                self.endpoint_url,
+                table_name,
+                dynamodb.batch_write_item,
+                {table_name: write_requests[i:i + DYNAMODB_BATCH_WRITE_LIMIT]},  # NOQA
+                'UnprocessedItems',
+                max_attempts
+            )
+            for results in responses:
+                record_consumed_capacity(results, writes=True)
+            if request_items:
+                unprocessed_requests.extend(request_items[table_name])
+        return unprocessed_requests
+
+
+# Tables live on DynamoDB unless told otherwise, the other engines keep them
+# in this process (see notification_backend/storage.py)
+STORAGE_ENGINES = {
+    "dynamodb": DynamoDBStorage,
+    "memory": lambda endpoint_url: MemoryStorage(),
+    "sqlite": lambda endpoint_url: SQLiteStorage(SQLITE_DATABASE)
+}
+
+
+def storage_engine(endpoint_url):
+    engine = _storage_engines.get(endpoint_url)
+    if engine is not None:
+        return engine
+    if STORAGE_ENGINE not in STORAGE_ENGINES:
+        raise ValueError("Unknown storage engine %s" % STORAGE_ENGINE)
+    with _dynamodb_lock:
+        engine = _storage_engines.get(endpoint_url)
+        if engine is None:
+            engine = STORAGE_ENGINES[STORAGE_ENGINE](endpoint_url)
+            _storage_engines[endpoint_url] = engine
+    return engine
+
+
+def projection_arguments(attributes):
+    # Every attribute gets aliased so reserved words can be projected too
+    aliases = ["#p%s" % i for i in range(len(attributes))]
+    return {
+        "ProjectionExpression": ", ".join(aliases),
+        "ExpressionAttributeNames": dict(zip(aliases, attributes))
+    }
+
+
+@traced("dynamodb_query")
+@dynamodb_latency.timed("query")
+def dynamodb_query(endpoint_url,
+                   table_name,
+                   key,
+                   index_name=None,
+                   limit=None,
+                   exclusive_start_key=None,
+                   projection=None,
+                   scan_index_forward=True,
+                   filter_expression=None):
+    return storage_engine(endpoint_url).query(
+        table_name,
+        key,
+        index_name=index_name,
+        limit=limit,
+        exclusive_start_key=exclusive_start_key,
+        projection=projection,
+        scan_index_forward=scan_index_forward,
+        filter_expression=filter_expression
+    )
+
+
+def dynamodb_results(endpoint_url,
+                     table_name,
+                     key,
+                     index_name=None,
+                     projection=None):
+    exclusive_start_key = None
+    more_results = True
+    while more_results:
+        items, exclusive_start_key = dynamodb_query(
+            endpoint_url,
+            table_name,
+            key,
+            index_name=index_name,
+            exclusive_start_key=exclusive_start_key,
+            projection=projection
+        )
+        for item in items:
             yield item
-        more_results = 'LastEvaluatedKey' in results
-        exclusive_start_key = results.get('LastEvaluatedKey')
+        more_results = exclusive_start_key is not None
+
+
+@traced("dynamodb_scan")
+@dynamodb_latency.timed("scan")
+def dynamodb_scan(endpoint_url,
+                  table_name,
+                  filter_expression=None,
+                  segment=None,
+                  total_segments=None,
+                  exclusive_start_key=None,
+                  projection=None):
+    return storage_engine(endpoint_url).scan(
+        table_name,
+        filter_expression=filter_expression,
+        segment=segment,
+        total_segments=total_segments,
+        exclusive_start_key=exclusive_start_key,
+        projection=projection
+    )
+
+
+def dynamodb_scan_results(endpoint_url,
+                          table_name,
+                          filter_expression=None,
+                          segment=None,
+                          total_segments=None,
+                          projection=None):
+    exclusive_start_key = None
+    more_results = True
+    while more_results:
+        items, exclusive_start_key = dynamodb_scan(
+            endpoint_url,
+            table_name,
+            filter_expression=filter_expression,
+            segment=segment,
+            total_segments=total_segments,
+            exclusive_start_key=exclusive_start_key,
+            projection=projection
+        )
+        for item in items:
+            yield item
+        more_results = exclusive_start_key is not None
+
+
+def scan_segment(results, pending_items, stopping):
+    # Hands the items of one segment over to dynamodb_parallel_scan_results
+    # (or the error that ended the segment), for as long as it still wants
+    # them
+    try:
+        for item in results:
+            if not put_pending(pending_items, (item, None), stopping):
+                return
+        put_pending(pending_items, (DYNAMODB_SEGMENT_DONE, None), stopping)
+    except Exception as e:
+        put_pending(pending_items, (DYNAMODB_SEGMENT_DONE, e), stopping)
+
+
+def put_pending(pending_items, entry, stopping):
+    while not stopping.is_set():
+        try:
+            pending_items.put(entry, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def dynamodb_parallel_scan_results(endpoint_url,
+                                   table_name,
+                                   total_segments,
+                                   filter_expression=None,
+                                   projection=None):
+    # Every segment is scanned by a thread of its own. Items are handed over
+    # through a bounded queue so slow consumers hold the scans back rather
+    # than buffering the table in memory.
+    pending_items = Queue.Queue(DYNAMODB_SCAN_BUFFER_SIZE)
+    stopping = threading.Event()
+    workers = []
+    for segment in range(total_segments):
+        results = dynamodb_scan_results(endpoint_url,
+                                        table_name,
+                                        filter_expression=filter_expression,
+                                        segment=segment,
+                                        total_segments=total_segments,
+                                        projection=projection)
+        worker = threading.Thread(target=bind_invocation(scan_segment),  # NOQA
+                                  args=(results, pending_items, stopping))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    segments_left = total_segments
+    try:
+        while segments_left:
+            item, error = pending_items.get()
+            if error is not None:
+                raise error
+            if item is DYNAMODB_SEGMENT_DONE:
+                segments_left -= 1
+                continue
+            yield item
+    finally:
+        # Scans still going (after an error, or when the consumer gave up)
+        # stop with the page they are on
+        stopping.set()
+        for worker in workers:
+            worker.join()
+
+
+@traced("dynamodb_get_item")
+@dynamodb_latency.timed("get_item")
+def dynamodb_get_item(endpoint_url, table_name, key, projection=None):
+    return storage_engine(endpoint_url).get_item(table_name,
+                                                 key,
+                                                 projection=projection)
+
+
+def dynamodb_batch_retry(endpoint_url,
+                         table_name,
+                         operation,
+                         request_items,
+                         unprocessed_name,
+                         max_attempts):
+    # Unprocessed items are what DynamoDB hands back instead of throttling
+    # a batch request, so they get the same backoff as throttled requests
+    key = (endpoint_url, table_name)
+    responses = []
+    attempt = 1
+    while True:
+        results = dynamodb_retry_policy.call(key,
+                                             operation,
+                                             RequestItems=request_items,
+                                             ReturnConsumedCapacity="TOTAL")
+        responses.append(results)
+        request_items = results.get(unprocessed_name)
+        if not request_items or not dynamodb_retry_policy.wait_to_retry(key, attempt, max_attempts):  # NOQA
+            return responses, request_items
+        attempt += 1
+
+
+@traced("dynamodb_batch_get")
+@dynamodb_latency.timed("batch_get")
+def dynamodb_batch_get(endpoint_url,
+                       table_name,
+                       keys,
+                       max_attempts=DYNAMODB_BATCH_MAX_ATTEMPTS,
+                       projection=None,
+                       consistent_read=False):
+    return storage_engine(endpoint_url).batch_get(
+        table_name,
+        keys,
+        projection=projection,
+        max_attempts=max_attempts,
+        consistent_read=consistent_read
+    )
+
+
+@traced("dynamodb_batch_write")
+@dynamodb_latency.timed("batch_write")
+def dynamodb_batch_write(endpoint_url,
+                         table_name,
+                         put_items=None,
+                         delete_keys=None,
+                         max_attempts=DYNAMODB_BATCH_MAX_ATTEMPTS):
+    return storage_engine(endpoint_url).batch_write(
+        table_name,
+        put_items=put_items,
+        delete_keys=delete_keys,
+        max_attempts=max_attempts
+    )
 
 
+@traced("dynamodb_new_item")
+@dynamodb_latency.timed("new_item")
 def dynamodb_new_item(endpoint_url,
                       table_name,
                       item,
-                      condition_expression=None):
-    dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
-    table = dynamodb.Table(table_name)
-    kwargs = {"Item": item}
-    if condition_expression:
-        kwargs.update({"ConditionExpression": condition_expression})
-    table.put_item(**kwargs)
+                      condition_expression=None,
+                      return_values=None):
+    return storage_engine(endpoint_url).put_item(
+        table_name,
+        item,
+        condition_expression=condition_expression,
+        return_values=return_values
+    )
 
 
+@traced("dynamodb_delete_item")
+@dynamodb_latency.timed("delete_item")
 def dynamodb_delete_item(endpoint_url,
                          table_name,
                          key,
                          condition_expression):
-    dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
-    table = dynamodb.Table(table_name)
-    table.delete_item(Key=key, ConditionExpression=condition_expression)
+    storage_engine(endpoint_url).delete_item(
+        table_name,
+        key,
+        condition_expression=condition_expression
+    )
 
 
+@traced("dynamodb_update_item")
+@dynamodb_latency.timed("update_item")
 def dynamodb_update_item(endpoint_url,
                          table_name,
                          key,
                          update_expression,
                          expr_attribute_values,
-                         condition_expression=None):
-    dynamodb = boto3.resource('dynamodb', endpoint_url=endpoint_url)
-    table = dynamodb.Table(table_name)
-    kwargs = {}
-    kwargs.update({"Key": key})
-    kwargs.update({"UpdateExpression": update_expression})
-    kwargs.update({"ExpressionAttributeValues": expr_attribute_values})
-    kwargs.update({"ReturnValues": "UPDATED_NEW"})
-    if condition_expression:
-        kwargs.update({"ConditionExpression": condition_expression})
-    result = table.update_item(**kwargs)
-    return result
+                         condition_expression=None,
+                         return_values="UPDATED_NEW"):
+    return storage_engine(endpoint_url).update_item(
+        table_name,
+        key,
+        update_expression,
+        expr_attribute_values,
+        condition_expression=condition_expression,
+        return_values=return_values
+    )
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+import threading
+
+
+# The invocation the current thread works on
+_local = threading.local()
+
+
+class Invocation(object):
+
+    # What the code serving an invocation keeps track of on the side: its
+    # trace and the path of the span it is in (see tracing.py), the
+    # capacity it consumed (see capacity.py) and when it has to respond by
+    # (see retry.py). Every thread has one, threads working on nothing
+    # leave it all None.
+    __slots__ = ("trace", "path", "usage", "deadline")
+
+    def __init__(self):
+        self.restore((None, None, None, None))
+
+    def state(self):
+        return (self.trace, self.path, self.usage, self.deadline)
+
+    def restore(self, state):
+        self.trace, self.path, self.usage, self.deadline = state
+
+
+def current_invocation():
+    invocation = getattr(_local, 'invocation', None)
+    if invocation is None:
+        invocation = Invocation()
+        _local.invocation = invocation
+    return invocation
+
+
+def bind_invocation(func):
+    # Work handed to other threads counts towards the invocation (and the
+    # span) it was handed out from, and is bound by its deadline
+    state = current_invocation().state()
+    if not any(value is not None for value in state):
+        return func
+
+    def run_bound(*args, **kwargs):
+        invocation = current_invocation()
+        previous_state = invocation.state()
+        invocation.restore(state)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invocation.restore(previous_state)
+    return run_bound
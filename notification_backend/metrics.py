@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+import bisect
+import functools
+import threading
+import timeit
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class Metric(object):
+
+    # Every thread updates a shard of its own, so updating a metric never
+    # waits for a lock (only a thread's first update does). The shards get
+    # added up as the metric is collected, and the shards of threads that
+    # are gone get folded into one.
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            with self._lock:
+                self.retire_shards()
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+        return shard
+
+    def retire_shards(self):
+        live_shards = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live_shards.append((thread, shard))
+            else:
+                self.merge(self._retired, shard)
+        self._shards = live_shards
+
+    def collect(self):
+        # Values by label values
+        totals = {}
+        with self._lock:
+            self.retire_shards()
+            self.merge(totals, self._retired)
+            for thread, shard in self._shards:
+                self.merge(totals, shard)
+        return totals
+
+    def reset(self):
+        with self._lock:
+            for thread, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+    def labels(self, label_values, *extra):
+        return zip(self.label_names, label_values) + list(extra)
+
+
+class Counter(Metric):
+
+    metric_type = "counter"
+
+    def inc(self, label_values=(), value=1):
+        shard = self.shard()
+        shard[label_values] = shard.get(label_values, 0) + value
+
+    def merge(self, totals, shard):
+        for label_values, value in shard.items():
+            totals[label_values] = totals.get(label_values, 0) + value
+
+    def samples(self):
+        return [("", self.labels(label_values), value)
+                for label_values, value in sorted(self.collect().items())]
+
+
+class Gauge(Counter):
+
+    # Goes up and down, every thread's shard holds what it added
+    metric_type = "gauge"
+
+    def dec(self, label_values=(), value=1):
+        self.inc(label_values, -value)
+
+
+class Histogram(Metric):
+
+    metric_type = "histogram"
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, label_values=()):
+        # Counts by bucket (plus one for values above the last bucket),
+        # followed by the sum of the values
+        shard = self.shard()
+        counts = shard.get(label_values)
+        if counts is None:
+            counts = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[label_values] = counts
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def timed(self, *label_values):
+        # Observes how long every call of the decorated function takes
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = timeit.default_timer()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(timeit.default_timer() - started,
+                                 label_values)
+            return wrapper
+        return decorator
+
+    def merge(self, totals, shard):
+        for label_values, counts in shard.items():
+            counts = list(counts)
+            total = totals.get(label_values)
+            if total is not None:
+                counts = [a + b for a, b in zip(total, counts)]
+            totals[label_values] = counts
+
+    def samples(self):
+        samples = []
+        for label_values, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((
+                    "_bucket",
+                    self.labels(label_values, ("le", format_value(bound))),
+                    cumulative
+                ))
+            samples.append(("_sum", self.labels(label_values), counts[-1]))
+            samples.append(("_count", self.labels(label_values), cumulative))
+        return samples
+
+
+class Snapshot(object):
+
+    # Values taken from the stats the caches and queues keep anyway, by
+    # label values
+    def __init__(self, name, description, metric_type, label_names, values):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        self.values = values
+
+    def samples(self):
+        return [("", zip(self.label_names, label_values), value)
+                for label_values, value in sorted(self.values.items())]
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))  # NOQA
+        for name, value in labels
+    )
+
+
+def render(metrics):
+    # Prometheus' text exposition format
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP %s %s" % (metric.name, metric.description))
+        lines.append("# TYPE %s %s" % (metric.name, metric.metric_type))
+        for suffix, labels, value in metric.samples():
+            lines.append("%s%s%s %s" % (metric.name,
+                                        suffix,
+                                        format_labels(labels),
+                                        format_value(value)))
+    return "\n".join(lines) + "\n"
@@ -1,23 +1,377 @@
+import hashlib
+import itertools
+import json
 import logging
-import requests
+import math
+import os
+import threading
+import urllib
+from collections import OrderedDict
+from email.utils import formatdate
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import RequestException
 from boto3.exceptions import Boto3Error
 from botocore.exceptions import ClientError
 from botocore.exceptions import BotoCoreError
 from boto3.dynamodb.conditions import Key, Attr
 from notification_backend.http import format_response
+from notification_backend.http import format_stream_response
 from notification_backend.http import validate_jwt
 from notification_backend.http import format_error_payload
 from notification_backend.http import dynamodb_results
+from notification_backend.http import dynamodb_query
+from notification_backend.http import dynamodb_parallel_scan_results
+from notification_backend.http import dynamodb_scan_results
+from notification_backend.http import encode_pagination_cursor
+from notification_backend.http import decode_pagination_cursor
 from notification_backend.http import dynamodb_new_item
+from notification_backend.http import dynamodb_get_item
+from notification_backend.http import dynamodb_batch_get
+from notification_backend.http import dynamodb_batch_write
 from notification_backend.http import dynamodb_update_item
-from notification_backend.http import dynamodb_delete_item
+from notification_backend.http import dynamodb_capacity
+from notification_backend.http import DYNAMODB_MAX_BACKOFF
+from notification_backend.github import github_get
+from notification_backend.github import GitHubRateLimited
+from notification_backend.github import github_poll_interval
+from notification_backend.cache import LRUCache
+from notification_backend.retry import is_throttling_error
+from notification_backend.write_behind import WriteBehindQueue
+from notification_backend.write_behind import expected_values_condition
+from notification_backend.tracing import span
+from notification_backend.tracing import traced
+from notification_backend.capacity import current_usage
+from notification_backend.invocation import bind_invocation
 from notification_backend.time import get_epoch_time
 from notification_backend.time import get_current_epoch_time
+from notification_backend.time import get_github_timestamp
 
 
 logger = logging.getLogger("notification_backend")
 BACKLOG_TIME_LIMIT = 2592000 * 6  # 6 months, in seconds
 DEFAULT_BACKLOG_SEARCH_TIME = 604800  # 1 week, in seconds
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+MAX_BATCH_THREAD_IDS = 100
+MAX_BULK_THREADS = 100
+# Segmented exports scan the whole table (any user's export costs what
+# reading every user's threads does), so they are off unless enabled
+MAX_EXPORT_SEGMENTS = int(os.environ.get('MAX_EXPORT_SEGMENTS', 0))
+GITHUB_SYNC_PAGE_SIZE = 50  # GitHub's maximum for the notifications list
+GITHUB_SYNC_MAX_PAGES = int(os.environ.get('GITHUB_SYNC_MAX_PAGES', 10))
+
+# The attributes each route needs to read from the datastore (None for the
+# whole item)
+THREAD_RESOURCE_ATTRIBUTES = [
+    "thread_id",
+    "thread_url",
+    "thread_subscription_url",
+    "reason",
+    "updated_at",
+    "tags"
+]
+# Reads by thread id can come across tombstones of deleted threads
+TOMBSTONE_AWARE_ATTRIBUTES = THREAD_RESOURCE_ATTRIBUTES + ["deleted_at"]
+# What GitHub identified the stored copy of a thread by, for refreshes to
+# ask whether it changed since
+GITHUB_VALIDATORS = ["github_etag", "github_last_modified"]
+# What the tag index rows of a thread get built from
+INDEXED_ATTRIBUTES = TOMBSTONE_AWARE_ATTRIBUTES + ["user_id", "change_version"]  # NOQA
+ROUTE_PROJECTIONS = {
+    # Threads found missing get written back only as long as their tombstone
+    # (if any) is still there, which is told apart by its change version
+    "find_thread": TOMBSTONE_AWARE_ATTRIBUTES + ["change_version"] + GITHUB_VALIDATORS,  # NOQA
+    "find_threads": TOMBSTONE_AWARE_ATTRIBUTES + ["change_version"] + GITHUB_VALIDATORS,  # NOQA
+    "find_all_threads": THREAD_RESOURCE_ATTRIBUTES,
+    "find_filtered_threads": THREAD_RESOURCE_ATTRIBUTES,
+    "find_changed_threads": TOMBSTONE_AWARE_ATTRIBUTES + ["change_version", "changed_at"],  # NOQA
+    # Patched attributes get merged into the whole stored item
+    "update_threads": None,
+    "delete_threads": ["user_id", "thread_id", "deleted_at", "reason", "tags"] + GITHUB_VALIDATORS,  # NOQA
+    "export_threads": TOMBSTONE_AWARE_ATTRIBUTES,
+    # Synced threads get merged into the whole stored item
+    "sync_threads": None
+}
+# Each user's change version is kept in an item of its own, under a thread
+# id GitHub never hands out
+USER_METADATA_THREAD_ID = 0
+# Deleted threads leave a tombstone behind for delta syncs, change tokens
+# older than this can no longer be used
+TOMBSTONE_TTL = int(os.environ.get('TOMBSTONE_TTL', 604800))  # in seconds
+# How long a write may take to land after its change version got handed
+# out, delta syncs don't skip over a missing version any sooner
+CHANGE_SETTLE_TIME = int(os.environ.get('CHANGE_SETTLE_TIME', 30))  # in seconds  # NOQA
+# How many times the tag index rows of a thread get rewritten after the
+# thread changed again while they were being written
+INDEX_RECONCILE_ROUNDS = 3
+SINGLE_THREAD_ROUTES = ["find_thread", "update_thread", "delete_thread"]
+# Routes turned away while the user is over their read capacity budget
+LIST_ROUTES = [
+    "find_threads",
+    "find_all_threads",
+    "find_filtered_threads",
+    "find_changed_threads",
+    "export_threads"
+]
+GITHUB_FALLBACK_WORKERS = int(os.environ.get('GITHUB_FALLBACK_WORKERS', 8))
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('WRITE_BEHIND_QUEUE_SIZE', 1000))  # NOQA
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get('WRITE_BEHIND_MAX_ATTEMPTS', 3))  # NOQA
+GITHUB_NOT_FOUND_CACHE_SIZE = int(os.environ.get('GITHUB_NOT_FOUND_CACHE_SIZE', 4096))  # NOQA
+GITHUB_NOT_FOUND_CACHE_TTL = int(os.environ.get('GITHUB_NOT_FOUND_CACHE_TTL', 300))  # NOQA
+
+# Thread ids GitHub recently answered with a 404, keyed by (user id, thread
+# id), so retries of stale ids don't eat into the user's rate limit
+github_not_found_cache = LRUCache(GITHUB_NOT_FOUND_CACHE_SIZE,
+                                  ttl=GITHUB_NOT_FOUND_CACHE_TTL)
+
+_fallback_pool_lock = threading.Lock()
+_fallback_pool = None
+
+
+def github_fallback_pool():
+    global _fallback_pool
+    with _fallback_pool_lock:
+        if _fallback_pool is None:
+            _fallback_pool = ThreadPool(GITHUB_FALLBACK_WORKERS)
+    return _fallback_pool
+
+
+def allocate_change_versions(endpoint_url, table_name, user_id, count):
+    # Every write bumps the user's version (invalidating the validators
+    # handed out for earlier reads) and stamps each written thread with a
+    # version of its own, for delta syncs to pick up
+    result = dynamodb_update_item(
+        endpoint_url=endpoint_url,
+        table_name=table_name,
+        key={"user_id": user_id, "thread_id": USER_METADATA_THREAD_ID},
+        update_expression="add user_version :n set changed_at=:now",
+        expr_attribute_values={
+            ":n": count,
+            ":now": get_current_epoch_time()
+        }
+    )
+    last_version = int(result['Attributes']['user_version'])
+    return range(last_version - count + 1, last_version + 1)
+
+
+def stamp_changes(items, versions):
+    # Items are stamped with the time of their change once its version is
+    # allocated, so no version was handed out after the time it carries
+    changed_at = get_current_epoch_time()
+    for item, change_version in zip(items, versions):
+        item['change_version'] = change_version
+        item['changed_at'] = changed_at
+
+
+def stamp_change_versions(endpoint_url, table_name, items):
+    items_by_user = OrderedDict()
+    for item in items:
+        items_by_user.setdefault(item.get('user_id'), []).append(item)
+    for user_id, user_items in items_by_user.items():
+        stamp_changes(user_items, allocate_change_versions(endpoint_url,
+                                                           table_name,
+                                                           user_id,
+                                                           len(user_items)))
+
+
+def stamp_queued_writes(endpoint_url, table_name, items):
+    # Items that failed to be written keep the change version they got the
+    # first time around
+    stamp_change_versions(endpoint_url,
+                          table_name,
+                          [i for i in items if 'change_version' not in i])
+
+
+# Threads looked up on GitHub get persisted in the background (server.py) or
+# right before the invocation returns (Lambda), in batches. Change versions
+# are handed out as the batches get written.
+write_behind_queue = WriteBehindQueue(WRITE_BEHIND_QUEUE_SIZE,
+                                      WRITE_BEHIND_MAX_ATTEMPTS,
+                                      ["user_id", "thread_id"],
+                                      prepare=stamp_queued_writes)
+
+
+def parse_github_thread(thread_id, thread_json, etag=None, last_modified=None):  # NOQA
+    result = {
+        "thread_id": int(thread_id),
+        "thread_url": thread_json.get('url'),
+        "thread_subscription_url": thread_json.get('subscription_url'),
+        "reason": thread_json.get('reason'),
+        "updated_at": get_epoch_time(thread_json.get('updated_at')),
+        "subject_title": thread_json.get('subject', {}).get('title'),
+        "subject_url": thread_json.get('subject', {}).get('url'),
+        "subject_type": thread_json.get('subject', {}).get('type'),
+        "repository_owner": thread_json.get('repository', {}).get('owner', {}).get('login'),  # NOQA
+        "repository_name": thread_json.get('repository', {}).get('name')
+    }
+    for name, value in zip(GITHUB_VALIDATORS, [etag, last_modified]):
+        if value:
+            result[name] = value
+    return result
+
+
+def determine_list_of_tags(result):
+    # Set an appropriate tag name given the reason for the notification
+    # event
+    # https://developer.github.com/v3/activity/notifications/#notification-reasons
+    reason_map = {
+        "subscribed": "watching",
+        "manual": "subscribed",
+        "author": "owner",
+        "comment": "commented",
+        "mention": "mentioned",
+        "team_mention": "mentioned",
+        "assign": "assignee",
+        "review_requested": "reviewer",
+        "state_change": "participant"
+    }
+    tag_list = []
+    # Reasons GitHub added since don't get a tag of their own
+    if result.get('reason') in reason_map:
+        tag_list.append(reason_map.get(result.get('reason')))
+    tag_list.append(result.get('subject_type').lower())
+    tag_list.append(result.get('repository_owner').lower())
+    tag_list.append(result.get('repository_name').lower())
+    return tag_list
+
+
+def is_tombstone(result):
+    return bool(result.get('deleted_at'))
+
+
+def thread_index_keys(item):
+    # The tag index lists every thread once per tag and once for its
+    # reason, under the user it belongs to. Tombstones aren't listed.
+    if not item or is_tombstone(item):
+        return set()
+    user_id = int(item.get('user_id'))
+    index_keys = set("%s#tag:%s" % (user_id, t)
+                     for t in item.get('tags') or [] if t)
+    if item.get('reason'):
+        index_keys.add("%s#reason:%s" % (user_id, item.get('reason')))
+    return index_keys
+
+
+def thread_index_changes(old_items, new_items):
+    # Returns the index rows to put for the threads as they are about to be
+    # written (rows carry the thread resource, so filtered listings don't
+    # have to read the threads themselves), along with the keys of the rows
+    # the threads are no longer listed under
+    new_index_keys = {}
+    put_rows = []
+    for item in new_items:
+        index_keys = thread_index_keys(item)
+        new_index_keys[int(item.get('thread_id'))] = index_keys
+        row = dict((k, item.get(k)) for k in THREAD_RESOURCE_ATTRIBUTES
+                   if item.get(k) is not None)
+        row['thread_id'] = int(item.get('thread_id'))
+        row['user_id'] = int(item.get('user_id'))
+        put_rows.extend(dict(row, index_key=k) for k in sorted(index_keys))
+
+    delete_keys = []
+    for item in old_items:
+        thread_id = int(item.get('thread_id'))
+        stale_keys = thread_index_keys(item) - new_index_keys.get(thread_id, set())  # NOQA
+        delete_keys.extend({"index_key": k, "thread_id": thread_id}
+                           for k in sorted(stale_keys))
+    return put_rows, delete_keys
+
+
+def write_index_rows(endpoint_url, tag_table_name, put_rows, delete_keys):
+    if not put_rows and not delete_keys:
+        return
+    unprocessed_requests = dynamodb_batch_write(endpoint_url,
+                                                tag_table_name,
+                                                put_items=put_rows,
+                                                delete_keys=delete_keys)
+    if unprocessed_requests:
+        raise RuntimeError("%s tag index writes left unprocessed" % len(unprocessed_requests))  # NOQA
+
+
+def reconcile_thread_index(endpoint_url, table_name, tag_table_name,
+                           written_items):
+    # Index rows get written after the threads they list, so a thread
+    # written again in the meantime may have had its rows replaced by ones
+    # of the version written before it. Threads whose version moved on get
+    # their rows rewritten from what is stored, until the rows match it.
+    # Returns the threads still on the move after that.
+    for attempt in range(INDEX_RECONCILE_ROUNDS):
+        if not written_items:
+            break
+        current_items, unprocessed_keys = dynamodb_batch_get(
+            endpoint_url,
+            table_name,
+            [{"user_id": int(i['user_id']), "thread_id": int(i['thread_id'])}  # NOQA
+             for i in written_items],
+            projection=INDEXED_ATTRIBUTES,
+            consistent_read=True
+        )
+        if unprocessed_keys:
+            raise RuntimeError("%s threads could not be read back" % len(unprocessed_keys))  # NOQA
+        # Threads that are gone altogether were never written through here
+        current_by_id = dict((int(c['thread_id']), c) for c in current_items)
+        moved = []
+        for item in written_items:
+            current = current_by_id.get(int(item['thread_id']))
+            if current and current.get('change_version') != item.get('change_version'):  # NOQA
+                moved.append((item, current))
+        put_rows, delete_keys = thread_index_changes([i for i, c in moved],
+                                                     [c for i, c in moved])
+        write_index_rows(endpoint_url, tag_table_name, put_rows, delete_keys)
+        written_items = [c for i, c in moved]
+    return written_items
+
+
+def rebuild_thread_index(endpoint_url, table_name, tag_table_name, user_id):
+    # Rewrites every index row of the user from their threads, and deletes
+    # the rows listing anything else (left behind by index writes that
+    # failed). Reads the whole tag index, it is meant for repairs only.
+    # Returns the number of rows put and deleted.
+    threads = list(dynamodb_results(
+        endpoint_url,
+        table_name,
+        Key('user_id').eq(user_id) & Key('thread_id').gt(USER_METADATA_THREAD_ID),  # NOQA
+        projection=INDEXED_ATTRIBUTES
+    ))
+    put_rows, delete_keys = thread_index_changes([], threads)
+    listed = set((r['index_key'], r['thread_id']) for r in put_rows)
+    stale_keys = [
+        {"index_key": r['index_key'], "thread_id": int(r['thread_id'])}
+        for r in dynamodb_scan_results(endpoint_url,
+                                       tag_table_name,
+                                       filter_expression=Attr('user_id').eq(user_id),  # NOQA
+                                       projection=["index_key", "thread_id"])
+        if (r['index_key'], int(r['thread_id'])) not in listed
+    ]
+    write_index_rows(endpoint_url, tag_table_name, put_rows, stale_keys)
+    # Threads written while the rows were being rebuilt
+    reconcile_thread_index(endpoint_url, table_name, tag_table_name, threads)
+    return len(put_rows), len(stale_keys)
+
+
+@traced("format_thread_resource")
+def format_thread_resource(result):
+    return {
+        "type": "threads",
+        "id": int(result.get('thread_id')),
+        "attributes": {
+            "thread-url": result.get('thread_url'),
+            "thread-subscription-url": result.get('thread_subscription_url'),
+            "reason": result.get('reason'),
+            "updated-at": int(result.get('updated_at')),
+            "tags": result.get('tags')
+        },
+        "relationships": {
+            "github-thread": {
+                "data": {
+                    "id": int(result.get('thread_id')),
+                    "type": "github-thread"
+                }
+            }
+        }
+    }
 
 
 class NotificationThreads(object):
@@ -29,10 +383,27 @@ class NotificationThreads(object):
                      "notification_dynamodb_endpoint_url",
                      "notification_user_notification_dynamodb_table_name",
                      "notification_user_notification_date_dynamodb_index_name",
-                     "qs_from"]:
+                     "notification_user_notification_change_dynamodb_index_name",  # NOQA
+                     "notification_github_not_found_dynamodb_table_name",
+                     "notification_user_notification_tag_dynamodb_table_name",  # NOQA
+                     "qs_from",
+                     "qs_page_size",
+                     "qs_page_cursor",
+                     "qs_filter_id",
+                     "qs_filter_tag",
+                     "qs_filter_reason",
+                     "qs_since",
+                     "qs_segments",
+                     "stream_response",
+                     "if_none_match",
+                     "if_modified_since"]:
             setattr(self, prop, lambda_event.get(prop))
             self.token = None
             self.userid = None
+            self.projection = None
+            self.github_retry_after = None
+            # Threads GitHub wasn't asked about to spare its rate limit
+            self.github_deferred = set()
             self.resource_path = lambda_event.get('resource-path', "")
             self.threadid = lambda_event.get('threadid', '0')
         self.lambda_event = lambda_event
@@ -50,8 +421,25 @@ class NotificationThreads(object):
             logger.info(error_msg)
             return format_response(401, format_error_payload(401, error_msg))
 
+        if method_name in SINGLE_THREAD_ROUTES and \
+                int(self.threadid) == USER_METADATA_THREAD_ID:
+            error_msg = "Thread %s does not exist" % self.threadid
+            logger.info(error_msg)
+            return format_response(404, format_error_payload(404, error_msg))
+
+        usage = current_usage()
+        if usage is not None:
+            usage.route = method_name
+            usage.user_id = self.userid
+        if method_name in LIST_ROUTES:
+            retry_after = dynamodb_capacity.retry_after(self.userid)
+            if retry_after is not None:
+                return self.over_capacity_budget_response(retry_after)
+
+        self.projection = ROUTE_PROJECTIONS.get(method_name)
         method_to_call = getattr(self, method_name)
-        return method_to_call()
+        with span(method_name):
+            return method_to_call()
 
     def find_thread(self):
         thread_id = self.threadid
@@ -60,63 +448,182 @@ class NotificationThreads(object):
             results = dynamodb_results(
                 self.notification_dynamodb_endpoint_url,
                 self.notification_user_notification_dynamodb_table_name,
-                Key('user_id').eq(self.userid) & Key('thread_id').eq(int(thread_id))  # NOQA
+                Key('user_id').eq(self.userid) & Key('thread_id').eq(int(thread_id)),  # NOQA
+                projection=self.projection
             )
             # There should really only be one result
             result = results.next()
         except (Boto3Error, BotoCoreError, ClientError) as e:
             error_msg = "Error querying for thread %s from the datastore" % thread_id  # NOQA
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
         except StopIteration:
             pass
 
-        if not result:
+        if not result or is_tombstone(result):
             logger.debug("Could not find info for thread %s in the datastore" % thread_id)  # NOQA
 
-            result = self.lookup_github_thread_info(thread_id)
-            if not result:
+            result = self.fetch_github_thread(thread_id, result)
+            if not result and self.github_retry_after:
+                return self.github_rate_limited_response()
+            if not result or is_tombstone(result):
                 error_msg = "Could not find info for thread %s" % thread_id
                 logger.info(error_msg)
                 return format_response(404,
                                        format_error_payload(404, error_msg))
 
-            result['tags'] = self.determine_list_of_tags(result)
-            self.persist_thread_information(result)
+        result['thread_id'] = int(thread_id)
+        try:
+            headers, last_modified = self.validators(
+                int(result.get('updated_at')),
+                self.user_metadata(),
+                int(thread_id)
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying for thread %s from the datastore" % thread_id  # NOQA
+            return self.datastore_error(error_msg, e)
+        if self.not_modified(headers['ETag'], last_modified):
+            logger.debug("Thread %s has not been modified" % thread_id)
+            return format_response(304, {}, headers)
 
         payload = {
-            "data": {
-                "type": "threads",
-                "id": int(thread_id),
-                "attributes": {
-                    "thread-url": result.get('thread_url'),
-                    "thread-subscription-url": result.get('thread_subscription_url'),  # NOQA
-                    "reason": result.get('reason'),
-                    "updated-at": int(result.get('updated_at')),
-                    "tags": result.get('tags')
-                },
-                "relationships": {
-                    "github-thread": {
-                        "data": {
-                            "id": int(thread_id),
-                            "type": "github-thread"
-                        }
-                    }
-                }
-            }
+            "data": format_thread_resource(result)
         }
-        return format_response(200, payload)
+        return format_response(200, payload, headers)
 
-    def lookup_github_thread_info(self, thread_id):
-        headers = {
-            "Accept": "application/json",
-            "Authorization": "Bearer %s" % self.token.get('github_token')
+    def determine_thread_ids(self):
+        thread_ids = []
+        for thread_id in self.qs_filter_id.split(","):
+            thread_id = int(thread_id)
+            if thread_id <= USER_METADATA_THREAD_ID:
+                raise ValueError("%s is not a thread id" % thread_id)
+            if thread_id not in thread_ids:
+                thread_ids.append(thread_id)
+        if len(thread_ids) > MAX_BATCH_THREAD_IDS:
+            raise ValueError("%s thread ids requested" % len(thread_ids))
+        return thread_ids
+
+    def find_threads(self):
+        try:
+            thread_ids = self.determine_thread_ids()
+        except ValueError as e:
+            error_msg = "'filter[id]' parameter needs to be a comma separated list of at most %s thread ids" % MAX_BATCH_THREAD_IDS  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        keys = [{"user_id": self.userid, "thread_id": t} for t in thread_ids]
+        try:
+            results, unprocessed_keys = dynamodb_batch_get(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                keys,
+                projection=self.projection
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying the datastore"
+            return self.datastore_error(error_msg, e)
+        if unprocessed_keys:
+            error_msg = "Error querying the datastore"
+            logger.error("%s: %s keys left unprocessed" % (error_msg, len(unprocessed_keys)))  # NOQA
+            return format_response(500, format_error_payload(500, error_msg))
+
+        found = dict((int(r.get('thread_id')), r)
+                     for r in results if not is_tombstone(r))
+        tombstones = dict((int(r.get('thread_id')), r)
+                          for r in results if is_tombstone(r))
+        missing = [t for t in thread_ids if t not in found]
+        if missing:
+            logger.debug("Could not find info for threads %s in the datastore" % missing)  # NOQA
+            fallback_results = github_fallback_pool().map(
+                bind_invocation(
+                    lambda t: self.fetch_github_thread(t, tombstones.get(t))
+                ),
+                missing
+            )
+            for result in fallback_results:
+                if result and not is_tombstone(result):
+                    found[result.get('thread_id')] = result
+
+        payload = {
+            "data": [format_thread_resource(found[t]) for t in thread_ids if t in found],  # NOQA
+            "meta": {
+                "not-found": [t for t in thread_ids if t not in found and t not in self.github_deferred],  # NOQA
+                "deferred": [t for t in thread_ids if t in self.github_deferred]  # NOQA
+            }
         }
+        headers = {}
+        if self.github_deferred:
+            # The deferred threads are worth asking for again after this long
+            headers['Retry-After'] = str(int(math.ceil(self.github_retry_after)))  # NOQA
+        return format_response(200, payload, headers)
 
-        r = requests.get(
-            'https://api.github.com/notifications/threads/%s' % thread_id,
-            headers=headers
-        )
+    def datastore_error(self, error_msg, e):
+        logger.error("%s: %s" % (error_msg, str(e)))
+        if is_throttling_error(e):
+            # Still throttled after all the retries there was time for
+            retry_after = int(math.ceil(DYNAMODB_MAX_BACKOFF))
+            return format_response(503,
+                                   format_error_payload(503, error_msg),
+                                   {"Retry-After": str(retry_after)})
+        return format_response(500, format_error_payload(500, error_msg))
+
+    def github_rate_limited_response(self):
+        retry_after = int(math.ceil(self.github_retry_after))
+        error_msg = "GitHub rate limit nearly used up, try again in %s seconds" % retry_after  # NOQA
+        logger.info(error_msg)
+        return format_response(503,
+                               format_error_payload(503, error_msg),
+                               {"Retry-After": str(retry_after)})
+
+    def over_capacity_budget_response(self, retry_after):
+        retry_after = int(math.ceil(retry_after))
+        error_msg = "Read capacity budget used up, try again in %s seconds" % retry_after  # NOQA
+        logger.info("User %s: %s" % (self.userid, error_msg))
+        return format_response(429,
+                               format_error_payload(429, error_msg),
+                               {"Retry-After": str(retry_after)})
+
+    def fetch_github_thread(self, thread_id, tombstone=None):
+        # The tombstone the thread left behind, if it got deleted before.
+        # With the validators of the deleted copy on it, GitHub only gets
+        # asked whether the thread changed since (which doesn't count
+        # against the rate limit). If it didn't, the tombstone is kept and
+        # returned as it is.
+        if self.known_github_not_found(thread_id):
+            logger.debug("GitHub recently could not find thread %s" % thread_id)  # NOQA
+            return None
+        result = self.lookup_github_thread_info(thread_id, tombstone)
+        if result and result is not tombstone:
+            result['tags'] = determine_list_of_tags(result)
+            self.persist_thread_information(result, tombstone)
+        return result
+
+    def github_validators(self, stored):
+        headers = {}
+        if stored and stored.get('github_etag'):
+            headers['If-None-Match'] = stored.get('github_etag')
+        if stored and stored.get('github_last_modified'):
+            headers['If-Modified-Since'] = stored.get('github_last_modified')
+        return headers
+
+    @traced("lookup_github_thread_info")
+    def lookup_github_thread_info(self, thread_id, stored=None):
+        try:
+            r = github_get('/notifications/threads/%s' % thread_id,
+                           self.token.get('github_token'),
+                           headers=self.github_validators(stored))
+        except GitHubRateLimited as e:
+            logger.info("Not looking up thread %s: %s" % (thread_id, str(e)))
+            self.github_retry_after = e.retry_after
+            self.github_deferred.add(int(thread_id))
+            return None
+        except RequestException as e:
+            logger.error("Error contacting GitHub for thread %s: %s" % (thread_id, str(e)))  # NOQA
+            return None
+        if r.status_code == 304 and stored:
+            logger.debug("Thread %s has not changed on GitHub" % thread_id)
+            return stored
+        if r.status_code == 404:
+            self.remember_github_not_found(thread_id)
         if not r.status_code == 200:
             logger.info("Could not find thread information for %s" % thread_id)
             logger.info("HTTP response code from GitHub: %s" % r.status_code)
@@ -130,158 +637,623 @@ class NotificationThreads(object):
             logger.error("Could not parse JSON from response %s. Error: %s" % (r.text, str(e)))  # NOQA
             return None
 
-        updated_at = get_epoch_time(thread_json.get('updated_at'))
-        return {
-            "thread_id": int(thread_id),
-            "thread_url": thread_json.get('url'),
-            "thread_subscription_url": thread_json.get('subscription_url'),
-            "reason": thread_json.get('reason'),
-            "updated_at": updated_at,
-            "subject_title": thread_json.get('subject', {}).get('title'),
-            "subject_url": thread_json.get('subject', {}).get('url'),
-            "subject_type": thread_json.get('subject', {}).get('type'),
-            "repository_owner": thread_json.get('repository', {}).get('owner', {}).get('login'),  # NOQA
-            "repository_name": thread_json.get('repository', {}).get('name')
-        }
+        return parse_github_thread(thread_id,
+                                   thread_json,
+                                   r.headers.get('ETag'),
+                                   r.headers.get('Last-Modified'))
 
-    def determine_list_of_tags(self, result):
-        # Set an appropriate tag name given the reason for the notification
-        # event
-        # https://developer.github.com/v3/activity/notifications/#notification-reasons
-        reason_map = {
-            "subscribed": "watching",
-            "manual": "subscribed",
-            "author": "owner",
-            "comment": "commented",
-            "mention": "mentioned",
-            "team_mention": "mentioned",
-            "assign": "assignee"
-        }
-        tag_list = []
-        tag_list.append(reason_map.get(result.get('reason')))
-        tag_list.append(result.get('subject_type').lower())
-        tag_list.append(result.get('repository_owner').lower())
-        tag_list.append(result.get('repository_name').lower())
-        return tag_list
+    def github_not_found_key(self, thread_id):
+        return {"user_id": self.userid, "thread_id": int(thread_id)}
 
-    def persist_thread_information(self, result):
+    def known_github_not_found(self, thread_id):
+        key = self.github_not_found_key(thread_id)
+        if github_not_found_cache.get((key['user_id'], key['thread_id'])):
+            return True
+        if not self.notification_github_not_found_dynamodb_table_name:
+            return False
+
+        try:
+            item = dynamodb_get_item(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_github_not_found_dynamodb_table_name,
+                key
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            logger.error("Error querying for GitHub misses of thread %s: %s" % (thread_id, str(e)))  # NOQA
+            return False
+        # Expired items can linger for a while before DynamoDB removes them
+        if not item or int(item.get('expires_at')) <= get_current_epoch_time():
+            return False
+        # The local entry goes when the shared one does, not a whole TTL on
+        github_not_found_cache.set((key['user_id'], key['thread_id']),
+                                   True,
+                                   expires_at=int(item.get('expires_at')))
+        return True
+
+    def remember_github_not_found(self, thread_id):
+        key = self.github_not_found_key(thread_id)
+        github_not_found_cache.set((key['user_id'], key['thread_id']), True)
+        if not self.notification_github_not_found_dynamodb_table_name:
+            return
+
+        key['expires_at'] = get_current_epoch_time() + GITHUB_NOT_FOUND_CACHE_TTL  # NOQA
+        try:
+            dynamodb_new_item(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_github_not_found_dynamodb_table_name,
+                key
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            logger.error("Error recording a GitHub miss of thread %s: %s" % (thread_id, str(e)))  # NOQA
+
+    @traced("persist_thread_information")
+    def persist_thread_information(self, result, tombstone=None):
+        # The thread is only written as long as nothing else got written in
+        # its place since it was found missing: a PATCH or DELETE made before
+        # the write lands is not to be undone by it
+        if tombstone:
+            expected = {"change_version": tombstone.get('change_version')}
+        else:
+            expected = {"thread_id": None}
         result['user_id'] = int(self.userid)
+        # The thread gets listed in the tag index once it is written
+        if write_behind_queue.enqueue(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                dict(result),
+                expected,
+                self.index_persisted_thread):
+            return
+
         try:
+            stamp_change_versions(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                [result]
+            )
             dynamodb_new_item(
                 self.notification_dynamodb_endpoint_url,
                 self.notification_user_notification_dynamodb_table_name,
-                result
+                result,
+                condition_expression=expected_values_condition(expected)
             )
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":  # NOQA
+                logger.debug("Thread %s got written while it was looked up on GitHub" % result.get('thread_id'))  # NOQA
+                return
+            error_msg = "Error writing info for thread %s to the datastore" % result.get('thread_id')  # NOQA
+            return self.datastore_error(error_msg, e)
         except (Boto3Error, BotoCoreError) as e:
             error_msg = "Error writing info for thread %s to the datastore" % result.get('thread_id')  # NOQA
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
+        self.index_persisted_thread(result)
 
-    def find_all_threads(self):
+    def index_persisted_thread(self, result):
+        # Threads only get fetched from GitHub when there is nothing (but
+        # maybe a tombstone) stored, so there are no stale index rows
+        self.update_thread_index([], [result])
+
+    def update_thread_index(self, old_items, new_items):
+        # Takes the threads (or tombstones) as they were before and as they
+        # got written, with their change versions. The threads themselves
+        # are written by now, so failing to keep the tag index up to date
+        # does not fail the request: the user's index needs a rebuild then
+        # (see rebuild_thread_index).
+        if not self.notification_user_notification_tag_dynamodb_table_name:
+            return
+        put_rows, delete_keys = thread_index_changes(old_items, new_items)
+        try:
+            write_index_rows(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_tag_dynamodb_table_name,  # NOQA
+                put_rows,
+                delete_keys
+            )
+            unsettled = reconcile_thread_index(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                self.notification_user_notification_tag_dynamodb_table_name,  # NOQA
+                new_items
+            )
+        except (Boto3Error, BotoCoreError, ClientError, RuntimeError) as e:
+            logger.error("Error updating the tag index of user %s, it needs a rebuild: %s" % (self.userid, str(e)))  # NOQA
+            return
+        if unsettled:
+            logger.error("Tag index rows of threads %s of user %s kept changing, it needs a rebuild" % (sorted(int(i['thread_id']) for i in unsettled), self.userid))  # NOQA
+
+    def user_metadata_key(self):
+        return {"user_id": self.userid, "thread_id": USER_METADATA_THREAD_ID}
+
+    def user_metadata(self):
+        item = dynamodb_get_item(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            self.user_metadata_key(),
+            projection=["user_version", "changed_at"]
+        ) or {}
+        return int(item.get('user_version', 0)), int(item.get('changed_at', 0))  # NOQA
+
+    def stamp_changes(self, items):
+        # The items are all the user's own
+        stamp_changes(items, allocate_change_versions(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            self.userid,
+            len(items)
+        ))
+
+    def tombstone(self, user_id, thread_id, stored):
+        deleted_at = get_current_epoch_time()
+        tombstone = {
+            "user_id": user_id,
+            "thread_id": thread_id,
+            "deleted_at": deleted_at,
+            # Picked up by the table's time to live setting
+            "expires_at": deleted_at + TOMBSTONE_TTL
+        }
+        # The thread only comes back from GitHub once it changed there
+        # since it got deleted (see fetch_github_thread)
+        for name in GITHUB_VALIDATORS:
+            if stored.get(name):
+                tombstone[name] = stored.get(name)
+        return tombstone
+
+    def change_token(self, user_version):
+        # Change tokens are opaque to clients, same as the pagination cursors
+        return encode_pagination_cursor({
+            "user_id": self.userid,
+            "user_version": user_version,
+            "issued_at": get_current_epoch_time()
+        })
+
+    def validators(self, updated_at, user_metadata, *variant):
+        user_version, changed_at = user_metadata
+        last_modified = max(updated_at, changed_at)
+
+        fingerprint = json.dumps([self.userid, updated_at, user_version] + list(variant))  # NOQA
+        headers = {
+            "ETag": '"%s"' % hashlib.sha1(fingerprint).hexdigest(),
+            "Last-Modified": formatdate(last_modified, usegmt=True)
+        }
+        return headers, last_modified
+
+    def not_modified(self, etag, last_modified):
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        if self.if_none_match:
+            etags = [e.strip() for e in self.if_none_match.split(",")]
+            return "*" in etags or etag in etags or "W/" + etag in etags
+        if self.if_modified_since:
+            since = parsedate_tz(self.if_modified_since)
+            return since is not None and last_modified <= mktime_tz(since)
+        return False
+
+    def newest_updated_at(self):
+        results, last_evaluated_key = dynamodb_query(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            Key('user_id').eq(self.userid) & Key('updated_at').gte(self.from_date),  # NOQA
+            index_name=self.notification_user_notification_date_dynamodb_index_name,  # NOQA
+            limit=1,
+            projection=["updated_at"],
+            scan_index_forward=False
+        )
+        return max([int(r.get('updated_at')) for r in results] or [0])
+
+    def determine_from_date(self):
         current_epoch_time = get_current_epoch_time()
-        self.from_date = self.qs_from
-        if not self.from_date:
-            self.from_date = current_epoch_time - DEFAULT_BACKLOG_SEARCH_TIME
+        from_date = self.qs_from
+        if not from_date:
+            from_date = current_epoch_time - DEFAULT_BACKLOG_SEARCH_TIME
+
+        from_date = int(from_date)
+        if from_date <= (current_epoch_time - BACKLOG_TIME_LIMIT):
+            from_date = current_epoch_time - BACKLOG_TIME_LIMIT
+        return from_date
+
+    def determine_page_size(self):
+        if not self.qs_page_size:
+            return DEFAULT_PAGE_SIZE
+        page_size = int(self.qs_page_size)
+        if page_size < 1 or page_size > MAX_PAGE_SIZE:
+            raise ValueError("page size %s out of range" % page_size)
+        return page_size
+
+    def determine_start_key(self):
+        if not self.qs_page_cursor:
+            return None
+        start_key = decode_pagination_cursor(self.qs_page_cursor)
+        if str(start_key.get('user_id')) != str(self.userid):
+            raise ValueError("cursor does not belong to user %s" % self.userid)  # NOQA
+        return start_key
+
+    def next_page_link(self, page_size, last_evaluated_key):
+        if not last_evaluated_key:
+            return None
+        return "/notification/threads?from=%s&page[size]=%s&page[cursor]=%s" % (  # NOQA
+            self.from_date,
+            page_size,
+            encode_pagination_cursor(last_evaluated_key)
+        )
+
+    def find_all_threads(self):
+        try:
+            self.from_date = self.determine_from_date()
+        except ValueError as e:
+            error_msg = "'from' parameter needs to be in epoch seconds, %s is not valid" % self.qs_from  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
 
         try:
-            self.from_date = int(self.from_date)
+            page_size = self.determine_page_size()
         except ValueError as e:
-            error_msg = "'from' parameter needs to be in epoch seconds, %s is not valid" % self.from_date  # NOQA
+            error_msg = "'page[size]' parameter needs to be an integer between 1 and %s" % MAX_PAGE_SIZE  # NOQA
             logger.info("%s: %s" % (error_msg, str(e)))
             return format_response(400, format_error_payload(400, error_msg))
 
-        if self.from_date <= (current_epoch_time - BACKLOG_TIME_LIMIT):
-            self.from_date = current_epoch_time - BACKLOG_TIME_LIMIT
+        try:
+            start_key = self.determine_start_key()
+        except ValueError as e:
+            error_msg = "'page[cursor]' parameter is not valid"
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
 
-        thread_list = []
         try:
-            results = dynamodb_results(
+            user_metadata = self.user_metadata()
+            # Validators go by the window that was asked for. The default
+            # (and the clamped) window slides along with the clock, which
+            # would otherwise give every poll an ETag of its own.
+            headers, last_modified = self.validators(
+                self.newest_updated_at(),
+                user_metadata,
+                self.qs_from,
+                page_size,
+                self.qs_page_cursor
+            )
+            if self.not_modified(headers['ETag'], last_modified):
+                logger.debug("Threads for user %s have not been modified" % self.userid)  # NOQA
+                return format_response(304, {}, headers)
+
+            results, last_evaluated_key = dynamodb_query(
                 self.notification_dynamodb_endpoint_url,
                 self.notification_user_notification_dynamodb_table_name,
                 Key('user_id').eq(self.userid) & Key('updated_at').gte(self.from_date),  # NOQA
-                self.notification_user_notification_date_dynamodb_index_name
+                index_name=self.notification_user_notification_date_dynamodb_index_name,  # NOQA
+                limit=page_size,
+                exclusive_start_key=start_key,
+                projection=self.projection
             )
-            for result in results:
-                res = {
-                    "type": "threads",
-                    "id": int(result.get('thread_id')),
-                    "attributes": {
-                        "thread-url": result.get('thread_url'),
-                        "thread-subscription-url": result.get('thread_subscription_url'),  # NOQA
-                        "reason": result.get('reason'),
-                        "updated-at": int(result.get('updated_at')),
-                        "tags": result.get('tags')
-                    },
-                    "relationships": {
-                        "github-thread": {
-                            "data": {
-                                "id": int(result.get('thread_id')),
-                                "type": "github-thread"
-                            }
-                        }
-                    }
-                }
-                thread_list.append(res)
+            thread_list = [format_thread_resource(r) for r in results]
         except (Boto3Error, BotoCoreError, ClientError) as e:
             error_msg = "Error querying the datastore"
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
+
+        payload = {
+            "data": thread_list,
+            "links": {
+                "next": self.next_page_link(page_size, last_evaluated_key)
+            },
+            "meta": {
+                "change-token": self.change_token(user_metadata[0])
+            }
+        }
+        return format_response(200, payload, headers)
+
+    def determine_index_key(self):
+        # With both filters, threads are looked up by tag and the ones with
+        # another reason are left out
+        if self.qs_filter_tag:
+            return "%s#tag:%s" % (int(self.userid), self.qs_filter_tag)
+        return "%s#reason:%s" % (int(self.userid), self.qs_filter_reason)
+
+    def determine_index_start_key(self, index_key):
+        if not self.qs_page_cursor:
+            return None
+        start_key = decode_pagination_cursor(self.qs_page_cursor)
+        if start_key.get('index_key') != index_key:
+            raise ValueError("cursor does not belong to %s" % index_key)
+        return start_key
+
+    def index_filter_expression(self):
+        conditions = []
+        if self.qs_filter_tag and self.qs_filter_reason:
+            conditions.append(Attr('reason').eq(self.qs_filter_reason))
+        if self.qs_from:
+            conditions.append(Attr('updated_at').gte(self.from_date))
+        if not conditions:
+            return None
+        return reduce(lambda a, b: a & b, conditions)
+
+    def filtered_page_link(self, page_size, last_evaluated_key):
+        if not last_evaluated_key:
+            return None
+        params = [("filter[tag]", self.qs_filter_tag),
+                  ("filter[reason]", self.qs_filter_reason),
+                  ("from", self.qs_from and self.from_date),
+                  ("page[size]", page_size),
+                  ("page[cursor]", encode_pagination_cursor(last_evaluated_key))]  # NOQA
+        return "/notification/threads?%s" % "&".join(
+            "%s=%s" % (name, urllib.quote(str(value), safe=""))
+            for name, value in params if value
+        )
+
+    def find_filtered_threads(self):
+        # Served from the tag index, which only holds the matching threads,
+        # in thread id order. Unlike the other listings, threads of any age
+        # are listed unless 'from' is given.
+        if not self.notification_user_notification_tag_dynamodb_table_name:
+            error_msg = "Filtering threads by tag or reason is not enabled"
+            logger.info(error_msg)
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            self.from_date = self.determine_from_date()
+        except ValueError as e:
+            error_msg = "'from' parameter needs to be in epoch seconds, %s is not valid" % self.qs_from  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            page_size = self.determine_page_size()
+        except ValueError as e:
+            error_msg = "'page[size]' parameter needs to be an integer between 1 and %s" % MAX_PAGE_SIZE  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        index_key = self.determine_index_key()
+        try:
+            start_key = self.determine_index_start_key(index_key)
+        except ValueError as e:
+            error_msg = "'page[cursor]' parameter is not valid"
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            results, last_evaluated_key = dynamodb_query(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_tag_dynamodb_table_name,  # NOQA
+                Key('index_key').eq(index_key),
+                limit=page_size,
+                exclusive_start_key=start_key,
+                projection=self.projection,
+                filter_expression=self.index_filter_expression()
+            )
+            thread_list = [format_thread_resource(r) for r in results]
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying the datastore"
+            return self.datastore_error(error_msg, e)
 
         payload = {
-            "data": thread_list
+            "data": thread_list,
+            "links": {
+                "next": self.filtered_page_link(page_size, last_evaluated_key)
+            }
         }
         return format_response(200, payload)
 
-    def update_thread(self):
-        thread_id = int(self.threadid)
-        patch_payload = self.payload.get('data', {})
+    def determine_since_token(self):
+        token = decode_pagination_cursor(self.qs_since)
+        if str(token.get('user_id')) != str(self.userid):
+            raise ValueError("change token does not belong to user %s" % self.userid)  # NOQA
+        try:
+            return int(token['user_version']), int(token['issued_at'])
+        except (KeyError, TypeError) as e:
+            raise ValueError("incomplete change token: %s" % str(e))
 
-        # The PATCH payload needs to have the 'type' member
-        patch_type = patch_payload.get('type')
-        if patch_type != "threads":
-            error_msg = "Invalid 'type' member, should be 'threads'"
+    def visible_changes(self, results, since_version):
+        # Versions get handed out before the writes carrying them land, so
+        # a version missing from the results may still be on its way. The
+        # changes after it are held back until CHANGE_SETTLE_TIME after they
+        # were made, by when the missing write has landed or never will
+        # (it failed, or a later write of the same thread replaced it).
+        # Returns the changes to hand out and the version they go up to.
+        settled_at = get_current_epoch_time() - CHANGE_SETTLE_TIME
+        changes = []
+        last_version = since_version
+        for r in results:
+            change_version = int(r.get('change_version'))
+            if change_version > last_version + 1 and \
+                    int(r.get('changed_at') or 0) > settled_at:
+                break
+            changes.append(r)
+            last_version = change_version
+        return changes, last_version
+
+    def find_changed_threads(self):
+        if not self.notification_user_notification_change_dynamodb_index_name:  # NOQA
+            error_msg = "Listing changed threads is not enabled"
             logger.info(error_msg)
             return format_response(400, format_error_payload(400, error_msg))
 
-        # The PATCH payload needs to have the 'id' member
         try:
-            m_thread_id = int(patch_payload.get('id'))
-            if m_thread_id != thread_id:
-                raise ValueError
-        except (ValueError, TypeError):
-            error_msg = "Invalid 'id' member, should match patch url"
+            since_version, issued_at = self.determine_since_token()
+        except ValueError as e:
+            error_msg = "'since' parameter is not a valid change token"
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+        if issued_at <= get_current_epoch_time() - TOMBSTONE_TTL:
+            error_msg = "'since' change token has expired, threads need to be listed again"  # NOQA
             logger.info(error_msg)
+            return format_response(410, format_error_payload(410, error_msg))
+
+        try:
+            page_size = self.determine_page_size()
+        except ValueError as e:
+            error_msg = "'page[size]' parameter needs to be an integer between 1 and %s" % MAX_PAGE_SIZE  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
             return format_response(400, format_error_payload(400, error_msg))
 
-        # Gather the attributes that need to be updated
-        updated_at = patch_payload.get('attributes', {}).get('updated-at')
-        reason = patch_payload.get('attributes', {}).get('reason')
-        tags = patch_payload.get('attributes', {}).get('tags', [])
+        try:
+            results, last_evaluated_key = dynamodb_query(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                Key('user_id').eq(self.userid) & Key('change_version').gt(since_version),  # NOQA
+                index_name=self.notification_user_notification_change_dynamodb_index_name,  # NOQA
+                limit=page_size,
+                projection=self.projection
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying the datastore"
+            return self.datastore_error(error_msg, e)
 
+        # The index is ordered by version, so the new token picks up right
+        # after the last change returned
+        changes, user_version = self.visible_changes(results, since_version)
+        change_token = self.change_token(user_version)
+        next_link = None
+        if last_evaluated_key and len(changes) == len(results):
+            next_link = "/notification/threads?since=%s&page[size]=%s" % (change_token, page_size)  # NOQA
+        payload = {
+            "data": [format_thread_resource(r) for r in changes if not is_tombstone(r)],  # NOQA
+            "links": {
+                "next": next_link
+            },
+            "meta": {
+                "deleted": [int(r.get('thread_id')) for r in changes if is_tombstone(r)],  # NOQA
+                "change-token": change_token
+            }
+        }
+        return format_response(200, payload)
+
+    def determine_export_segments(self):
+        if not self.qs_segments:
+            return None
+        segments = int(self.qs_segments)
+        if segments < 1 or segments > MAX_EXPORT_SEGMENTS:
+            raise ValueError("segment count %s out of range" % segments)
+        return segments
+
+    def export_results(self, segments):
+        # The user's partition is read page by page. Segmented scans go
+        # through the whole table instead, which only pays off for large
+        # tables with many users.
+        if segments is None:
+            return dynamodb_results(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                Key('user_id').eq(self.userid) & Key('thread_id').gt(USER_METADATA_THREAD_ID),  # NOQA
+                projection=self.projection
+            )
+        return dynamodb_parallel_scan_results(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            segments,
+            filter_expression=Attr('user_id').eq(self.userid) & Attr('thread_id').gt(USER_METADATA_THREAD_ID),  # NOQA
+            projection=self.projection
+        )
+
+    def export_threads(self):
+        if self.qs_segments and MAX_EXPORT_SEGMENTS < 1:
+            error_msg = "Segmented exports are not enabled"
+            logger.info(error_msg)
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            segments = self.determine_export_segments()
+        except ValueError as e:
+            error_msg = "'segments' parameter needs to be an integer between 1 and %s" % MAX_EXPORT_SEGMENTS  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        # Lambda responses can't be streamed, so the whole export gets read
+        # in one go there. Otherwise the first thread is read up front, so
+        # a datastore that can't be reached still gets an error response.
+        results = self.export_results(segments)
+        try:
+            if not self.stream_response:
+                results = iter(list(results))
+            first_results = list(itertools.islice(results, 1))
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying the datastore"
+            return self.datastore_error(error_msg, e)
+
+        lines = (
+            json.dumps(format_thread_resource(r)) + "\n"
+            for r in itertools.chain(first_results, results)
+            if not is_tombstone(r)
+        )
+        headers = {"Content-Type": "application/x-ndjson"}
+        if not self.stream_response:
+            return format_response(200, "".join(lines), headers)
+        return format_stream_response(lines, headers)
+
+    def validate_thread_resource(self, resource, thread_id=None):
+        # The PATCH payload needs to have the 'type' member
+        if resource.get('type') != "threads":
+            return "Invalid 'type' member, should be 'threads'"
+
+        # The PATCH payload needs to have the 'id' member (matching the patch
+        # url, if there is one)
+        try:
+            m_thread_id = int(resource.get('id'))
+            if m_thread_id <= USER_METADATA_THREAD_ID:
+                raise ValueError
+            if thread_id is not None and m_thread_id != thread_id:
+                raise ValueError
+        except (ValueError, TypeError):
+            if thread_id is None:
+                return "Invalid 'id' member, should be a thread id"
+            return "Invalid 'id' member, should match patch url"
+        return None
+
+    def thread_resource_attributes(self, resource):
         # The understanding here is that any attribute that isn't explicitly
         # specified is essentially blanked out (with a falsey value)
+        attributes = resource.get('attributes', {})
+        return {
+            "updated_at": attributes.get('updated-at'),
+            "reason": attributes.get('reason'),
+            "tags": attributes.get('tags', [])
+        }
+
+    def update_thread(self):
+        thread_id = int(self.threadid)
+        patch_payload = self.payload.get('data', {})
+
+        error_msg = self.validate_thread_resource(patch_payload, thread_id)
+        if error_msg:
+            logger.info(error_msg)
+            return format_response(400, format_error_payload(400, error_msg))
+
+        attributes = self.thread_resource_attributes(patch_payload)
         key = {
             "user_id": self.userid,
             "thread_id": thread_id
         }
         values = {
-            ":u": updated_at,
-            ":r": reason,
-            ":t": tags
+            ":u": attributes.get('updated_at'),
+            ":r": attributes.get('reason'),
+            ":t": attributes.get('tags')
         }
-        update_expression = "set updated_at=:u, reason=:r, tags=:t"  # NOQA
+        # Patching a deleted thread brings it back
+        update_expression = "set updated_at=:u, reason=:r, tags=:t, change_version=:c, changed_at=:ca remove deleted_at, expires_at"  # NOQA
         try:
-            dynamodb_update_item(
+            change = {}
+            self.stamp_changes([change])
+            values.update({
+                ":c": change['change_version'],
+                ":ca": change['changed_at']
+            })
+            result = dynamodb_update_item(
                 endpoint_url=self.notification_dynamodb_endpoint_url,
                 table_name=self.notification_user_notification_dynamodb_table_name,  # NOQA
                 key=key,
                 update_expression=update_expression,
-                expr_attribute_values=values
+                expr_attribute_values=values,
+                return_values="ALL_OLD"
             )
         except (Boto3Error, BotoCoreError, ClientError) as e:
             error_msg = "Error updating thread %s in the datastore" % thread_id
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
+
+        if self.notification_user_notification_tag_dynamodb_table_name:
+            stored = result.get('Attributes', {})
+            item = dict((k, v) for k, v in stored.items()
+                        if k not in ["deleted_at", "expires_at"])
+            item.update(key)
+            item.update(attributes)
+            item.update(change)
+            # Nothing to clean up after for threads that weren't stored yet
+            self.update_thread_index([stored] if stored else [], [item])
 
         payload = {
             "meta": {
@@ -292,30 +1264,33 @@ class NotificationThreads(object):
 
     def delete_thread(self):
         thread_id = int(self.threadid)
-        key = {
-            "user_id": self.userid,
-            "thread_id": thread_id
-        }
         try:
-            dynamodb_delete_item(
-                endpoint_url=self.notification_dynamodb_endpoint_url,
-                table_name=self.notification_user_notification_dynamodb_table_name,  # NOQA
-                key=key,
-                condition_expression=Attr("user_id").eq(self.userid) & Attr("thread_id").eq(thread_id)  # NOQA
+            # Threads that are gone are turned away before a change version
+            # gets handed out, a version that never lands holds delta syncs
+            # back (see visible_changes)
+            existing = self.existing_thread(thread_id)
+            if not existing:
+                return self.thread_missing_response(thread_id)
+            # The thread gets replaced by its tombstone, which has to tell
+            # delta syncs about the delete
+            tombstone = self.tombstone(self.userid, thread_id, existing)
+            self.stamp_changes([tombstone])
+            stored = dynamodb_new_item(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                tombstone,
+                condition_expression=Attr("user_id").eq(self.userid) & Attr("thread_id").eq(thread_id) & Attr("deleted_at").not_exists(),  # NOQA
+                return_values="ALL_OLD"
             )
         except ClientError as e:
             if e.response['Error']['Code'] == "ConditionalCheckFailedException":  # NOQA
-                error_msg = "Thread %s does not exist" % thread_id
-                logger.info(error_msg)
-                return format_response(409,
-                                       format_error_payload(409, error_msg))
+                return self.thread_missing_response(thread_id)
             error_msg = "Error deleting thread %s from the datastore" % thread_id  # NOQA
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
         except (Boto3Error, BotoCoreError) as e:
             error_msg = "Error deleting thread %s from the datastore" % thread_id  # NOQA
-            logger.error("%s: %s" % (error_msg, str(e)))
-            return format_response(500, format_error_payload(500, error_msg))
+            return self.datastore_error(error_msg, e)
+        self.update_thread_index([stored], [tombstone])
 
         payload = {
             "meta": {
@@ -323,3 +1298,342 @@ class NotificationThreads(object):
             }
         }
         return format_response(200, payload)
+
+    def existing_thread(self, thread_id):
+        # Returns what the tombstone of the thread carries over, or None if
+        # there is no thread to delete
+        item = dynamodb_get_item(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            {"user_id": self.userid, "thread_id": thread_id},
+            projection=["thread_id", "deleted_at"] + GITHUB_VALIDATORS
+        )
+        if not item or is_tombstone(item):
+            return None
+        return item
+
+    def thread_missing_response(self, thread_id):
+        error_msg = "Thread %s does not exist" % thread_id
+        logger.info(error_msg)
+        return format_response(409, format_error_payload(409, error_msg))
+
+    def bulk_thread_resources(self):
+        resources = (self.payload or {}).get('data')
+        if not isinstance(resources, list) or len(resources) > MAX_BULK_THREADS:  # NOQA
+            raise ValueError("expected a list of at most %s resources" % MAX_BULK_THREADS)  # NOQA
+
+        valid_resources = {}
+        statuses = []
+        for resource in resources:
+            if not isinstance(resource, dict):
+                resource = {}
+            status = {"id": resource.get('id'), "status": 200}
+            error_msg = self.validate_thread_resource(resource)
+            if not error_msg and int(resource.get('id')) in valid_resources:
+                error_msg = "Duplicate thread id %s" % resource.get('id')
+            if error_msg:
+                status.update({"status": 400, "detail": error_msg})
+            else:
+                status['id'] = int(resource.get('id'))
+                valid_resources[status['id']] = resource
+            statuses.append(status)
+        return valid_resources, statuses
+
+    def bulk_existing_threads(self, thread_ids):
+        keys = [{"user_id": self.userid, "thread_id": t} for t in thread_ids]
+        results, unprocessed_keys = dynamodb_batch_get(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            keys,
+            projection=self.projection
+        )
+        existing = dict((int(r.get('thread_id')), r)
+                        for r in results if not is_tombstone(r))
+        failed_ids = set(int(k.get('thread_id')) for k in unprocessed_keys)
+        return existing, failed_ids
+
+    def bulk_write_threads(self, put_items):
+        # Deletes are written as tombstones, so these are all puts
+        unprocessed_requests = dynamodb_batch_write(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            put_items=put_items
+        )
+        failed_ids = set()
+        for write_request in unprocessed_requests:
+            item = write_request.get('PutRequest', {}).get('Item')
+            failed_ids.add(int(item.get('thread_id')))
+        return failed_ids
+
+    def bulk_response(self, statuses, failed_ids, action):
+        succeeded = 0
+        for status in statuses:
+            if status['id'] in failed_ids and status['status'] == 200:
+                status.update({
+                    "status": 500,
+                    "detail": "Error writing thread %s to the datastore" % status['id']  # NOQA
+                })
+            if status['status'] == 200:
+                succeeded += 1
+        payload = {
+            "meta": {
+                "message": "%s of %s threads %s successfully" % (succeeded, len(statuses), action),  # NOQA
+                "results": statuses
+            }
+        }
+        return format_response(200, payload)
+
+    def update_threads(self):
+        try:
+            resources, statuses = self.bulk_thread_resources()
+        except ValueError as e:
+            error_msg = "'data' member needs to be an array of at most %s thread resources" % MAX_BULK_THREADS  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            existing, failed_ids = self.bulk_existing_threads(resources.keys())
+            put_items = []
+            for thread_id, resource in resources.items():
+                if thread_id in failed_ids:
+                    continue
+                # BatchWriteItem can only put whole items, so the patched
+                # attributes get merged into whatever is already stored
+                item = dict(existing.get(thread_id, {
+                    "user_id": self.userid,
+                    "thread_id": thread_id
+                }))
+                item.update(self.thread_resource_attributes(resource))
+                put_items.append(item)
+            if put_items:
+                self.stamp_changes(put_items)
+            failed_ids.update(self.bulk_write_threads(put_items))
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error updating threads in the datastore"
+            return self.datastore_error(error_msg, e)
+        self.update_thread_index(
+            [i for t, i in existing.items() if t not in failed_ids],
+            [i for i in put_items if i['thread_id'] not in failed_ids]
+        )
+
+        return self.bulk_response(statuses, failed_ids, "updated")
+
+    def delete_threads(self):
+        try:
+            resources, statuses = self.bulk_thread_resources()
+        except ValueError as e:
+            error_msg = "'data' member needs to be an array of at most %s thread resources" % MAX_BULK_THREADS  # NOQA
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+
+        try:
+            existing, failed_ids = self.bulk_existing_threads(resources.keys())
+            tombstones = [self.tombstone(r.get('user_id'), r.get('thread_id'), r)  # NOQA
+                          for r in existing.values()]
+            if tombstones:
+                self.stamp_changes(tombstones)
+            failed_ids.update(self.bulk_write_threads(tombstones))
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error deleting threads from the datastore"
+            return self.datastore_error(error_msg, e)
+        self.update_thread_index(
+            [i for t, i in existing.items() if t not in failed_ids],
+            [i for i in tombstones if i['thread_id'] not in failed_ids]
+        )
+
+        for status in statuses:
+            missing = status['id'] not in existing and status['id'] not in failed_ids  # NOQA
+            if status['status'] == 200 and missing:
+                status.update({
+                    "status": 409,
+                    "detail": "Thread %s does not exist" % status['id']
+                })
+        return self.bulk_response(statuses, failed_ids, "deleted")
+
+    def determine_sync_window(self, started_at):
+        # Returns the 'since' and 'before' (None for up to now) to fetch the
+        # notifications in, and when the sync they are part of started.
+        # Syncs pick up where the last complete sync left off, or where the
+        # one still going ran out of pages, unless told otherwise.
+        since = (self.payload or {}).get('meta', {}).get('since')
+        if since is not None:
+            return int(since), None, started_at
+        item = dynamodb_get_item(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            self.user_metadata_key(),
+            projection=["github_synced_at",
+                        "github_sync_since",
+                        "github_sync_before",
+                        "github_sync_started_at"]
+        ) or {}
+        if item.get('github_sync_before'):
+            return (int(item.get('github_sync_since')),
+                    int(item.get('github_sync_before')),
+                    int(item.get('github_sync_started_at')))
+        if item.get('github_synced_at'):
+            return int(item.get('github_synced_at')), None, started_at
+        return get_current_epoch_time() - DEFAULT_BACKLOG_SEARCH_TIME, None, started_at  # NOQA
+
+    def fetch_github_notifications_page(self, since, before, page):
+        # Returns the page of notifications and whether there are more
+        # pages, or None if the page could not be fetched
+        params = {
+            "all": "true",
+            "since": get_github_timestamp(since),
+            "per_page": GITHUB_SYNC_PAGE_SIZE,
+            "page": page
+        }
+        if before is not None:
+            params['before'] = get_github_timestamp(before)
+        try:
+            r = github_get('/notifications',
+                           self.token.get('github_token'),
+                           params=params)
+        except GitHubRateLimited as e:
+            logger.info("Not syncing page %s of the notifications: %s" % (page, str(e)))  # NOQA
+            self.github_retry_after = e.retry_after
+            return None
+        except RequestException as e:
+            logger.error("Error contacting GitHub for page %s of the notifications: %s" % (page, str(e)))  # NOQA
+            return None
+        if r.status_code != 200:
+            logger.info("HTTP response code from GitHub for page %s of the notifications: %s" % (page, r.status_code))  # NOQA
+            return None
+        try:
+            notifications = r.json()
+        except ValueError as e:
+            logger.error("Could not parse JSON from response %s. Error: %s" % (r.text, str(e)))  # NOQA
+            return None
+        return notifications, 'next' in r.links
+
+    def fetch_github_notifications(self, since, before):
+        # A thread updated while paging can show up twice, the later copy
+        # is the more recent one
+        results = OrderedDict()
+        for page in range(1, GITHUB_SYNC_MAX_PAGES + 1):
+            fetched = self.fetch_github_notifications_page(since, before, page)  # NOQA
+            if fetched is None:
+                return results.values(), False
+            notifications, more_pages = fetched
+            for notification in notifications:
+                result = parse_github_thread(notification.get('id'),
+                                             notification)
+                results.pop(result['thread_id'], None)
+                results[result['thread_id']] = result
+            if not more_pages:
+                return results.values(), True
+        logger.info("Stopped syncing notifications after %s pages" % GITHUB_SYNC_MAX_PAGES)  # NOQA
+        return results.values(), False
+
+    def merge_synced_threads(self, results):
+        keys = [{"user_id": self.userid, "thread_id": r['thread_id']}
+                for r in results]
+        stored_items, unprocessed_keys = dynamodb_batch_get(
+            self.notification_dynamodb_endpoint_url,
+            self.notification_user_notification_dynamodb_table_name,
+            keys,
+            projection=self.projection
+        )
+        stored = dict((int(i.get('thread_id')), i) for i in stored_items)
+        failed_ids = set(int(k.get('thread_id')) for k in unprocessed_keys)
+
+        put_items = []
+        for result in results:
+            if result['thread_id'] in failed_ids:
+                continue
+            item = stored.get(result['thread_id'], {})
+            if is_tombstone(item) and item['deleted_at'] >= result['updated_at']:  # NOQA
+                # Deleted by the user, with nothing new on GitHub since
+                continue
+            if item and all(item.get(k) == v for k, v in result.items()):
+                # Nothing new, the thread keeps its change version
+                continue
+            if is_tombstone(item) or not item.get('tags'):
+                result['tags'] = determine_list_of_tags(result)
+            # Tags of stored threads may have been edited, they are kept.
+            # The listing carries no validators, the stored ones are for an
+            # older copy of the thread.
+            item = dict((k, v) for k, v in item.items()
+                        if k not in ["deleted_at", "expires_at"] + GITHUB_VALIDATORS)  # NOQA
+            item.update(result)
+            item['user_id'] = int(self.userid)
+            put_items.append(item)
+        return put_items, stored, failed_ids
+
+    def sync_threads(self):
+        try:
+            since, before, started_at = self.determine_sync_window(get_current_epoch_time())  # NOQA
+        except (TypeError, ValueError) as e:
+            error_msg = "'meta.since' member needs to be in epoch seconds"
+            logger.info("%s: %s" % (error_msg, str(e)))
+            return format_response(400, format_error_payload(400, error_msg))
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error querying the datastore"
+            return self.datastore_error(error_msg, e)
+
+        results, complete = self.fetch_github_notifications(since, before)
+        if not results and not complete:
+            if self.github_retry_after:
+                return self.github_rate_limited_response()
+            error_msg = "Error fetching notifications from GitHub"
+            return format_response(502, format_error_payload(502, error_msg))
+
+        try:
+            put_items, stored, failed_ids = self.merge_synced_threads(results)  # NOQA
+            stamp_change_versions(
+                self.notification_dynamodb_endpoint_url,
+                self.notification_user_notification_dynamodb_table_name,
+                put_items
+            )
+            failed_ids.update(self.bulk_write_threads(put_items))
+            complete = complete and not failed_ids
+            if complete:
+                self.record_github_sync(started_at)
+            elif results and not failed_ids:
+                # GitHub lists the most recently updated notifications
+                # first, the next sync carries on with the ones before
+                self.record_github_sync_progress(
+                    since,
+                    min(r['updated_at'] for r in results) + 1,
+                    started_at
+                )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            error_msg = "Error writing synced threads to the datastore"
+            return self.datastore_error(error_msg, e)
+
+        synced = [i for i in put_items if i['thread_id'] not in failed_ids]
+        self.update_thread_index(
+            [stored[i['thread_id']] for i in synced if i['thread_id'] in stored],  # NOQA
+            synced
+        )
+        payload = {
+            "data": [format_thread_resource(i) for i in synced],
+            "meta": {
+                "since": since,
+                "complete": complete,
+                "failed": sorted(failed_ids),
+                "poll-interval": github_poll_interval(self.token.get('github_token'))  # NOQA
+            }
+        }
+        return format_response(200, payload)
+
+    def record_github_sync(self, synced_at):
+        dynamodb_update_item(
+            endpoint_url=self.notification_dynamodb_endpoint_url,
+            table_name=self.notification_user_notification_dynamodb_table_name,  # NOQA
+            key=self.user_metadata_key(),
+            update_expression="set github_synced_at=:s remove github_sync_since, github_sync_before, github_sync_started_at",  # NOQA
+            expr_attribute_values={":s": synced_at}
+        )
+
+    def record_github_sync_progress(self, since, before, started_at):
+        # Notifications updated after the sync started get picked up by the
+        # sync after it
+        dynamodb_update_item(
+            endpoint_url=self.notification_dynamodb_endpoint_url,
+            table_name=self.notification_user_notification_dynamodb_table_name,  # NOQA
+            key=self.user_metadata_key(),
+            update_expression="set github_sync_since=:s, github_sync_before=:b, github_sync_started_at=:t",  # NOQA
+            expr_attribute_values={":s": since, ":b": before, ":t": started_at}  # NOQA
+        )
@@ -0,0 +1,221 @@
+from __future__ import absolute_import
+import logging
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+from botocore.retryhandler import EXCEPTION_MAP
+from notification_backend.invocation import current_invocation
+from notification_backend.tracing import traced
+
+
+logger = logging.getLogger("notification_backend")
+THROTTLING_ERROR_CODES = [
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded"
+]
+# Failures that don't say anything about the request itself, DynamoDB or
+# the connection to it just had a hiccup
+TRANSIENT_ERROR_CODES = [
+    "InternalServerError",
+    "InternalFailure",
+    "ServiceUnavailable"
+]
+CONNECTION_ERRORS = tuple(EXCEPTION_MAP['GENERAL_CONNECTION_ERROR'])
+
+
+def is_throttling_error(e):
+    if not isinstance(e, ClientError):
+        return False
+    return e.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(e):
+    if isinstance(e, CONNECTION_ERRORS):
+        return True
+    if not isinstance(e, ClientError):
+        return False
+    if e.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES:
+        return True
+    return e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500  # NOQA
+
+
+class AdaptiveRateLimiter(object):
+
+    # Unlimited until the first throttle. Every throttle then cuts the
+    # allowed request rate by 'beta' (down to 'min_rate'), and every success
+    # grows it back by 'growth' until it is back at the rate that got
+    # throttled, at which point the limit is lifted again.
+    def __init__(self, min_rate, beta=0.7, growth=1.05):
+        self.min_rate = min_rate
+        self.beta = beta
+        self.growth = growth
+        self.rate = None
+        self.throttled_rate = None
+        self.measured_rate = 0.0
+        self._last_request_at = None
+        self._next_request_at = 0.0
+        self._lock = threading.Lock()
+
+    def measure(self, now):
+        # Exponentially weighted average of the rate requests are sent at
+        if self._last_request_at is not None and now > self._last_request_at:
+            rate = 1.0 / (now - self._last_request_at)
+            self.measured_rate = 0.8 * self.measured_rate + 0.2 * rate
+        self._last_request_at = now
+
+    def acquire(self):
+        # Returns how long the request needs to be held back for (in
+        # seconds) and books its slot
+        now = time.time()
+        with self._lock:
+            self.measure(now)
+            if self.rate is None:
+                return 0
+            request_at = max(now, self._next_request_at)
+            self._next_request_at = request_at + 1.0 / self.rate
+            return request_at - now
+
+    def throttled(self):
+        with self._lock:
+            if self.rate is None:
+                self.throttled_rate = max(self.min_rate, self.measured_rate)
+                self.rate = self.throttled_rate
+            self.rate = max(self.min_rate, self.rate * self.beta)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            self.rate *= self.growth
+            if self.rate >= self.throttled_rate:
+                self.rate = None
+                self.throttled_rate = None
+
+
+class RetryPolicy(object):
+
+    # Throttled requests (and those that failed for transient reasons) are
+    # retried with exponential backoff and full jitter, for as long as the
+    # attempts and the time left in the current invocation allow. Only
+    # throttles slow the table down.
+    def __init__(self, max_attempts, backoff, max_backoff, min_rate,
+                 time_reserve):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_rate = min_rate
+        self.time_reserve = time_reserve
+        self.counters = dict.fromkeys([
+            "requests",
+            "throttles",
+            "errors",
+            "retries",
+            "exhausted",
+            "paced"
+        ], 0)
+        self.paced_seconds = 0.0
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def limiter(self, key):
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = AdaptiveRateLimiter(self.min_rate)
+                self._limiters[key] = limiter
+            return limiter
+
+    def set_deadline(self, remaining_seconds):
+        # Of the invocation the current thread works on (work it hands to
+        # other threads with bind_invocation shares it). None lifts the
+        # deadline, retries are then bound by attempts only.
+        if remaining_seconds is None:
+            current_invocation().deadline = None
+            return
+        current_invocation().deadline = time.time() + remaining_seconds
+
+    def time_left(self):
+        deadline = current_invocation().deadline
+        if deadline is None:
+            return None
+        return deadline - self.time_reserve - time.time()
+
+    def backoff_delay(self, attempt):
+        return random.uniform(
+            0,
+            min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        )
+
+    def pace(self, limiter):
+        delay = limiter.acquire()
+        if delay <= 0:
+            return
+        time_left = self.time_left()
+        if time_left is not None:
+            delay = max(0, min(delay, time_left))
+        self.count("paced")
+        with self._lock:
+            self.paced_seconds += delay
+        self.sleep(delay)
+
+    def wait_to_retry(self, key, attempt, max_attempts, throttled=True):
+        # Returns False once the attempts or the time budget are used up
+        if throttled:
+            self.limiter(key).throttled()
+            self.count("throttles")
+        else:
+            self.count("errors")
+        delay = self.backoff_delay(attempt)
+        time_left = self.time_left()
+        if attempt >= max_attempts or (time_left is not None and delay >= time_left):  # NOQA
+            self.count("exhausted")
+            return False
+        logger.info("Request to %s %s, retrying in %.3f seconds" % (key[1], "throttled" if throttled else "failed", delay))  # NOQA
+        self.count("retries")
+        self.sleep(delay)
+        return True
+
+    @traced("retry_sleep")
+    def sleep(self, delay):
+        time.sleep(delay)
+
+    def call(self, key, operation, **kwargs):
+        limiter = self.limiter(key)
+        attempt = 1
+        while True:
+            self.pace(limiter)
+            self.count("requests")
+            try:
+                result = operation(**kwargs)
+            except (ClientError,) + CONNECTION_ERRORS as e:
+                throttled = is_throttling_error(e)
+                if not (throttled or is_transient_error(e)) or \
+                        not self.wait_to_retry(key, attempt,
+                                               self.max_attempts, throttled):
+                    raise
+                attempt += 1
+                continue
+            limiter.succeeded()
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._limiters.clear()
+            for name in self.counters:
+                self.counters[name] = 0
+            self.paced_seconds = 0.0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['paced_seconds'] = self.paced_seconds
+            stats['rate_limited_tables'] = len(
+                [l for l in self._limiters.values() if l.rate is not None]
+            )
+        return stats
@@ -0,0 +1,618 @@
+from __future__ import absolute_import
+import bisect
+import copy
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import zlib
+from decimal import Decimal
+from boto3.dynamodb.conditions import AttributeBase
+from botocore.exceptions import ClientError
+
+
+UPDATE_ACTION = re.compile(r"\b(set|remove|add|delete)\s", re.IGNORECASE)
+COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b
+}
+# Key conditions on the sort key, as the (lower, upper) bounds they set.
+# Bounds are (value, inclusive).
+SORT_KEY_BOUNDS = {
+    "=": lambda v: ((v[0], True), (v[0], True)),
+    "<": lambda v: (None, (v[0], False)),
+    "<=": lambda v: (None, (v[0], True)),
+    ">": lambda v: ((v[0], False), None),
+    ">=": lambda v: ((v[0], True), None),
+    "BETWEEN": lambda v: ((v[0], True), (v[1], True)),
+    "begins_with": lambda v: ((v[0], True), (v[0] + u"\uffff", True))
+}
+
+
+def storage_error(code, message, operation_name):
+    # Same errors boto3 raises, so callers handle them the same way
+    return ClientError({"Error": {"Code": code, "Message": message}},
+                       operation_name)
+
+
+def to_storage_value(value):
+    # Numbers are stored (and come back) as Decimals, like boto3 does
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")  # NOQA
+    if isinstance(value, (int, long)):
+        return Decimal(value)
+    if isinstance(value, dict):
+        return dict((k, to_storage_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_storage_value(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return set(to_storage_value(v) for v in value)
+    return value
+
+
+def to_key_value(value, attribute_type):
+    # Key attributes are coerced to the type the table declares for them,
+    # so "333333" and 333333 find the same user
+    if attribute_type == "N" and not isinstance(value, Decimal):
+        return Decimal(str(value))
+    if attribute_type == "S" and not isinstance(value, basestring):
+        return unicode(value)
+    return value
+
+
+def project(item, projection=None):
+    if not projection:
+        return copy.deepcopy(item)
+    return copy.deepcopy(dict((k, item[k]) for k in projection if k in item))
+
+
+def condition_operands(values, item, key_types):
+    # Attributes are looked up in the item, values compared to a key
+    # attribute are coerced to the key's type
+    attribute_type = None
+    if isinstance(values[0], AttributeBase):
+        attribute_type = key_types.get(values[0].name)
+    operands = []
+    for value in values:
+        if hasattr(value, 'get_expression'):
+            # size(), the only function that can be an operand
+            operand = condition_operands(value.get_expression()['values'], item, key_types)[0]  # NOQA
+            operands.append(None if operand is None else len(operand))
+        elif isinstance(value, AttributeBase):
+            operands.append(item.get(value.name))
+        elif attribute_type and not isinstance(value, (list, tuple, set)):
+            operands.append(to_key_value(value, attribute_type))
+        else:
+            operands.append(to_storage_value(value))
+    return operands
+
+
+def evaluate_function(operator, operands):
+    if operator == "BETWEEN":
+        return operands[1] <= operands[0] <= operands[2]
+    if operator == "IN":
+        return operands[0] in operands[1]
+    if operator == "begins_with":
+        return operands[0].startswith(operands[1])
+    if operator == "contains":
+        return operands[1] in operands[0]
+    raise storage_error("ValidationException",
+                        "Condition %s is not supported" % operator,
+                        "Condition")
+
+
+def evaluate_condition(condition, item, key_types=None):
+    key_types = key_types or {}
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+    if operator in ["AND", "OR", "NOT"]:
+        results = [evaluate_condition(v, item, key_types) for v in values]
+        return {"AND": all, "OR": any, "NOT": lambda r: not r[0]}[operator](results)  # NOQA
+    if operator in ["attribute_exists", "attribute_not_exists"]:
+        return (values[0].name in item) == (operator == "attribute_exists")
+    operands = condition_operands(values, item, key_types)
+    if operands[0] is None:
+        # Conditions on missing attributes never hold
+        return operator == "<>"
+    if operator in COMPARISONS:
+        return COMPARISONS[operator](operands[0], operands[1])
+    return evaluate_function(operator, operands)
+
+
+def condition_terms(condition):
+    expression = condition.get_expression()
+    if expression['operator'] != "AND":
+        return [expression]
+    terms = []
+    for value in expression['values']:
+        terms.extend(condition_terms(value))
+    return terms
+
+
+def apply_update(item, update_expression, values):
+    # Supports the update expressions NotificationThreads makes: 'set' and
+    # 'add' from placeholders, and 'remove'. Returns the names of the
+    # attributes that got set or added.
+    updated = []
+    clauses = UPDATE_ACTION.split(update_expression)
+    for action, body in zip(clauses[1::2], clauses[2::2]):
+        action = action.lower()
+        for term in [t.strip() for t in body.split(",") if t.strip()]:
+            if action == "set":
+                name, placeholder = [p.strip() for p in term.split("=", 1)]
+                item[name] = to_storage_value(values[placeholder])
+            elif action == "add":
+                name, placeholder = term.split()
+                item[name] = item.get(name, 0) + to_storage_value(values[placeholder])  # NOQA
+            elif action == "remove":
+                item.pop(term, None)
+                continue
+            else:
+                raise storage_error("ValidationException",
+                                    "Update action %s is not supported" % action,  # NOQA
+                                    "UpdateItem")
+            updated.append(name)
+    return updated
+
+
+def update_return_values(return_values, old_item, new_item, updated):
+    if return_values == "ALL_OLD":
+        return old_item or {}
+    if return_values == "ALL_NEW":
+        return new_item
+    if return_values == "UPDATED_OLD":
+        return dict((k, old_item[k]) for k in updated if k in (old_item or {}))  # NOQA
+    if return_values == "UPDATED_NEW":
+        return dict((k, new_item[k]) for k in updated if k in new_item)
+    return {}
+
+
+def bisect_bounds(entries, lower, upper):
+    # Entries are sorted (sort key, range key) tuples, a 1-tuple sorts
+    # before every entry with the same sort key
+    start, stop = 0, len(entries)
+    if lower is not None:
+        value, inclusive = lower
+        start = bisect.bisect_left(entries, (value,))
+        while not inclusive and start < stop and entries[start][0] == value:  # NOQA
+            start += 1
+    if upper is not None:
+        value, inclusive = upper
+        stop = bisect.bisect_left(entries, (value,))
+        while inclusive and stop < len(entries) and entries[stop][0] == value:  # NOQA
+            stop += 1
+    return start, stop
+
+
+def scan_segment_of(hash_value, total_segments):
+    return (zlib.crc32(str(hash_value)) & 0xffffffff) % total_segments
+
+
+class TableSchema(object):
+
+    def __init__(self, key_schema, indexes=None):
+        # key_schema is [(hash key, type), (range key, type)], indexes map
+        # the names of local secondary indexes to their (range key, type)
+        self.hash_key, self.range_key = [name for name, _ in key_schema]
+        self.indexes = dict((n, k) for n, (k, _) in (indexes or {}).items())
+        self.key_types = dict(key_schema)
+        self.key_types.update(dict((indexes or {}).values()))
+        self.sort_keys = [self.range_key] + sorted(
+            set(self.indexes.values()) - set([self.range_key])
+        )
+
+    def sort_key(self, index_name=None):
+        if index_name is None:
+            return self.range_key
+        if index_name not in self.indexes:
+            raise storage_error("ValidationException",
+                                "The table does not have the specified index: %s" % index_name,  # NOQA
+                                "Query")
+        return self.indexes[index_name]
+
+    def key(self, item, operation_name):
+        try:
+            return tuple(to_key_value(item[k], self.key_types[k])
+                         for k in [self.hash_key, self.range_key])
+        except KeyError as e:
+            raise storage_error("ValidationException",
+                                "Missing the key %s in the item" % str(e),
+                                operation_name)
+
+    def normalize(self, item):
+        item = to_storage_value(item)
+        for name, attribute_type in self.key_types.items():
+            if item.get(name) is not None:
+                item[name] = to_key_value(item[name], attribute_type)
+        return item
+
+    def evaluated_key(self, item, sort_key):
+        return dict((k, item[k])
+                    for k in set([self.hash_key, self.range_key, sort_key]))
+
+
+class Storage(object):
+
+    # The datastore operations NotificationThreads is built on, named after
+    # (and behaving like) their DynamoDB counterparts: keys and conditions
+    # are boto3 conditions, numbers come back as Decimals and failing
+    # conditions raise a ClientError
+
+    def create_table(self, table_name, key_schema, indexes=None):
+        raise NotImplementedError
+
+    def query(self, table_name, key, index_name=None, limit=None,
+              exclusive_start_key=None, projection=None,
+              scan_index_forward=True, filter_expression=None):
+        raise NotImplementedError
+
+    def scan(self, table_name, filter_expression=None, segment=None,
+             total_segments=None, exclusive_start_key=None, projection=None):
+        raise NotImplementedError
+
+    def get_item(self, table_name, key, projection=None):
+        raise NotImplementedError
+
+    def put_item(self, table_name, item, condition_expression=None,
+                 return_values=None):
+        raise NotImplementedError
+
+    def delete_item(self, table_name, key, condition_expression=None):
+        raise NotImplementedError
+
+    def update_item(self, table_name, key, update_expression,
+                    expr_attribute_values, condition_expression=None,
+                    return_values="UPDATED_NEW"):
+        raise NotImplementedError
+
+    def batch_get(self, table_name, keys, projection=None,
+                  max_attempts=None, consistent_read=False):
+        raise NotImplementedError
+
+    def batch_write(self, table_name, put_items=None, delete_keys=None,
+                    max_attempts=None):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+
+    # Storage within this process, for tests, benchmarks and local
+    # development. Subclasses only store, look up and order items. Tables
+    # need to be created first, with the same schema as on DynamoDB. Tables
+    # are never throttled, so batches are always processed in full.
+
+    def __init__(self):
+        self._schemas = {}
+        self._lock = threading.RLock()
+
+    def schema(self, table_name, operation_name):
+        schema = self._schemas.get(table_name)
+        if schema is None:
+            raise storage_error("ResourceNotFoundException",
+                                "Requested resource not found: Table: %s not found" % table_name,  # NOQA
+                                operation_name)
+        return schema
+
+    def create_table(self, table_name, key_schema, indexes=None):
+        # Tables that already exist are left as they are
+        with self._lock:
+            if table_name not in self._schemas:
+                schema = TableSchema(key_schema, indexes)
+                self._create(table_name, schema)
+                self._schemas[table_name] = schema
+
+    def check_condition(self, schema, condition_expression, item,
+                        operation_name):
+        if condition_expression is None:
+            return
+        if not evaluate_condition(condition_expression, item or {},
+                                  schema.key_types):
+            raise storage_error("ConditionalCheckFailedException",
+                                "The conditional request failed",
+                                operation_name)
+
+    def key_bounds(self, schema, key, sort_key):
+        hash_value = None
+        lower = upper = None
+        for term in condition_terms(key):
+            name = term['values'][0].name
+            operands = [to_key_value(v, schema.key_types.get(name))
+                        for v in term['values'][1:]]
+            if name == schema.hash_key and term['operator'] == "=":
+                hash_value = operands[0]
+            elif name == sort_key and term['operator'] in SORT_KEY_BOUNDS:
+                lower, upper = SORT_KEY_BOUNDS[term['operator']](operands)
+            else:
+                raise storage_error("ValidationException",
+                                    "Query key condition not supported",
+                                    "Query")
+        if hash_value is None:
+            raise storage_error("ValidationException",
+                                "Query condition missed key schema element: %s" % schema.hash_key,  # NOQA
+                                "Query")
+        return hash_value, lower, upper
+
+    def query(self, table_name, key, index_name=None, limit=None,
+              exclusive_start_key=None, projection=None,
+              scan_index_forward=True, filter_expression=None):
+        with self._lock:
+            schema = self.schema(table_name, "Query")
+            sort_key = schema.sort_key(index_name)
+            hash_value, lower, upper = self.key_bounds(schema, key, sort_key)
+            after = None
+            if exclusive_start_key:
+                start_item = schema.normalize(exclusive_start_key)
+                after = (start_item[sort_key], start_item[schema.range_key])
+            items = self._sorted_items(table_name, hash_value, sort_key,
+                                       lower, upper, after,
+                                       not scan_index_forward, limit)
+            last_evaluated_key = None
+            if limit and len(items) == limit:
+                last_evaluated_key = schema.evaluated_key(items[-1], sort_key)
+            if filter_expression is not None:
+                items = [i for i in items if evaluate_condition(filter_expression, i, schema.key_types)]  # NOQA
+            return [project(i, projection) for i in items], last_evaluated_key  # NOQA
+
+    def scan(self, table_name, filter_expression=None, segment=None,
+             total_segments=None, exclusive_start_key=None, projection=None):
+        # Every segment is scanned in one page
+        with self._lock:
+            schema = self.schema(table_name, "Scan")
+            items = self._all_items(table_name)
+            if total_segments:
+                items = [i for i in items if scan_segment_of(i[schema.hash_key], total_segments) == segment]  # NOQA
+            if filter_expression is not None:
+                items = [i for i in items if evaluate_condition(filter_expression, i, schema.key_types)]  # NOQA
+            return [project(i, projection) for i in items], None
+
+    def get_item(self, table_name, key, projection=None):
+        with self._lock:
+            schema = self.schema(table_name, "GetItem")
+            item = self._get(table_name, schema.key(key, "GetItem"))
+            return None if item is None else project(item, projection)
+
+    def put_item(self, table_name, item, condition_expression=None,
+                 return_values=None):
+        with self._lock:
+            schema = self.schema(table_name, "PutItem")
+            item = schema.normalize(item)
+            key = schema.key(item, "PutItem")
+            old_item = self._get(table_name, key)
+            self.check_condition(schema, condition_expression, old_item,
+                                 "PutItem")
+            self._put(table_name, key, item)
+            if return_values == "ALL_OLD":
+                return project(old_item or {})
+
+    def delete_item(self, table_name, key, condition_expression=None):
+        with self._lock:
+            schema = self.schema(table_name, "DeleteItem")
+            key = schema.key(key, "DeleteItem")
+            self.check_condition(schema, condition_expression,
+                                 self._get(table_name, key), "DeleteItem")
+            self._delete(table_name, key)
+
+    def update_item(self, table_name, key, update_expression,
+                    expr_attribute_values, condition_expression=None,
+                    return_values="UPDATED_NEW"):
+        with self._lock:
+            schema = self.schema(table_name, "UpdateItem")
+            key_item = schema.normalize(key)
+            key = schema.key(key_item, "UpdateItem")
+            old_item = self._get(table_name, key)
+            self.check_condition(schema, condition_expression, old_item,
+                                 "UpdateItem")
+            item = project(old_item or key_item)
+            updated = apply_update(item,
+                                   update_expression,
+                                   expr_attribute_values or {})
+            item = schema.normalize(item)
+            self._put(table_name, key, item)
+            attributes = update_return_values(return_values, old_item, item,
+                                              updated)
+            if not attributes:
+                return {}
+            return {"Attributes": project(attributes)}
+
+    def batch_get(self, table_name, keys, projection=None,
+                  max_attempts=None, consistent_read=False):
+        # Reads are always consistent here
+        items = []
+        for key in keys:
+            item = self.get_item(table_name, key, projection=projection)
+            if item is not None:
+                items.append(item)
+        return items, []
+
+    def batch_write(self, table_name, put_items=None, delete_keys=None,
+                    max_attempts=None):
+        for item in put_items or []:
+            self.put_item(table_name, item)
+        for key in delete_keys or []:
+            self.delete_item(table_name, key)
+        return []
+
+
+class MemoryStorage(LocalStorage):
+
+    # Items are kept by key, and every table and index keeps a sorted list
+    # of (sort key, range key) entries per hash key, so queries bisect
+    # their way to the first item they return
+    def __init__(self):
+        super(MemoryStorage, self).__init__()
+        self._items = {}
+        self._entries = {}
+
+    def _create(self, table_name, schema):
+        self._items[table_name] = {}
+        self._entries[table_name] = dict((k, {}) for k in schema.sort_keys)
+
+    def _get(self, table_name, key):
+        return self._items[table_name].get(key)
+
+    def _put(self, table_name, key, item):
+        self._delete(table_name, key)
+        self._items[table_name][key] = item
+        for sort_key, entries in self._entries[table_name].items():
+            # Indexes are sparse, items without the sort key are left out
+            if item.get(sort_key) is not None:
+                bisect.insort(entries.setdefault(key[0], []),
+                              (item[sort_key], key[1]))
+
+    def _delete(self, table_name, key):
+        item = self._items[table_name].pop(key, None)
+        if item is None:
+            return
+        for sort_key, entries in self._entries[table_name].items():
+            if item.get(sort_key) is None:
+                continue
+            hash_entries = entries[key[0]]
+            del hash_entries[bisect.bisect_left(hash_entries, (item[sort_key], key[1]))]  # NOQA
+
+    def _sorted_items(self, table_name, hash_value, sort_key, lower, upper,
+                      after, reverse, limit):
+        entries = self._entries[table_name][sort_key].get(hash_value, [])
+        start, stop = bisect_bounds(entries, lower, upper)
+        if after is not None and reverse:
+            stop = min(stop, bisect.bisect_left(entries, after))
+        elif after is not None:
+            start = max(start, bisect.bisect_right(entries, after))
+        positions = xrange(stop - 1, start - 1, -1) if reverse else xrange(start, stop)  # NOQA
+        items = self._items[table_name]
+        return [items[(hash_value, entries[p][1])]
+                for p in itertools.islice(positions, limit)]
+
+    def _all_items(self, table_name):
+        items = self._items[table_name]
+        return [items[k] for k in sorted(items)]
+
+
+def encode_json_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)  # NOQA
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+def to_sql_value(value):
+    if isinstance(value, Decimal):
+        return encode_json_number(value)
+    return value
+
+
+def quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class SQLiteStorage(LocalStorage):
+
+    # Every table is a SQL table of JSON encoded items, with a column (and
+    # an index) for its keys and for the range key of each of its indexes
+    def __init__(self, database):
+        super(SQLiteStorage, self).__init__()
+        self._db = sqlite3.connect(database,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._columns = {}
+
+    def _create(self, table_name, schema):
+        columns = dict((k, "s%s" % i) for i, k in enumerate(schema.sort_keys))  # NOQA
+        columns[schema.range_key] = "r"
+        table = quote_identifier(table_name)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS %s (h, %s, item TEXT, PRIMARY KEY (h, r))" % (  # NOQA
+                table,
+                ", ".join(sorted(set(columns.values())))
+            )
+        )
+        for sort_key, column in columns.items():
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS %s ON %s (h, %s, r)" % (
+                    quote_identifier("%s#%s" % (table_name, column)),
+                    table,
+                    column
+                )
+            )
+        self._columns[table_name] = columns
+
+    def _item(self, row):
+        return json.loads(row[0], parse_int=Decimal, parse_float=Decimal)
+
+    def _get(self, table_name, key):
+        row = self._db.execute(
+            "SELECT item FROM %s WHERE h = ? AND r = ?" % quote_identifier(table_name),  # NOQA
+            [to_sql_value(k) for k in key]
+        ).fetchone()
+        return None if row is None else self._item(row)
+
+    def _put(self, table_name, key, item):
+        columns = sorted(self._columns[table_name].items())
+        self._db.execute(
+            "INSERT OR REPLACE INTO %s (h, %s, item) VALUES (?, %s, ?)" % (
+                quote_identifier(table_name),
+                ", ".join(c for _, c in columns),
+                ", ".join("?" for _ in columns)
+            ),
+            [to_sql_value(key[0])] +
+            [to_sql_value(item.get(k)) for k, _ in columns] +
+            [json.dumps(item, default=encode_json_number)]
+        )
+
+    def _delete(self, table_name, key):
+        self._db.execute(
+            "DELETE FROM %s WHERE h = ? AND r = ?" % quote_identifier(table_name),  # NOQA
+            [to_sql_value(k) for k in key]
+        )
+
+    def batch_write(self, table_name, put_items=None, delete_keys=None,
+                    max_attempts=None):
+        # One transaction per batch rather than per item, and like on
+        # DynamoDB a batch that can't be written leaves the table as it was
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                unprocessed = super(SQLiteStorage, self).batch_write(
+                    table_name, put_items, delete_keys, max_attempts
+                )
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+        return unprocessed
+
+    def _sorted_items(self, table_name, hash_value, sort_key, lower, upper,
+                      after, reverse, limit):
+        column = self._columns[table_name][sort_key]
+        where = ["h = ?", "%s IS NOT NULL" % column]
+        params = [to_sql_value(hash_value)]
+        if lower is not None:
+            where.append("%s %s ?" % (column, ">=" if lower[1] else ">"))
+            params.append(to_sql_value(lower[0]))
+        if upper is not None:
+            where.append("%s %s ?" % (column, "<=" if upper[1] else "<"))
+            params.append(to_sql_value(upper[0]))
+        if after is not None:
+            where.append("(%s {0} ? OR (%s = ? AND r {0} ?))".format("<" if reverse else ">") % (column, column))  # NOQA
+            params.extend(to_sql_value(v) for v in [after[0], after[0], after[1]])  # NOQA
+        order = "DESC" if reverse else "ASC"
+        sql = "SELECT item FROM %s WHERE %s ORDER BY %s %s, r %s" % (
+            quote_identifier(table_name), " AND ".join(where), column, order, order  # NOQA
+        )
+        if limit:
+            sql += " LIMIT %s" % int(limit)
+        return [self._item(row) for row in self._db.execute(sql, params)]
+
+    def _all_items(self, table_name):
+        rows = self._db.execute(
+            "SELECT item FROM %s ORDER BY h, r" % quote_identifier(table_name)
+        )
+        return [self._item(row) for row in rows]
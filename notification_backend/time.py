@@ -1,9 +1,54 @@
+from __future__ import absolute_import
 import iso8601
 import datetime
 import pytz
+import re
+import time
+
+
+# GitHub always sends timestamps as 'YYYY-MM-DDTHH:MM:SSZ'
+GITHUB_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z\Z')
+DAYS_BEFORE_MONTH = (0, 0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+EPOCH_ORDINAL = 719163  # datetime.date(1970, 1, 1).toordinal()
+
+
+def is_leap_year(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def get_github_epoch_time(iso8601_str):
+    if GITHUB_TIMESTAMP.match(iso8601_str) is None:
+        return None
+    year = int(iso8601_str[0:4])
+    month = int(iso8601_str[5:7])
+    day = int(iso8601_str[8:10])
+    hour = int(iso8601_str[11:13])
+    minute = int(iso8601_str[14:16])
+    second = int(iso8601_str[17:19])
+
+    if year < 1 or month < 1 or month > 12 or day < 1 or \
+            hour > 23 or minute > 59 or second > 59:
+        # Let the general parser deal with (and complain about) these
+        return None
+    leap_day = 1 if is_leap_year(year) else 0
+    if day > DAYS_IN_MONTH[month] + (leap_day if month == 2 else 0):
+        return None
+
+    y = year - 1
+    ordinal = y * 365 + y // 4 - y // 100 + y // 400 + \
+        DAYS_BEFORE_MONTH[month] + day
+    if month > 2:
+        ordinal += leap_day
+    days = ordinal - EPOCH_ORDINAL
+    return days * 86400 + hour * 3600 + minute * 60 + second
 
 
 def get_epoch_time(iso8601_str):
+    epoch_time = get_github_epoch_time(iso8601_str)
+    if epoch_time is not None:
+        return epoch_time
+
     epoch_datetime = datetime.datetime(1970, 1, 1)
     epoch_datetime = epoch_datetime.replace(tzinfo=pytz.UTC)
     datetime_obj = iso8601.parse_date(iso8601_str)
@@ -12,9 +57,8 @@ def get_epoch_time(iso8601_str):
 
 
 def get_current_epoch_time():
-    epoch_datetime = datetime.datetime(1970, 1, 1)
-    epoch_datetime = epoch_datetime.replace(tzinfo=pytz.UTC)
-    now_datetime = datetime.datetime.utcnow()
-    now_datetime = now_datetime.replace(tzinfo=pytz.UTC)
-    return_val = (now_datetime - epoch_datetime).total_seconds()
-    return int(return_val)
+    return int(time.time())
+
+
+def get_github_timestamp(epoch_time):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(epoch_time))
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+import functools
+import threading
+import timeit
+from collections import OrderedDict
+from notification_backend.invocation import current_invocation
+
+
+# How many invocations are being traced, so that nothing else needs looking
+# up while none are. The trace of the invocation the current thread works
+# on, and the path of the span it is in, are kept with the invocation.
+_active_traces = 0
+_tracing_lock = threading.Lock()
+
+
+class Trace(object):
+
+    # What an invocation spent its time on, by span. Spans of the same name
+    # under the same parent add up, so paging through a query shows up as a
+    # single span with the number of pages as its count. Spans are listed in
+    # the order they were first entered in.
+    def __init__(self):
+        self.started = timeit.default_timer()
+        self.spans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enter(self, path):
+        with self._lock:
+            self.spans.setdefault(path, [0, 0.0])
+
+    def record(self, path, seconds):
+        with self._lock:
+            span = self.spans[path]
+            span[0] += 1
+            span[1] += seconds
+
+    def elapsed(self):
+        return timeit.default_timer() - self.started
+
+    def timings(self):
+        with self._lock:
+            spans = OrderedDict(
+                (path, {"count": count, "ms": round(seconds * 1000, 3)})
+                for path, (count, seconds) in self.spans.items()
+            )
+        return {
+            "total-ms": round(self.elapsed() * 1000, 3),
+            "spans": spans
+        }
+
+
+class Span(object):
+
+    def __init__(self, trace, path):
+        self.trace = trace
+        self.path = path
+
+    def __enter__(self):
+        self.invocation = current_invocation()
+        self.parent_path = self.invocation.path
+        self.invocation.path = self.path
+        self.trace.enter(self.path)
+        self.started = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.trace.record(self.path, timeit.default_timer() - self.started)
+        self.invocation.path = self.parent_path
+        return False
+
+
+class NoSpan(object):
+
+    # What spans are when nothing is being traced
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def current_trace():
+    return current_invocation().trace
+
+
+def set_trace(trace):
+    global _active_traces
+    invocation = current_invocation()
+    with _tracing_lock:
+        if invocation.trace is None and trace is not None:
+            _active_traces += 1
+        elif invocation.trace is not None and trace is None:
+            _active_traces -= 1
+        invocation.trace = trace
+        invocation.path = None
+
+
+def start_trace():
+    trace = Trace()
+    set_trace(trace)
+    return trace
+
+
+def stop_trace():
+    set_trace(None)
+
+
+def span(name):
+    if not _active_traces:
+        return NO_SPAN
+    invocation = current_invocation()
+    if invocation.trace is None:
+        return NO_SPAN
+    if invocation.path:
+        name = "%s/%s" % (invocation.path, name)
+    return Span(invocation.trace, name)
+
+
+def traced(name):
+    # Wraps every call of the function in a span, at the cost of a global
+    # lookup when nothing is being traced
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _active_traces or current_trace() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,212 @@
+from __future__ import absolute_import
+import Queue
+import logging
+import threading
+import time
+from collections import OrderedDict
+from boto3.dynamodb.conditions import Attr
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError
+from notification_backend.http import dynamodb_batch_get
+from notification_backend.http import dynamodb_batch_write
+from notification_backend.tracing import traced
+
+
+logger = logging.getLogger("notification_backend")
+
+
+def expected_values_condition(expected):
+    # The condition expression for a put that is only to be made while the
+    # stored item has the expected values (None for attributes it must not
+    # have)
+    conditions = [Attr(name).not_exists() if value is None else Attr(name).eq(value)  # NOQA
+                  for name, value in sorted(expected.items())]
+    return reduce(lambda a, b: a & b, conditions)
+
+
+def has_expected_values(item, expected):
+    return all(item.get(name) == value for name, value in expected.items())
+
+
+class WriteBehindQueue(object):
+
+    # Items are put to the datastore in batches, some time after they were
+    # queued. Items can be queued with the values their stored copy is
+    # expected to have (see expected_values_condition). Those get checked
+    # with a single consistent BatchGetItem right before the batch is
+    # written, and items whose stored copy no longer has them are dropped
+    # (the item got written some other way in the meantime). Like with the
+    # bulk routes, an item written between the check and the batch still
+    # gets overwritten. 'prepare' gets to amend every batch of items right
+    # before it is written. 'written' gets called with every item once it
+    # is written, as it was written.
+    def __init__(self, max_size, max_attempts, key_names, prepare=None):
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.key_names = key_names
+        self.prepare = prepare
+        self.counters = dict.fromkeys([
+            "queued",
+            "overflowed",
+            "written",
+            "retried",
+            "dropped",
+            "superseded",
+            "flushes",
+            "flush_errors"
+        ], 0)
+        self.flush_seconds = 0.0
+        self._pending = Queue.Queue(max(max_size, 1))
+        self._counters_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._stopping = threading.Event()
+
+    def count(self, name, value=1):
+        with self._counters_lock:
+            self.counters[name] += value
+
+    def enqueue(self, endpoint_url, table_name, item, expected=None,
+                written=None):
+        # Returns False if the item could not be queued, in which case the
+        # caller needs to write it out by itself
+        if self.max_size <= 0:
+            return False
+        try:
+            self._pending.put_nowait((endpoint_url, table_name, item, expected, written, 0))  # NOQA
+        except Queue.Full:
+            self.count("overflowed")
+            return False
+        self.count("queued")
+        return True
+
+    def requeue(self, endpoint_url, table_name, item, expected, written,
+                attempts):
+        if attempts >= self.max_attempts:
+            logger.error("Giving up on writing %s to %s after %s attempts" % (self.item_key(item), table_name, attempts))  # NOQA
+            self.count("dropped")
+            return
+        try:
+            self._pending.put_nowait((endpoint_url, table_name, item, expected, written, attempts))  # NOQA
+        except Queue.Full:
+            logger.error("Write-behind queue is full, dropping %s" % (self.item_key(item),))  # NOQA
+            self.count("dropped")
+            return
+        self.count("retried")
+
+    def item_key(self, item):
+        return tuple(item.get(k) for k in self.key_names)
+
+    def pending_batches(self):
+        # Only the latest write of an item is worth making, and BatchWriteItem
+        # refuses duplicate keys anyway
+        batches = OrderedDict()
+        while True:
+            try:
+                endpoint_url, table_name, item, expected, written, attempts = self._pending.get_nowait()  # NOQA
+            except Queue.Empty:
+                return batches
+            batch = batches.setdefault((endpoint_url, table_name), OrderedDict())  # NOQA
+            batch.pop(self.item_key(item), None)
+            batch[self.item_key(item)] = (item, expected, written, attempts)
+
+    @traced("write_behind_flush")
+    def flush(self):
+        with self._flush_lock:
+            start = time.time()
+            batches = self.pending_batches()
+            for (endpoint_url, table_name), batch in batches.items():
+                self.write_batch(endpoint_url, table_name, batch)
+            if batches:
+                self.count("flushes")
+                with self._counters_lock:
+                    self.flush_seconds += time.time() - start
+
+    def write_batch(self, endpoint_url, table_name, batch):
+        try:
+            failed_keys = self.drop_superseded_items(endpoint_url,
+                                                     table_name,
+                                                     batch)
+            items = [item for key, (item, _, _, _) in batch.items()
+                     if key not in failed_keys]
+            if self.prepare:
+                self.prepare(endpoint_url, table_name, items)
+            unprocessed_requests = dynamodb_batch_write(endpoint_url,
+                                                        table_name,
+                                                        put_items=items)
+            failed_keys.update(
+                self.item_key(r.get('PutRequest', {}).get('Item'))
+                for r in unprocessed_requests
+            )
+        except (Boto3Error, BotoCoreError, ClientError) as e:
+            logger.error("Error writing %s queued items to %s: %s" % (len(batch), table_name, str(e)))  # NOQA
+            self.count("flush_errors")
+            failed_keys = set(batch.keys())
+
+        self.count("written", len(batch) - len(failed_keys))
+        for key, (item, expected, written, attempts) in batch.items():
+            if key in failed_keys:
+                self.requeue(endpoint_url, table_name, item, expected,
+                             written, attempts + 1)
+            elif written:
+                written(item)
+
+    def drop_superseded_items(self, endpoint_url, table_name, batch):
+        # Superseded items are taken out of the batch, returns the keys of
+        # the items that could not be checked
+        checked = [(key, expected)
+                   for key, (_, expected, _, _) in batch.items()
+                   if expected is not None]
+        if not checked:
+            return set()
+        names = set(self.key_names)
+        for key, expected in checked:
+            names.update(expected.keys())
+        stored_items, unprocessed_keys = dynamodb_batch_get(
+            endpoint_url,
+            table_name,
+            [dict(zip(self.key_names, key)) for key, _ in checked],
+            projection=sorted(names),
+            consistent_read=True
+        )
+        stored = dict((self.item_key(i), i) for i in stored_items)
+        failed_keys = set(self.item_key(k) for k in unprocessed_keys)
+        for key, expected in checked:
+            if key in failed_keys:
+                continue
+            if not has_expected_values(stored.get(key, {}), expected):
+                logger.debug("Not writing %s to %s, it changed since it got queued" % (key, table_name))  # NOQA
+                self.count("superseded")
+                del batch[key]
+        return failed_keys
+
+    def run(self, interval):
+        while not self._stopping.wait(interval):
+            self.flush()
+
+    def start(self, interval):
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self.run, args=(interval,))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def clear(self):
+        self.pending_batches()
+
+    def stop(self):
+        if self._worker is not None:
+            self._stopping.set()
+            self._worker.join()
+            self._worker = None
+        self.flush()
+
+    def running(self):
+        return self._worker is not None
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self.counters)
+            stats['flush_seconds'] = self.flush_seconds
+        stats['pending'] = self._pending.qsize()
+        return stats
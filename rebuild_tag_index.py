@@ -0,0 +1,34 @@
+import argparse
+import os
+import sys
+from notification_backend.notification_threads import rebuild_thread_index
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the tag index rows of the given users from "
+                    "their notifications, in the tables named by the "
+                    "server's environment variables"
+    )
+    parser.add_argument("user_ids", type=int, nargs="+")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    tag_table_name = os.environ.get('NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME')  # NOQA
+    if not tag_table_name:
+        sys.exit("NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME is not set")  # NOQA
+    for user_id in args.user_ids:
+        put_count, delete_count = rebuild_thread_index(
+            os.environ['DYNAMODB_ENDPOINT_URL'],
+            os.environ['NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME'],
+            tag_table_name,
+            user_id
+        )
+        sys.stdout.write("Rebuilt the tag index of user %s: %s rows written, %s stale rows deleted\n" % (user_id, put_count, delete_count))  # NOQA
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,52 @@
 import BaseHTTPServer
+import Queue
+import argparse
+import collections
+import errno
+import functools
+import select
+import signal
+import socket
 import sys
+import threading
 import time
+import timeit
 import json
 import os
 import logging
 import re
+import urlparse
+import zlib
 from notification_backend.entrypoint import handler
+from notification_backend.notification_threads import write_behind_queue
+from notification_backend.notification_threads import github_not_found_cache
+from notification_backend.http import STORAGE_ENGINE
+from notification_backend.http import storage_engine
+from notification_backend.http import jwt_cache_stats
+from notification_backend.http import dynamodb_retry_stats
+from notification_backend.http import dynamodb_capacity_stats
+from notification_backend.http import dynamodb_latency
+from notification_backend.github import github_latency
+from notification_backend.metrics import Gauge
+from notification_backend.metrics import Histogram
+from notification_backend.metrics import Snapshot
+from notification_backend.metrics import render
+from notification_backend.metrics import CONTENT_TYPE
 
 
-HOST_NAME = sys.argv[1]
-PORT_NUMBER = int(sys.argv[2])
 logger = logging.getLogger("notification_backend")
 
 allowed_headers = [
     "Content-Type",
-    "Authorization"
+    "Authorization",
+    "If-None-Match",
+    "If-Modified-Since",
+    "X-Debug-Timings"
+]
+
+exposed_headers = [
+    "ETag",
+    "Last-Modified"
 ]
 
 allowed_methods = [
@@ -25,88 +57,635 @@ allowed_methods = [
     "DELETE"
 ]
 
+HEARTBEAT_INTERVAL = 1  # in seconds
+# Workers that go this long without a heartbeat get killed
+HEARTBEAT_TIMEOUT = int(os.environ.get('HEARTBEAT_TIMEOUT', 30))  # in seconds  # NOQA
+GRACEFUL_TIMEOUT = 30  # in seconds
+STREAM_CHUNK_SIZE = 65536  # in bytes
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.5))  # NOQA
+
+METRICS_PATH = "/notification/metrics"
+# Requests are labelled by route rather than by path, so that every thread
+# doesn't get metrics of its own
+METRIC_ROUTES = [
+    "/notification/threads",
+    "/notification/threads/export",
+    "/notification/threads/{thread-id}",
+    "/notification/sync",
+    "/notification/ping",
+    METRICS_PATH
+]
+
+request_latency = Histogram("notification_http_request_duration_seconds",
+                            "Time spent on requests, until fully responded to",  # NOQA
+                            ["route", "method", "status"])
+requests_in_flight = Gauge("notification_http_requests_in_flight",
+                           "Requests being worked on")
+
+SERVICE_UNAVAILABLE_RESPONSE = (
+    "HTTP/1.1 503 Service Unavailable\r\n"
+    "Content-Length: 0\r\n"
+    "Connection: close\r\n"
+    "\r\n"
+)
+
+
+def observed(do_method):
+    # Counts the request towards the metrics of its route
+    @functools.wraps(do_method)
+    def observed_method(self):
+        self.response_status = None
+        started = timeit.default_timer()
+        requests_in_flight.inc()
+        try:
+            do_method(self)
+        finally:
+            requests_in_flight.dec()
+            request_latency.observe(
+                timeit.default_timer() - started,
+                (metric_route(self.path), self.command, str(self.response_status or "none"))  # NOQA
+            )
+    return observed_method
+
 
 class LocalNotificationBackend(BaseHTTPServer.BaseHTTPRequestHandler):
 
     server_version = "LocalNotificationBackend/0.1"
 
-    def do_OPTIONS(self):
-        self.send_response(200)
+    def send_response(self, code, message=None):
+        self.response_status = code
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)  # NOQA
+
+    def send_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header("Access-Control-Allow-Methods", ",".join(allowed_methods))  # NOQA
         self.send_header("Access-Control-Allow-Headers", ",".join(allowed_headers))  # NOQA
-        self.end_headers()
+        self.send_header("Access-Control-Expose-Headers", ",".join(exposed_headers))  # NOQA
 
-    def do_GET(self):
-        status, result = handle_request({}, self.headers, self.path, "GET")
+    def send_json(self, status, result, headers=None):
         self.send_response(status)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header("Access-Control-Allow-Methods", ",".join(allowed_methods))  # NOQA
-        self.send_header("Access-Control-Allow-Headers", ",".join(allowed_headers))  # NOQA
+        self.send_cors_headers()
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        if status == 304:
+            # A 304 never has a body (not even an empty JSON document)
+            self.end_headers()
+            self.server.record_request()
+            return
+        body = json.dumps(result)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record_request()
+
+    def send_stream(self, status, lines, headers=None):
+        # Chunked over HTTP/1.1, plain HTTP/1.0 responses end when the
+        # connection gets closed
+        chunked = self.request_version == "HTTP/1.1" and \
+            self.protocol_version == "HTTP/1.1"
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(status)
+        self.send_cors_headers()
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.close_connection = 1
+        self.end_headers()
+        try:
+            self.write_stream(lines, chunked, gzipped)
+        except Exception:
+            # The status line is long gone, dropping the connection without
+            # the last chunk is the only way left to tell the client
+            logger.exception("Streamed response aborted")
+            self.close_connection = 1
+            return
+        self.server.record_request()
+
+    def write_stream(self, lines, chunked, gzipped):
+        encoder = None
+        if gzipped:
+            encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in stream_chunks(lines, STREAM_CHUNK_SIZE):
+            if encoder:
+                chunk = encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)  # NOQA
+            self.write_chunk(chunk, chunked)
+        if encoder:
+            self.write_chunk(encoder.flush(), chunked)
+        if chunked:
+            self.wfile.write("0\r\n\r\n")
+
+    def write_chunk(self, chunk, chunked):
+        if not chunk:
+            return
+        if chunked:
+            self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        else:
+            self.wfile.write(chunk)
+
+    def send_metrics(self):
+        body = render(server_metrics(self.server))
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record_request()
+
+    def read_payload(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    @observed
+    def do_OPTIONS(self):
+        self.send_response(200)
+        self.send_cors_headers()
+        self.send_header("Content-Length", "0")
         self.end_headers()
-        self.wfile.write(json.dumps(result))
 
+    @observed
+    def do_GET(self):
+        if urlparse.urlparse(self.path).path == METRICS_PATH:
+            self.send_metrics()
+            return
+        status, result, headers = handle_request({},
+                                                 self.headers,
+                                                 self.path,
+                                                 "GET")
+        if isinstance(result, collections.Iterator):
+            self.send_stream(status, result, headers)
+            return
+        self.send_json(status, result, headers)
+
+    @observed
     def do_POST(self):
-        length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(length)
-        payload = json.loads(post_data)
-        status, result = handle_request(
-            payload,
+        status, result, headers = handle_request(
+            self.read_payload(),
             self.headers,
             self.path,
             "POST"
         )
-        self.send_response(status)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header("Access-Control-Allow-Methods", ",".join(allowed_methods))  # NOQA
-        self.send_header("Access-Control-Allow-Headers", ",".join(allowed_headers))  # NOQA
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(result))
+        self.send_json(status, result, headers)
 
+    @observed
     def do_PATCH(self):
-        length = int(self.headers['Content-Length'])
-        patch_data = self.rfile.read(length)
-        payload = json.loads(patch_data)
-        status, result = handle_request(
-            payload,
+        status, result, headers = handle_request(
+            self.read_payload(),
             self.headers,
             self.path,
             "PATCH"
         )
-        self.send_response(status)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header("Access-Control-Allow-Methods", ",".join(allowed_methods))  # NOQA
-        self.send_header("Access-Control-Allow-Headers", ",".join(allowed_headers))  # NOQA
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(result))
+        self.send_json(status, result, headers)
 
+    @observed
     def do_DELETE(self):
-        status, result = handle_request({}, self.headers, self.path, "DELETE")
-        self.send_response(status)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header("Access-Control-Allow-Methods", ",".join(allowed_methods))  # NOQA
-        self.send_header("Access-Control-Allow-Headers", allowed_headers.join(","))  # NOQA
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(result))
+        status, result, headers = handle_request(
+            self.read_payload(),
+            self.headers,
+            self.path,
+            "DELETE"
+        )
+        self.send_json(status, result, headers)
 
 
-def handle_request(payload, headers, resource_path, http_method):
-    threadid = None
+def stream_chunks(lines, chunk_size):
+    # Joins lines into chunks of about chunk_size bytes, so neither every
+    # line goes out on its own nor does the whole body get buffered
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+class KeepAliveNotificationBackend(LocalNotificationBackend):
+
+    # Persistent connections hold on to a worker thread, so idle ones are
+    # dropped after a while
+    protocol_version = "HTTP/1.1"
+    timeout = 15
+
+
+class LocalHTTPServer(BaseHTTPServer.HTTPServer):
+
+    allow_reuse_address = True
+
+    def __init__(self,
+                 server_address,
+                 handler_class,
+                 bind_and_activate=True):
+        self.requests_served = 0
+        self.requests_served_lock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(self,
+                                           server_address,
+                                           handler_class,
+                                           bind_and_activate)
+
+    def record_request(self):
+        with self.requests_served_lock:
+            self.requests_served += 1
+
+    def use_socket(self, listening_socket):
+        # Serve from an already bound and listening socket (shared between
+        # pre-forked worker processes)
+        self.socket.close()
+        self.socket = listening_socket
+        self.server_address = listening_socket.getsockname()
+        self.server_name, self.server_port = self.server_address[:2]
+
+
+class ThreadPoolHTTPServer(LocalHTTPServer):
+
+    def __init__(self,
+                 server_address,
+                 handler_class,
+                 workers,
+                 queue_size,
+                 bind_and_activate=True):
+        # The listen backlog is sized to match the request queue
+        self.request_queue_size = queue_size
+        self.pending_requests = Queue.Queue(queue_size)
+        self.workers = []
+        LocalHTTPServer.__init__(self,
+                                 server_address,
+                                 handler_class,
+                                 bind_and_activate)
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_pending_requests)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self.pending_requests.put_nowait((request, client_address))
+        except Queue.Full:
+            logger.warning("Request queue is full, rejecting %s:%s" % client_address)  # NOQA
+            try:
+                request.sendall(SERVICE_UNAVAILABLE_RESPONSE)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+
+    def process_pending_requests(self):
+        while True:
+            request, client_address = self.pending_requests.get()
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        LocalHTTPServer.server_close(self)
+        for worker in self.workers:
+            self.pending_requests.put((None, None))
+
+    def drain(self, timeout):
+        # Let the worker threads finish whatever was already accepted
+        self.server_close()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+
+
+def eintr_retry(func, *args):
+    while True:
+        try:
+            return func(*args)
+        except (OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+
+def kill_worker(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        # The worker might have exited already
+        if e.errno != errno.ESRCH:
+            raise
+
+
+class PreforkServer(object):
+
+    def __init__(self, args, listening_socket):
+        self.args = args
+        self.listening_socket = listening_socket
+        self.worker_count = args.workers
+        self.workers = {}
+        self.generation = 0
+        self.running = True
+        self.restart_requested = False
+        self.report_requested = False
+
+    def spawn_worker(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for worker in self.workers.values():
+                os.close(worker['pipe'])
+            status = 0
+            try:
+                run_worker(self.args, self.listening_socket, write_fd)
+            except Exception:
+                logger.exception("Worker %s crashed" % os.getpid())
+                status = 1
+            finally:
+                os._exit(status)
+
+        os.close(write_fd)
+        now = time.time()
+        self.workers[pid] = {
+            "pipe": read_fd,
+            "buffer": "",
+            "generation": self.generation,
+            "started": now,
+            "last_heartbeat": now,
+            "requests": 0
+        }
+        logger.info("Started worker %s (generation %s)" % (pid, self.generation))  # NOQA
+        return pid
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.restart_requested = True
+        elif signum == signal.SIGUSR1:
+            self.report_requested = True
+        else:
+            self.running = False
+
+    def read_heartbeats(self, timeout):
+        pipes = dict((w['pipe'], pid) for pid, w in self.workers.items())
+        readable = eintr_retry(select.select, pipes.keys(), [], [], timeout)[0]  # NOQA
+        for fd in readable:
+            worker = self.workers[pipes[fd]]
+            worker['buffer'] += eintr_retry(os.read, fd, 4096)
+            lines = worker['buffer'].split("\n")
+            worker['buffer'] = lines.pop()
+            for line in lines:
+                heartbeat = json.loads(line)
+                worker['last_heartbeat'] = time.time()
+                worker['requests'] = heartbeat.get('requests')
+
+    def reap_workers(self):
+        while self.workers:
+            pid, status = eintr_retry(os.waitpid, -1, os.WNOHANG)
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker['pipe'])
+            logger.info("Worker %s exited with status %s" % (pid, status))
+            if self.running and worker['generation'] == self.generation:
+                self.spawn_worker()
+
+    def kill_stale_workers(self):
+        now = time.time()
+        for pid, worker in self.workers.items():
+            if now - worker['last_heartbeat'] > HEARTBEAT_TIMEOUT:
+                logger.warning("Worker %s missed its heartbeats, killing it" % pid)  # NOQA
+                kill_worker(pid, signal.SIGKILL)
+
+    def restart_workers(self):
+        # Rolling restart, every old worker gets replaced by a fresh one
+        # before being asked to finish its in-flight requests and exit
+        self.restart_requested = False
+        self.generation += 1
+        logger.info("Restarting workers (generation %s)" % self.generation)
+        for pid in [p for p, w in self.workers.items() if w['generation'] < self.generation]:  # NOQA
+            self.spawn_worker()
+            kill_worker(pid, signal.SIGTERM)
+
+    def report_health(self):
+        self.report_requested = False
+        now = time.time()
+        for pid, worker in sorted(self.workers.items()):
+            logger.info(
+                "Worker %s: generation %s, up %ds, %s requests served, last heartbeat %.1fs ago" % (  # NOQA
+                    pid,
+                    worker['generation'],
+                    now - worker['started'],
+                    worker['requests'],
+                    now - worker['last_heartbeat']
+                )
+            )
+
+    def stop_workers(self):
+        for pid in self.workers:
+            kill_worker(pid, signal.SIGTERM)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while self.workers and time.time() < deadline:
+            self.read_heartbeats(0.1)
+            self.reap_workers()
+        for pid in self.workers:
+            logger.warning("Worker %s did not stop in time, killing it" % pid)  # NOQA
+            kill_worker(pid, signal.SIGKILL)
+
+    def serve_forever(self):
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1]:  # NOQA
+            signal.signal(signum, self.handle_signal)
+        for i in range(self.worker_count):
+            self.spawn_worker()
+        while self.running:
+            self.read_heartbeats(HEARTBEAT_INTERVAL)
+            self.reap_workers()
+            self.kill_stale_workers()
+            if self.restart_requested:
+                self.restart_workers()
+            if self.report_requested:
+                self.report_health()
+        self.stop_workers()
+
+
+def send_heartbeats(httpd, heartbeat_fd, stopping):
+    # From a thread of its own, so that a worker busy with a request that
+    # takes longer than HEARTBEAT_TIMEOUT doesn't get killed for it
+    while True:
+        heartbeat = {"pid": os.getpid(), "requests": httpd.requests_served}
+        eintr_retry(os.write, heartbeat_fd, json.dumps(heartbeat) + "\n")
+        if stopping.wait(HEARTBEAT_INTERVAL):
+            return
+
+
+def run_worker(args, listening_socket, heartbeat_fd):
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    for signum in [signal.SIGINT, signal.SIGHUP, signal.SIGUSR1]:
+        signal.signal(signum, signal.SIG_IGN)
+
+    # Every worker opens storage of its own, after the fork: a SQLite
+    # connection can't be shared between processes
+    if STORAGE_ENGINE != "dynamodb":
+        create_storage_tables()
+    httpd = create_server(args, listening_socket)
+    # Waits for a connection at most this long before checking whether the
+    # worker is to stop. handle_request() waits no longer than the socket's
+    # own timeout either, which on the non-blocking listening socket would
+    # have it spin: a worker that loses the race for a connection waits in
+    # accept() for the next one for as long instead.
+    httpd.timeout = HEARTBEAT_INTERVAL
+    httpd.socket.settimeout(HEARTBEAT_INTERVAL)
+    write_behind_queue.start(WRITE_BEHIND_FLUSH_INTERVAL)
+    heartbeats = threading.Thread(target=send_heartbeats,
+                                  args=(httpd, heartbeat_fd, stopping))
+    heartbeats.daemon = True
+    heartbeats.start()
+    while not stopping.is_set():
+        httpd.handle_request()
+
+    if isinstance(httpd, ThreadPoolHTTPServer):
+        httpd.drain(GRACEFUL_TIMEOUT)
+    write_behind_queue.stop()
+
+
+def create_storage_tables():
+    # DynamoDB tables get created by 'make init-local-dynamodb', the other
+    # storage engines are told about the same tables as the server starts
+    engine = storage_engine(os.environ['DYNAMODB_ENDPOINT_URL'])
+    thread_key_schema = [("user_id", "N"), ("thread_id", "N")]
+    thread_indexes = {
+        os.environ['NOTIFICATION_USER_NOTIFICATION_DATE_DYNAMODB_INDEX_NAME']: ("updated_at", "N")  # NOQA
+    }
+    if os.environ.get('NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME'):  # NOQA
+        thread_indexes[os.environ['NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME']] = ("change_version", "N")  # NOQA
+    engine.create_table(
+        os.environ['NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME'],
+        thread_key_schema,
+        indexes=thread_indexes
+    )
+    optional_tables = [
+        ('NOTIFICATION_GITHUB_NOT_FOUND_DYNAMODB_TABLE_NAME', thread_key_schema),  # NOQA
+        ('NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME', [("index_key", "S"), ("thread_id", "N")])  # NOQA
+    ]
+    for table_variable, key_schema in optional_tables:
+        if os.environ.get(table_variable):
+            engine.create_table(os.environ[table_variable], key_schema)
+
+
+def resource_route(resource_path):
+    # The route (as API Gateway knows it) and thread id of a path
     thread_id_path = re.match('^/notification/threads/([0-9]+)$', resource_path)  # NOQA
     if thread_id_path:
-        resource_path = "/notification/threads/{thread-id}"
-        threadid = thread_id_path.group(1)
+        return "/notification/threads/{thread-id}", thread_id_path.group(1)
+    return resource_path, None
+
 
-    qs_from = None
-    # qs_from_path = re.match('^/notification/threads(\?.+)?$', resource_path)
-    qs_from_path = re.match('^/notification/threads\?from=(.+)$', resource_path)  # NOQA
-    if qs_from_path:
-        resource_path = "/notification/threads"
-        qs_from = qs_from_path.group(1)
+def metric_route(path):
+    route = resource_route(urlparse.urlparse(path).path)[0]
+    if route not in METRIC_ROUTES:
+        return "other"
+    return route
+
+
+def cache_metrics():
+    caches = {
+        "jwt": jwt_cache_stats(),
+        "github_not_found": github_not_found_cache.stats()
+    }
+    hit_ratios = dict(
+        (name, float(s['hits']) / (s['hits'] + s['misses']) if s['hits'] + s['misses'] else 0.0)  # NOQA
+        for name, s in caches.items()
+    )
+    return [
+        Snapshot("notification_cache_hits_total",
+                 "Cache lookups that found an entry", "counter", ["cache"],
+                 dict(((n,), s['hits']) for n, s in caches.items())),
+        Snapshot("notification_cache_misses_total",
+                 "Cache lookups that found nothing", "counter", ["cache"],
+                 dict(((n,), s['misses']) for n, s in caches.items())),
+        Snapshot("notification_cache_hit_ratio",
+                 "Share of the cache lookups that found an entry", "gauge",
+                 ["cache"], dict(((n,), r) for n, r in hit_ratios.items())),
+        Snapshot("notification_cache_entries",
+                 "Entries in the cache", "gauge", ["cache"],
+                 dict(((n,), s['size']) for n, s in caches.items()))
+    ]
+
+
+def dynamodb_metrics():
+    retries = dynamodb_retry_stats()
+    capacity = dynamodb_capacity_stats()
+    consumed = {
+        ("none", "read"): capacity['unattributed_read_units'],
+        ("none", "write"): capacity['unattributed_write_units']
+    }
+    for route, totals in capacity['routes'].items():
+        consumed[(route, "read")] = totals['read_units']
+        consumed[(route, "write")] = totals['write_units']
+    return [
+        Snapshot("notification_dynamodb_retry_events_total",
+                 "DynamoDB requests made, throttled, failed, retried, given up on and held back",  # NOQA
+                 "counter", ["event"],
+                 dict(((e,), retries[e]) for e in ["requests", "throttles", "errors", "retries", "exhausted", "paced"])),  # NOQA
+        Snapshot("notification_dynamodb_paced_seconds_total",
+                 "Time DynamoDB requests were held back for", "counter", [],
+                 {(): retries['paced_seconds']}),
+        Snapshot("notification_dynamodb_rate_limited_tables",
+                 "Tables requests are held back for", "gauge", [],
+                 {(): retries['rate_limited_tables']}),
+        Snapshot("notification_dynamodb_consumed_capacity_units_total",
+                 "DynamoDB capacity units consumed, by route (none outside of requests)",  # NOQA
+                 "counter", ["route", "kind"], consumed),
+        Snapshot("notification_dynamodb_capacity_rejected_total",
+                 "Requests turned away for being over the read capacity budget",  # NOQA
+                 "counter", [], {(): capacity['rejected']})
+    ]
+
+
+def write_behind_metrics():
+    stats = write_behind_queue.stats()
+    events = ["queued", "overflowed", "written", "retried", "dropped",
+              "superseded", "flushes", "flush_errors"]
+    return [
+        Snapshot("notification_write_behind_events_total",
+                 "Threads queued, written, retried and dropped, and flushes",
+                 "counter", ["event"],
+                 dict(((e,), stats[e]) for e in events)),
+        Snapshot("notification_write_behind_flush_seconds_total",
+                 "Time spent flushing queued writes", "counter", [],
+                 {(): stats['flush_seconds']}),
+        Snapshot("notification_write_behind_pending",
+                 "Threads waiting to be written", "gauge", [],
+                 {(): stats['pending']})
+    ]
+
+
+def server_metrics(httpd):
+    metrics = [request_latency, requests_in_flight]
+    pending_requests = getattr(httpd, 'pending_requests', None)
+    if pending_requests is not None:
+        metrics.append(Snapshot("notification_http_requests_queued",
+                                "Connections waiting for a worker thread",
+                                "gauge", [], {(): pending_requests.qsize()}))
+    metrics.extend([dynamodb_latency, github_latency])
+    metrics.extend(dynamodb_metrics())
+    metrics.extend(cache_metrics())
+    metrics.extend(write_behind_metrics())
+    return metrics
+
+
+def handle_request(payload, headers, resource_path, http_method):
+    url = urlparse.urlparse(resource_path)
+    resource_path, threadid = resource_route(url.path)
+    query_string = dict(urlparse.parse_qsl(url.query))
 
     event = {
         "resource-path": resource_path,
@@ -117,8 +696,22 @@ def handle_request(payload, headers, resource_path, http_method):
         "notification_dynamodb_endpoint_url": os.environ['DYNAMODB_ENDPOINT_URL'],  # NOQA
         "notification_user_notification_dynamodb_table_name": os.environ['NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME'],  # NOQA
         "notification_user_notification_date_dynamodb_index_name": os.environ['NOTIFICATION_USER_NOTIFICATION_DATE_DYNAMODB_INDEX_NAME'],  # NOQA
+        "notification_user_notification_change_dynamodb_index_name": os.environ.get('NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME'),  # NOQA
+        "notification_github_not_found_dynamodb_table_name": os.environ.get('NOTIFICATION_GITHUB_NOT_FOUND_DYNAMODB_TABLE_NAME'),  # NOQA
+        "notification_user_notification_tag_dynamodb_table_name": os.environ.get('NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME'),  # NOQA
         "threadid": threadid,
-        "qs_from": qs_from,
+        "qs_from": query_string.get("from"),
+        "qs_page_size": query_string.get("page[size]"),
+        "qs_page_cursor": query_string.get("page[cursor]"),
+        "qs_filter_id": query_string.get("filter[id]"),
+        "qs_filter_tag": query_string.get("filter[tag]"),
+        "qs_filter_reason": query_string.get("filter[reason]"),
+        "qs_since": query_string.get("since"),
+        "qs_segments": query_string.get("segments"),
+        "stream_response": True,
+        "if_none_match": headers.get("If-None-Match"),
+        "if_modified_since": headers.get("If-Modified-Since"),
+        "debug_timings": headers.get("X-Debug-Timings"),
     }
     try:
         response_payload = handler(event, {})
@@ -131,17 +724,70 @@ def handle_request(payload, headers, resource_path, http_method):
 
 def transform_response(response_payload):
     status = response_payload['http_status']
-    data = response_payload['data']
-    return (status, data)
+    data = response_payload.get('stream', response_payload.get('data'))
+    headers = response_payload.get('headers', {})
+    return (status, data, headers)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Run the local development server"
+    )
+    parser.add_argument("host_name")
+    parser.add_argument("port_number", type=int)
+    parser.add_argument("--threads", type=int, default=0,
+                        help="serve requests concurrently with this many worker threads, using HTTP/1.1 persistent connections")  # NOQA
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="maximum number of connections waiting for a worker thread")  # NOQA
+    parser.add_argument("--workers", type=int, default=0,
+                        help="pre-fork this many worker processes sharing the listening socket (SIGHUP restarts them, SIGUSR1 logs their health)")  # NOQA
+    return parser.parse_args(argv)
+
+
+def create_listening_socket(args):
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((args.host_name, args.port_number))
+    listening_socket.listen(max(args.queue_size, 5))
+    # Every worker waits on the same socket, the ones that lose the race
+    # for a connection must not block in accept()
+    listening_socket.setblocking(0)
+    return listening_socket
+
+
+def create_server(args, listening_socket=None):
+    server_address = (args.host_name, args.port_number)
+    bind_and_activate = listening_socket is None
+    if args.threads > 0:
+        httpd = ThreadPoolHTTPServer(server_address,
+                                     KeepAliveNotificationBackend,
+                                     args.threads,
+                                     max(args.queue_size, 1),
+                                     bind_and_activate)
+    else:
+        httpd = LocalHTTPServer(server_address,
+                                LocalNotificationBackend,
+                                bind_and_activate)
+    if listening_socket is not None:
+        httpd.use_socket(listening_socket)
+    return httpd
 
 
 if __name__ == '__main__':
-    server_class = BaseHTTPServer.HTTPServer
-    httpd = server_class((HOST_NAME, PORT_NUMBER), LocalNotificationBackend)
-    print(time.asctime(), "Server Starts - %s:%s" % (HOST_NAME, PORT_NUMBER))
+    args = parse_args(sys.argv[1:])
+    if STORAGE_ENGINE != "dynamodb" and args.workers == 0:
+        create_storage_tables()
+    if args.workers > 0:
+        httpd = PreforkServer(args, create_listening_socket(args))
+    else:
+        httpd = create_server(args)
+        write_behind_queue.start(WRITE_BEHIND_FLUSH_INTERVAL)
+    print(time.asctime(), "Server Starts - %s:%s" % (args.host_name, args.port_number))  # NOQA
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
-    httpd.server_close()
-    print(time.asctime(), "Server Stops - %s:%s" % (HOST_NAME, PORT_NUMBER))
+    if args.workers == 0:
+        httpd.server_close()
+        write_behind_queue.stop()
+    print(time.asctime(), "Server Stops - %s:%s" % (args.host_name, args.port_number))  # NOQA
@@ -0,0 +1,243 @@
+import unittest
+import json
+import jwt
+from mock import patch
+from boto3.exceptions import Boto3Error
+from notification_backend.notification_threads import NotificationThreads
+
+
+class TestBulkThreads(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_batch_get')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_batch_get = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_batch_write')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_batch_write = patcher2.start()
+        self.mock_db_batch_write.return_value = []
+
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_update = patcher3.start()
+        self.mock_db_update.return_value = {
+            "Attributes": {"user_version": 12}
+        }
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {
+                "data": [
+                    {
+                        "type": "threads",
+                        "id": 1,
+                        "attributes": {
+                            "updated-at": 1460443218,
+                            "reason": "mention",
+                            "tags": ["mentioned", "read"]
+                        }
+                    },
+                    {
+                        "type": "threads",
+                        "id": "2",
+                        "attributes": {
+                            "updated-at": 1460443219,
+                            "reason": "comment",
+                            "tags": ["commented"]
+                        }
+                    },
+                    {
+                        "type": "fake",
+                        "id": 3
+                    },
+                    {
+                        "type": "threads",
+                        "id": "3s"
+                    },
+                    {
+                        "type": "threads",
+                        "id": 1
+                    }
+                ]
+            },
+            "resource-path": "/notification/threads",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"
+        }
+        self.mock_db_batch_get.return_value = ([{
+            "user_id": 333333,
+            "thread_id": 1,
+            "thread_url": "http://api.example.com/fake/1",
+            "reason": "subscribed",
+            "updated_at": 1460443217,
+            "subject_title": "Fake Issue",
+            "tags": ["watching"]
+        }], [])
+
+    def results(self, result_json):
+        return result_json.get('data').get('meta').get('results')
+
+    def test_invalid_payload(self):
+        for payload in [{}, {"data": {"type": "threads", "id": 1}},
+                        {"data": [{"type": "threads", "id": 1}] * 101}]:
+            self.lambda_event['payload'] = payload
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("update_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'data' member needs to be an array of at most 100 thread resources"  # NOQA
+            )
+        self.assertEqual(len(self.mock_db_batch_get.mock_calls), 0)
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 0)
+
+    def test_update_threads(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(result_json.get('data').get('meta').get('message'),
+                         "2 of 5 threads updated successfully")
+        self.assertEqual(self.results(result_json), [
+            {"id": 1, "status": 200},
+            {"id": 2, "status": 200},
+            {"id": 3, "status": 400, "detail": "Invalid 'type' member, should be 'threads'"},  # NOQA
+            {"id": "3s", "status": 400, "detail": "Invalid 'id' member, should be a thread id"},  # NOQA
+            {"id": 1, "status": 400, "detail": "Duplicate thread id 1"}
+        ])
+        self.assertEqual(
+            self.mock_db_batch_get.call_args[1].get('projection'),
+            None
+        )
+        put_items = self.mock_db_batch_write.call_args[1].get('put_items')
+        self.assertEqual(sorted(i.pop('change_version') for i in put_items),
+                         [11, 12])
+        for item in put_items:
+            self.assertTrue(item.pop('changed_at') > 0)
+        put_items = dict((i['thread_id'], i) for i in put_items)
+        self.assertEqual(put_items[1], {
+            "user_id": 333333,
+            "thread_id": 1,
+            "thread_url": "http://api.example.com/fake/1",
+            "reason": "mention",
+            "updated_at": 1460443218,
+            "subject_title": "Fake Issue",
+            "tags": ["mentioned", "read"]
+        })
+        self.assertEqual(put_items[2], {
+            "user_id": "333333",
+            "thread_id": 2,
+            "reason": "comment",
+            "updated_at": 1460443219,
+            "tags": ["commented"]
+        })
+
+    def test_update_deleted_thread(self):
+        self.mock_db_batch_get.return_value = ([{
+            "user_id": 333333,
+            "thread_id": 1,
+            "deleted_at": 1460443300,
+            "expires_at": 1461048100
+        }], [])
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("update_threads")
+        put_items = self.mock_db_batch_write.call_args[1].get('put_items')
+        put_items = dict((i['thread_id'], i) for i in put_items)
+        self.assertFalse('deleted_at' in put_items[1])
+        self.assertFalse('expires_at' in put_items[1])
+
+    def test_update_threads_unprocessed(self):
+        self.mock_db_batch_get.return_value = ([], [{"thread_id": 1}])
+        self.mock_db_batch_write.return_value = [
+            {"PutRequest": {"Item": {"thread_id": 2}}}
+        ]
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_threads")
+        put_items = self.mock_db_batch_write.call_args[1].get('put_items')
+        self.assertEqual([i['thread_id'] for i in put_items], [2])
+        self.assertEqual(
+            [r['status'] for r in self.results(result_json)],
+            [500, 500, 400, 400, 400]
+        )
+
+    def test_update_threads_datastore_error(self):
+        self.mock_db_batch_write.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("update_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error updating threads in the datastore"
+        )
+
+    def test_delete_threads(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("delete_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(result_json.get('data').get('meta').get('message'),
+                         "1 of 5 threads deleted successfully")
+        self.assertEqual(
+            self.results(result_json)[:2],
+            [{"id": 1, "status": 200},
+             {"id": 2, "status": 409, "detail": "Thread 2 does not exist"}]
+        )
+        tombstones = self.mock_db_batch_write.call_args[1].get('put_items')
+        self.assertEqual(len(tombstones), 1)
+        self.assertEqual(tombstones[0].get('user_id'), 333333)
+        self.assertEqual(tombstones[0].get('thread_id'), 1)
+        self.assertEqual(tombstones[0].get('change_version'), 12)
+        self.assertTrue(tombstones[0].get('deleted_at'))
+        self.assertEqual(
+            self.mock_db_batch_get.call_args[1].get('projection'),
+            ["user_id", "thread_id", "deleted_at", "reason", "tags",
+             "github_etag", "github_last_modified"]
+        )
+
+    def test_delete_deleted_thread(self):
+        self.mock_db_batch_get.return_value = ([{
+            "user_id": 333333,
+            "thread_id": 1,
+            "deleted_at": 1460443300
+        }], [])
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("delete_threads")
+        self.assertEqual(self.results(result_json)[0], {
+            "id": 1,
+            "status": 409,
+            "detail": "Thread 1 does not exist"
+        })
+        self.assertEqual(self.mock_db_update.mock_calls, [])
+
+    def test_delete_threads_unprocessed(self):
+        self.mock_db_batch_write.return_value = [
+            {"PutRequest": {"Item": {"user_id": 333333, "thread_id": 1}}}
+        ]
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("delete_threads")
+        self.assertEqual(self.results(result_json)[0], {
+            "id": 1,
+            "status": 500,
+            "detail": "Error writing thread 1 to the datastore"
+        })
+
+    def test_delete_threads_datastore_error(self):
+        self.mock_db_batch_get.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("delete_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error deleting threads from the datastore"
+        )
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 0)
@@ -0,0 +1,55 @@
+import unittest
+from mock import patch
+from notification_backend.cache import LRUCache
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.cache.time.time')
+        self.addCleanup(patcher1.stop)
+        self.mock_time = patcher1.start()
+        self.mock_time.return_value = 1000
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get("one"), None)
+        cache.set("one", 1)
+        self.assertEqual(cache.get("one"), 1)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(2)
+        cache.set("one", 1)
+        cache.set("two", 2)
+        cache.get("one")
+        cache.set("three", 3)
+        self.assertEqual(cache.get("two"), None)
+        self.assertEqual(cache.get("one"), 1)
+        self.assertEqual(cache.get("three"), 3)
+
+    def test_expires_at(self):
+        cache = LRUCache(10)
+        cache.set("one", 1, expires_at=1010)
+        self.mock_time.return_value = 1009
+        self.assertEqual(cache.get("one"), 1)
+        self.mock_time.return_value = 1010
+        self.assertEqual(cache.get("one"), None)
+        self.assertEqual(cache.stats().get('size'), 0)
+
+    def test_default_ttl(self):
+        cache = LRUCache(10, ttl=30)
+        cache.set("one", 1)
+        self.mock_time.return_value = 1029
+        self.assertEqual(cache.get("one"), 1)
+        self.mock_time.return_value = 1030
+        self.assertEqual(cache.get("one"), None)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(10)
+        cache.set("one", 1)
+        cache.set("two", 2)
+        cache.delete("one")
+        self.assertEqual(cache.get("one"), None)
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0})
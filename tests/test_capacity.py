@@ -0,0 +1,202 @@
+import unittest
+import json
+import threading
+import jwt
+from mock import patch
+from notification_backend.entrypoint import handler
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.http import dynamodb_capacity
+from notification_backend.capacity import CapacityUsage
+from notification_backend.capacity import CapacityAccounts
+from notification_backend.capacity import current_usage
+from notification_backend.capacity import start_metering
+from notification_backend.capacity import stop_metering
+from notification_backend.invocation import bind_invocation
+
+
+class TestCapacity(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(stop_metering)
+        self.accounts = CapacityAccounts(10, 60, 100)
+
+    def usage(self, route, user_id, read_units, write_units=0.0):
+        usage = CapacityUsage()
+        usage.route = route
+        usage.user_id = user_id
+        usage.add("fakethreads", read_units, write_units)
+        return usage
+
+    def test_usage_by_table(self):
+        usage = CapacityUsage()
+        usage.add("fakethreads", read_units=2.5)
+        usage.add("fakethreads", write_units=1.0)
+        usage.add("faketags", write_units=3.0)
+        self.assertEqual(usage.totals(), (2.5, 4.0))
+        self.assertEqual(usage.summary(), {
+            "read-units": 2.5,
+            "write-units": 4.0,
+            "tables": {
+                "fakethreads": {"read-units": 2.5, "write-units": 1.0},
+                "faketags": {"read-units": 0.0, "write-units": 3.0}
+            }
+        })
+
+    def test_totals_by_route(self):
+        self.accounts.record(self.usage("find_all_threads", "1", 4.0))
+        self.accounts.record(self.usage("find_all_threads", "2", 2.0))
+        self.accounts.record(self.usage("update_thread", "1", 0.5, 1.0))
+        self.accounts.unattributed.add("fakethreads", write_units=2.0)
+        stats = self.accounts.stats()
+        self.assertEqual(stats['routes'], {
+            "find_all_threads": {
+                "invocations": 2,
+                "read_units": 6.0,
+                "write_units": 0.0
+            },
+            "update_thread": {
+                "invocations": 1,
+                "read_units": 0.5,
+                "write_units": 1.0
+            }
+        })
+        self.assertEqual(stats['unattributed_read_units'], 0.0)
+        self.assertEqual(stats['unattributed_write_units'], 2.0)
+        self.assertEqual(stats['users'], 2)
+
+    def test_read_budget(self):
+        self.accounts.record(self.usage("find_all_threads", "1", 6.0))
+        self.assertEqual(self.accounts.retry_after("1"), None)
+        self.accounts.record(self.usage("find_all_threads", "1", 6.0))
+        self.assertTrue(59 < self.accounts.retry_after("1") <= 60)
+        # Other users have budgets of their own
+        self.assertEqual(self.accounts.retry_after("2"), None)
+        self.assertEqual(self.accounts.stats()['rejected'], 1)
+
+    def test_read_budget_window_over(self):
+        self.accounts.record(self.usage("find_all_threads", "1", 12.0))
+        with patch('notification_backend.capacity.time.time') as mock_time, \
+                patch('notification_backend.cache.time.time') as mock_cache_time:  # NOQA
+            mock_time.return_value = mock_cache_time.return_value = \
+                self.accounts.user_window("1")[0] + 61
+            self.assertEqual(self.accounts.retry_after("1"), None)
+
+    def test_no_read_budget(self):
+        accounts = CapacityAccounts(0, 60, 100)
+        accounts.record(self.usage("find_all_threads", "1", 1000.0))
+        self.assertEqual(accounts.retry_after("1"), None)
+
+    def test_usage_bound_to_other_threads(self):
+        usage = start_metering()
+        worker = threading.Thread(
+            target=bind_invocation(lambda: current_usage().add("fakethreads", 1.5))  # NOQA
+        )
+        worker.start()
+        worker.join()
+        self.assertEqual(usage.totals(), (1.5, 0.0))
+
+
+class TestRouteCapacity(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        patcher2 = patch.object(dynamodb_capacity, 'read_budget', 10)
+        self.addCleanup(patcher2.stop)
+        patcher2.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        dynamodb_capacity.reset()
+        self.addCleanup(dynamodb_capacity.reset)
+
+        engine = storage_engine("http://example.com")
+        engine.create_table("fakethreads",
+                            [("user_id", "N"), ("thread_id", "N")])
+        engine.put_item("fakethreads", {
+            "user_id": 333333,
+            "thread_id": 123456,
+            "reason": "mention",
+            "updated_at": 1460443217,
+            "tags": ["mentioned"]
+        })
+        token = jwt.encode({"sub": "333333"}, "shhsekret", algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": "shhsekret",
+            "bearer_token": "Bearer %s" % token,
+            "resource-path": "/notification/threads/export",
+            "http-method": "GET",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"  # NOQA
+        }
+
+    def spend(self, read_units):
+        usage = CapacityUsage()
+        usage.user_id = "333333"
+        usage.add("fakethreads", read_units)
+        dynamodb_capacity.record(usage)
+
+    def test_within_budget(self):
+        self.spend(5.0)
+        result = handler(self.lambda_event, {})
+        self.assertEqual(result.get('http_status'), 200)
+        routes = dynamodb_capacity.stats()['routes']
+        self.assertEqual(routes['export_threads']['invocations'], 1)
+
+    def test_over_budget(self):
+        self.spend(10.0)
+        with self.assertRaises(TypeError) as cm:
+            handler(self.lambda_event, {})
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 429)
+        self.assertTrue(0 < int(result_json['headers']['Retry-After']) <= 60)
+        self.assertEqual(dynamodb_capacity.stats()['rejected'], 1)
+
+        # Only list queries get turned away
+        self.lambda_event.update({
+            "resource-path": "/notification/threads/{thread-id}",
+            "threadid": "123456"
+        })
+        result = handler(self.lambda_event, {})
+        self.assertEqual(result.get('http_status'), 200)
+
+    def test_capacity_logged(self):
+        def export_threads():
+            current_usage().add("fakethreads", read_units=3.0)
+            return {"http_status": 200, "data": ""}
+
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            with patch('notification_backend.notification_threads.NotificationThreads.export_threads') as mock_export:  # NOQA
+                mock_export.side_effect = export_threads
+                handler(self.lambda_event, {})
+        logged = json.loads(mock_logger.info.call_args[0][0])
+        self.assertEqual(logged['capacity']['route'], "export_threads")
+        self.assertEqual(logged['capacity']['user-id'], "333333")
+        self.assertEqual(logged['capacity']['read-units'], 3.0)
+        self.assertEqual(current_usage(), None)
+
+        routes = dynamodb_capacity.stats()['routes']
+        self.assertEqual(routes['export_threads']['read_units'], 3.0)
+
+        # ...and counts towards the user's budget
+        self.spend(7.0)
+        with self.assertRaises(TypeError):
+            handler(self.lambda_event, {})
+
+    def test_streamed_capacity(self):
+        def export_threads():
+            def lines():
+                current_usage().add("fakethreads", read_units=2.0)
+                yield "{}\n"
+            return {"http_status": 200, "stream": lines()}
+
+        self.lambda_event['stream_response'] = True
+        with patch('notification_backend.notification_threads.NotificationThreads.export_threads') as mock_export:  # NOQA
+            mock_export.side_effect = export_threads
+            result = handler(self.lambda_event, {})
+            self.assertEqual(dynamodb_capacity.stats()['routes'], {})
+            self.assertEqual(list(result['stream']), ["{}\n"])
+        routes = dynamodb_capacity.stats()['routes']
+        self.assertEqual(routes['export_threads']['read_units'], 2.0)
+        self.assertEqual(current_usage(), None)
@@ -0,0 +1,117 @@
+import unittest
+from mock import patch
+from boto3.dynamodb.conditions import Attr
+from benchmarks.dataset import generate_threads
+from benchmarks.dataset import write_dataset
+from benchmarks.dataset import EDITED_TAGS
+from benchmarks.dataset import REASONS
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.notification_threads import determine_list_of_tags
+
+
+NOW = 1460500000
+WEEK = 604800
+
+
+class TestDataset(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        self.engine = storage_engine("http://example.com")
+        self.engine.create_table("threads",
+                                 [("user_id", "N"), ("thread_id", "N")])
+        self.engine.create_table("tags",
+                                 [("index_key", "S"), ("thread_id", "N")])
+
+    def write(self, user_ids, threads_per_user, seed=0, deleted_share=0.02):
+        return list(write_dataset("http://example.com",
+                                  "threads",
+                                  user_ids,
+                                  threads_per_user,
+                                  seed=seed,
+                                  now=NOW,
+                                  tag_table_name="tags",
+                                  deleted_share=deleted_share))
+
+    def stored_items(self, user_id):
+        items, _ = self.engine.scan("threads",
+                                    filter_expression=Attr('user_id').eq(user_id))  # NOQA
+        return items
+
+    def stored_threads(self, user_id):
+        return [i for i in self.stored_items(user_id)
+                if i['thread_id'] != 0 and 'deleted_at' not in i]
+
+    def test_same_seed_same_items(self):
+        self.assertEqual(self.write([1, 2], 50, seed=7), [(1, 50), (2, 50)])
+        written = self.stored_items(2)
+        self.assertEqual(len(written), 51)
+
+        # Whatever other users get generated along with them
+        self.assertEqual(generate_threads(2, 50, seed=7, now=NOW),
+                         sorted((i for i in written if i['thread_id'] != 0),
+                                key=lambda i: i['change_version']))
+        self.assertNotEqual(generate_threads(2, 50, seed=8, now=NOW),
+                            generate_threads(2, 50, seed=7, now=NOW))
+
+    def test_recent_updates(self):
+        self.write([1], 1000)
+        ages = sorted(NOW - int(i['updated_at'])
+                      for i in self.stored_threads(1))
+        # Most of six months' worth of notifications are from the last week
+        recent = len([a for a in ages if a < WEEK])
+        self.assertTrue(recent > len(ages) * 0.55)
+        self.assertTrue(ages[-1] > WEEK * 20)
+
+    def test_user_version(self):
+        self.write([1], 500)
+        items = self.stored_items(1)
+        metadata = [i for i in items if i['thread_id'] == 0][0]
+        change_versions = [i['change_version'] for i in items
+                           if i['thread_id'] != 0]
+        self.assertEqual(metadata['user_version'], max(change_versions))
+        self.assertEqual(sorted(change_versions), range(1, 501))
+
+    def test_tombstones(self):
+        self.write([1], 200, deleted_share=0.5)
+        tombstones = [i for i in self.stored_items(1) if 'deleted_at' in i]
+        self.assertTrue(50 < len(tombstones) < 150)
+        for tombstone in tombstones:
+            self.assertEqual(tombstone['expires_at'] - tombstone['deleted_at'], WEEK)  # NOQA
+            self.assertTrue(NOW - WEEK <= tombstone['deleted_at'] <= NOW)
+            self.assertFalse('updated_at' in tombstone)
+            self.assertFalse('tags' in tombstone)
+
+    def test_tags(self):
+        self.write([1], 1000)
+        threads = self.stored_threads(1)
+        reason_tags = dict(
+            (reason, determine_list_of_tags({
+                "reason": reason,
+                "subject_type": "Issue",
+                "repository_owner": "octocat",
+                "repository_name": "left-pad"
+            })[0])
+            for reason, _ in REASONS
+        )
+        # Every reason comes with its tag, and each of them shows up
+        for thread in threads:
+            self.assertEqual(thread['tags'][0], reason_tags[thread['reason']])  # NOQA
+            self.assertFalse(None in thread['tags'])
+        self.assertEqual(set(t['tags'][0] for t in threads),
+                         set(reason_tags.values()))
+        watching = len([t for t in threads if t['tags'][0] == "watching"])
+        self.assertTrue(0.4 < float(watching) / len(threads) < 0.5)
+        # Some of them have been tagged by the user on top of that
+        edited = len([t for t in threads if t['tags'][-1] in EDITED_TAGS])
+        self.assertTrue(0.07 < float(edited) / len(threads) < 0.13)
+
+        # Listed in the tag index under each of them
+        rows, _ = self.engine.scan("tags")
+        self.assertEqual(len(rows),
+                         sum(len(t['tags']) + 1 for t in threads))
@@ -10,9 +10,21 @@ from botocore.exceptions import ClientError
 class TestDeleteThread(unittest.TestCase):
 
     def setUp(self):
-        patcher1 = patch('notification_backend.notification_threads.dynamodb_delete_item')  # NOQA
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_new_item')  # NOQA
         self.addCleanup(patcher1.stop)
-        self.mock_db_delete = patcher1.start()
+        self.mock_db_new_item = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_update = patcher2.start()
+        self.mock_db_update.return_value = {
+            "Attributes": {"user_version": 8}
+        }
+
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_get_item')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_get_item = patcher3.start()
+        self.mock_db_get_item.return_value = {"thread_id": 123456}
 
         self.jwt_signing_secret = "shhsekret"
         self.token = jwt.encode({"sub": "1234"},
@@ -50,8 +62,23 @@ class TestDeleteThread(unittest.TestCase):
         }
 
     def test_thread_does_not_exist(self):
+        for stored in [None, {"thread_id": 123456, "deleted_at": 3332400}]:
+            self.mock_db_get_item.return_value = stored
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("delete_thread")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 409)
+        self.assertEqual(self.mock_db_get_item.call_args[1].get('projection'),
+                         ["thread_id", "deleted_at", "github_etag",
+                          "github_last_modified"])
+        # No change version got handed out for a delete that didn't happen
+        self.assertEqual(len(self.mock_db_update.mock_calls), 0)
+        self.assertEqual(len(self.mock_db_new_item.mock_calls), 0)
+
+    def test_thread_deleted_meanwhile(self):
         ce = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "OperationName")  # NOQA
-        self.mock_db_delete.side_effect = ce
+        self.mock_db_new_item.side_effect = ce
         t = NotificationThreads(self.lambda_event)
         with self.assertRaises(TypeError) as cm:
             t.process_thread_event("delete_thread")
@@ -65,11 +92,11 @@ class TestDeleteThread(unittest.TestCase):
             result_json.get('data').get('errors')[0].get('detail'),
             "Thread 123456 does not exist"
         )
-        self.assertTrue(self.mock_db_delete.mock_calls > 0)
+        self.assertTrue(self.mock_db_new_item.mock_calls > 0)
 
     def test_error_querying_datastore_clienterror(self):
         ce = ClientError({"Error": {"Code": "random"}}, "OperationName")  # NOQA
-        self.mock_db_delete.side_effect = ce
+        self.mock_db_new_item.side_effect = ce
         t = NotificationThreads(self.lambda_event)
         with self.assertRaises(TypeError) as cm:
             t.process_thread_event("delete_thread")
@@ -83,10 +110,10 @@ class TestDeleteThread(unittest.TestCase):
             result_json.get('data').get('errors')[0].get('detail'),
             "Error deleting thread 123456 from the datastore"
         )
-        self.assertTrue(self.mock_db_delete.mock_calls > 0)
+        self.assertTrue(self.mock_db_new_item.mock_calls > 0)
 
     def test_error_querying_datastore_boto3error(self):
-        self.mock_db_delete.side_effect = Boto3Error
+        self.mock_db_new_item.side_effect = Boto3Error
         t = NotificationThreads(self.lambda_event)
         with self.assertRaises(TypeError) as cm:
             t.process_thread_event("delete_thread")
@@ -100,7 +127,7 @@ class TestDeleteThread(unittest.TestCase):
             result_json.get('data').get('errors')[0].get('detail'),
             "Error deleting thread 123456 from the datastore"
         )
-        self.assertTrue(self.mock_db_delete.mock_calls > 0)
+        self.assertTrue(self.mock_db_new_item.mock_calls > 0)
 
     def test_delete_thread(self):
         t = NotificationThreads(self.lambda_event)
@@ -108,4 +135,28 @@ class TestDeleteThread(unittest.TestCase):
         self.assertEqual(result_json.get('http_status'), 200)
         self.assertEqual(result_json.get('data').get('meta').get('message'),
                          'Thread 123456 successfully deleted')
-        self.assertTrue(self.mock_db_delete.mock_calls > 0)
+        self.assertEqual(self.mock_db_update.call_args[1].get('key'),
+                         {"user_id": "1234", "thread_id": 0})
+        self.assertEqual(self.mock_db_update.call_args[1].get('update_expression'),  # NOQA
+                         "add user_version :n set changed_at=:now")
+        tombstone = self.mock_db_new_item.call_args[0][2]
+        self.assertEqual(tombstone.get('thread_id'), 123456)
+        self.assertEqual(tombstone.get('change_version'), 8)
+        self.assertTrue('changed_at' in tombstone)
+        self.assertEqual(tombstone.get('expires_at') - tombstone.get('deleted_at'), 604800)  # NOQA
+        self.assertFalse('updated_at' in tombstone)
+        self.assertFalse('github_etag' in tombstone)
+
+    def test_tombstone_keeps_github_validators(self):
+        self.mock_db_get_item.return_value = {
+            "thread_id": 123456,
+            "github_etag": '"abc"',
+            "github_last_modified": "Tue, 12 Apr 2016 01:40:17 GMT"
+        }
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("delete_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        tombstone = self.mock_db_new_item.call_args[0][2]
+        self.assertEqual(tombstone.get('github_etag'), '"abc"')
+        self.assertEqual(tombstone.get('github_last_modified'),
+                         "Tue, 12 Apr 2016 01:40:17 GMT")
@@ -2,7 +2,9 @@ import unittest
 import logging
 from mock import patch
 from mock import call
+from mock import MagicMock
 from notification_backend.entrypoint import handler
+from notification_backend.http import dynamodb_retry_policy
 import json
 
 
@@ -12,6 +14,10 @@ class TestEntrypoint(unittest.TestCase):
         patcher2 = patch('notification_backend.entrypoint.NotificationThreads')
         self.addCleanup(patcher2.stop)
         self.mock_notif_threads = patcher2.start()
+        self.mock_notif_threads.return_value.process_thread_event.return_value = {  # NOQA
+            "http_status": 200,
+            "data": {"data": []}
+        }
 
     def test_log_level_warning(self):
         logger = logging.getLogger("notification_backend")
@@ -71,6 +77,97 @@ class TestEntrypoint(unittest.TestCase):
         self.assertTrue(call().process_thread_event('find_all_threads') in self.mock_notif_threads.mock_calls)  # NOQA
         self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
 
+    def test_export_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/threads/export",
+            "http-method": "GET"
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('export_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_sync_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/sync",
+            "http-method": "POST"
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('sync_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_find_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/threads",
+            "http-method": "GET",
+            "qs_filter_id": "1,2,3",
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('find_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_find_filtered_threads_endpoint(self):
+        for qs in [{"qs_filter_tag": "mentioned"},
+                   {"qs_filter_reason": "mention"}]:
+            self.mock_notif_threads.reset_mock()
+            event = {
+                "resource-path": "/notification/threads",
+                "http-method": "GET"
+            }
+            event.update(qs)
+            handler(event, {})
+            self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)  # NOQA
+            self.assertTrue(call().process_thread_event('find_filtered_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+            self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_queued_writes_flushed(self):
+        with patch('notification_backend.entrypoint.write_behind_queue') as mock_queue:  # NOQA
+            mock_queue.running.return_value = False
+            # ...even when the request fails
+            with self.assertRaises(TypeError):
+                handler({"resource-path": "/fake"}, {})
+            self.assertEqual(len(mock_queue.flush.mock_calls), 1)
+
+            # server.py flushes them in the background instead
+            mock_queue.running.return_value = True
+            handler({"resource-path": "/notification/threads",
+                     "http-method": "GET"}, {})
+            self.assertEqual(len(mock_queue.flush.mock_calls), 1)
+
+    def test_queued_writes_flushed_within_deadline(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 3000
+        time_left = []
+        with patch('notification_backend.entrypoint.write_behind_queue') as mock_queue:  # NOQA
+            mock_queue.running.return_value = False
+            mock_queue.flush.side_effect = lambda: time_left.append(dynamodb_retry_policy.time_left())  # NOQA
+            handler({"resource-path": "/notification/threads",
+                     "http-method": "GET"}, context)
+        self.assertTrue(0 < time_left[0] <= 2.5)
+        self.assertEqual(dynamodb_retry_policy.time_left(), None)
+
+    def test_dynamodb_retry_deadline(self):
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 3000
+        with patch('notification_backend.entrypoint.dynamodb_retry_policy') as mock_policy:  # NOQA
+            handler({"resource-path": "/notification/threads",
+                     "http-method": "GET"}, context)
+            self.assertEqual(mock_policy.set_deadline.mock_calls,
+                             [call(3.0), call(None)])
+
+    def test_find_changed_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/threads",
+            "http-method": "GET",
+            "qs_since": "token",
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('find_changed_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
     def test_update_thread_endpoint_qs(self):
         event = {
             "resource-path": "/notification/threads/{thread-id}",
@@ -92,3 +189,97 @@ class TestEntrypoint(unittest.TestCase):
         self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
         self.assertTrue(call().process_thread_event('delete_thread') in self.mock_notif_threads.mock_calls)  # NOQA
         self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_update_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/threads",
+            "http-method": "PATCH"
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('update_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_delete_threads_endpoint(self):
+        event = {
+            "resource-path": "/notification/threads",
+            "http-method": "DELETE"
+        }
+        handler(event, {})
+        self.assertTrue(call(event) in self.mock_notif_threads.mock_calls)
+        self.assertTrue(call().process_thread_event('delete_threads') in self.mock_notif_threads.mock_calls)  # NOQA
+        self.assertEqual(len(self.mock_notif_threads.mock_calls), 2)
+
+    def test_debug_timings(self):
+        event = {
+            "resource-path": "/notification/ping",
+            "http-method": "GET",
+            "debug_timings": "1"
+        }
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            result = handler(event, {})
+        timings = result.get('data').get('meta').get('timings')
+        self.assertTrue(timings.get('total-ms') >= 0)
+        self.assertTrue("write_behind_flush" in timings.get('spans'))
+
+        # Along with a log line for the invocation
+        trace = json.loads(mock_logger.info.call_args[0][0]).get('trace')
+        self.assertEqual(trace.get('resource-path'), "/notification/ping")
+        self.assertEqual(trace.get('http-status'), 200)
+        self.assertEqual(trace.get('spans'), timings.get('spans'))
+
+    def test_debug_timings_error(self):
+        with self.assertRaises(TypeError) as cm:
+            handler({"resource-path": "/", "debug_timings": "1"}, {})
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+        self.assertTrue("timings" in result_json.get('data').get('meta'))
+
+    @patch('notification_backend.entrypoint.TRACE_SAMPLE_RATE', 1)
+    def test_sampled_invocations_logged(self):
+        event = {
+            "resource-path": "/notification/ping",
+            "http-method": "GET"
+        }
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            result = handler(event, {})
+        self.assertFalse("timings" in result.get('data').get('meta'))
+        trace = json.loads(mock_logger.info.call_args[0][0]).get('trace')
+        self.assertEqual(trace.get('http-status'), 200)
+
+    def test_not_traced(self):
+        event = {
+            "resource-path": "/notification/ping",
+            "http-method": "GET"
+        }
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            with patch('notification_backend.entrypoint.start_trace') as mock_start:  # NOQA
+                result = handler(event, {})
+        self.assertFalse("timings" in result.get('data').get('meta'))
+        self.assertEqual(len(mock_start.mock_calls), 0)
+
+        # Still logged, without the spans
+        logged = json.loads(mock_logger.info.call_args[0][0])
+        self.assertEqual(logged.get('invocation').get('resource-path'),
+                         "/notification/ping")
+        self.assertEqual(logged.get('invocation').get('http-method'), "GET")
+        self.assertEqual(logged.get('invocation').get('http-status'), 200)
+        self.assertTrue(logged.get('invocation').get('total-ms') >= 0)
+        self.assertFalse("trace" in logged)
+
+    def test_not_traced_error_logged(self):
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            with self.assertRaises(TypeError):
+                handler({"resource-path": "/", "http-method": "GET"}, {})
+        logged = json.loads(mock_logger.info.call_args[0][0])
+        self.assertEqual(logged.get('invocation').get('http-status'), 400)
+
+        self.mock_notif_threads.side_effect = TypeError("not a response")
+        with patch('notification_backend.entrypoint.logger') as mock_logger:
+            with self.assertRaises(TypeError):
+                handler({
+                    "resource-path": "/notification/threads/{thread-id}",
+                    "http-method": "GET"
+                }, {})
+        logged = json.loads(mock_logger.info.call_args[0][0])
+        self.assertEqual(logged.get('invocation').get('http-status'), 500)
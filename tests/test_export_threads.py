@@ -0,0 +1,156 @@
+import unittest
+import json
+import jwt
+from decimal import Decimal
+from mock import patch
+from boto3.exceptions import Boto3Error
+from notification_backend.notification_threads import NotificationThreads
+
+
+class TestExportThreads(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_results')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_results = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_parallel_scan_results')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_scan = patcher2.start()
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {},
+            "resource-path": "/notification/threads/export",
+            "stream_response": True,
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"  # NOQA
+        }
+        self.threads = [
+            {
+                "thread_id": Decimal(1),
+                "thread_url": "http://api.example.com/fake/1",
+                "thread_subscription_url": "http://api.example.com/fake/1/subscribe",  # NOQA
+                "reason": "subscribed",
+                "updated_at": Decimal(1460443217),
+                "tags": ["watching"]
+            },
+            {
+                "thread_id": Decimal(2),
+                "deleted_at": Decimal(1460443300)
+            },
+            {
+                "thread_id": Decimal(3),
+                "thread_url": "http://api.example.com/fake/3",
+                "thread_subscription_url": "http://api.example.com/fake/3/subscribe",  # NOQA
+                "reason": "mention",
+                "updated_at": Decimal(1460443000),
+                "tags": ["mentioned"]
+            }
+        ]
+
+    def test_streamed_export(self):
+        self.mock_db_results.return_value = iter(self.threads)
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("export_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(result_json.get('headers'),
+                         {"Content-Type": "application/x-ndjson"})
+        lines = list(result_json.get('stream'))
+        # Tombstones of deleted threads are left out
+        self.assertEqual([json.loads(l).get('id') for l in lines], [1, 3])
+        self.assertTrue(all(l.endswith("\n") for l in lines))
+        self.assertEqual(json.loads(lines[0]).get('attributes').get('reason'),  # NOQA
+                         "subscribed")
+        self.assertEqual(self.mock_db_results.call_args[0][:2],
+                         ("http://example.com", "fakethreads"))
+        self.assertEqual(
+            self.mock_db_results.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags", "deleted_at"]  # NOQA
+        )
+        self.assertEqual(len(self.mock_db_scan.mock_calls), 0)
+
+    def test_export_read_lazily(self):
+        def results():
+            yield self.threads[0]
+            raise Boto3Error
+        self.mock_db_results.return_value = results()
+        t = NotificationThreads(self.lambda_event)
+        stream = t.process_thread_event("export_threads").get('stream')
+        self.assertEqual(json.loads(stream.next()).get('id'), 1)
+        with self.assertRaises(Boto3Error):
+            stream.next()
+
+    def test_unstreamed_export(self):
+        self.mock_db_results.return_value = iter(self.threads)
+        self.lambda_event['stream_response'] = None
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("export_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        lines = result_json.get('data').splitlines()
+        self.assertEqual([json.loads(l).get('id') for l in lines], [1, 3])
+
+    def test_empty_export(self):
+        self.mock_db_results.return_value = iter([])
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("export_threads")
+        self.assertEqual(list(result_json.get('stream')), [])
+
+    @patch('notification_backend.notification_threads.MAX_EXPORT_SEGMENTS', 8)  # NOQA
+    def test_segmented_export(self):
+        self.mock_db_scan.return_value = iter(self.threads)
+        self.lambda_event['qs_segments'] = "4"
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("export_threads")
+        lines = list(result_json.get('stream'))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(self.mock_db_scan.call_args[0],
+                         ("http://example.com", "fakethreads", 4))
+        self.assertEqual(len(self.mock_db_results.mock_calls), 0)
+
+    def test_segments_not_enabled(self):
+        self.lambda_event['qs_segments'] = "4"
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("export_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Segmented exports are not enabled"
+        )
+        self.assertEqual(len(self.mock_db_scan.mock_calls), 0)
+
+    @patch('notification_backend.notification_threads.MAX_EXPORT_SEGMENTS', 8)  # NOQA
+    def test_invalid_segments(self):
+        for segments in ["0", "9", "fake"]:
+            self.lambda_event['qs_segments'] = segments
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("export_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'segments' parameter needs to be an integer between 1 and 8"
+            )
+
+    def test_datastore_error(self):
+        def results():
+            raise Boto3Error
+            yield
+        self.mock_db_results.return_value = results()
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("export_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error querying the datastore"
+        )
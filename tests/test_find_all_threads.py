@@ -2,16 +2,19 @@ import unittest
 import json
 import jwt
 import time
+from decimal import Decimal
 from datetime import datetime
 from mock import patch
 from boto3.exceptions import Boto3Error
 from notification_backend.notification_threads import NotificationThreads
+from notification_backend.http import encode_pagination_cursor
+from notification_backend.http import decode_pagination_cursor
 
 
 class TestFindAllThreads(unittest.TestCase):
 
     def setUp(self):
-        patcher1 = patch('notification_backend.notification_threads.dynamodb_results')  # NOQA
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_query')  # NOQA
         self.addCleanup(patcher1.stop)
         self.mock_db_results = patcher1.start()
 
@@ -20,6 +23,14 @@ class TestFindAllThreads(unittest.TestCase):
         self.mock_time = patcher2.start()
         self.mock_time.return_value = time.mktime(datetime(2016, 1, 10).timetuple())  # NOQA
 
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_get_item')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_get_item = patcher3.start()
+        self.mock_db_get_item.return_value = {
+            "user_version": Decimal(3),
+            "changed_at": Decimal(1460443000)
+        }
+
         self.jwt_signing_secret = "shhsekret"
         self.token = jwt.encode({"sub": "333333"},
                                 self.jwt_signing_secret,
@@ -36,7 +47,7 @@ class TestFindAllThreads(unittest.TestCase):
         self.backlog_time_limit = 2592000 * 6  # 6 months, in seconds
         self.default_backlog_search_time = 604800  # 1 week, in seconds
 
-        self.mock_db_results.return_value = [{
+        self.mock_db_results.return_value = ([{
             "thread_id": 12345678,
             "thread_url": "http://api.example.com/fake/12345678",
             "thread_subscription_url": "http://api.example.com/fake/12345678/subscribe",  # NOQA
@@ -47,7 +58,7 @@ class TestFindAllThreads(unittest.TestCase):
             "subject_type": "Issue",
             "repository_owner": "octocat",
             "repository_name": "left-pad"
-        }]
+        }], None)
 
     def test_invalid_from_date(self):
         self.lambda_event['qs_from'] = "faketest"
@@ -103,3 +114,168 @@ class TestFindAllThreads(unittest.TestCase):
             result_json.get('data').get('errors')[0].get('detail'),
             "Error querying the datastore"
         )
+
+    def test_default_page_size(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_all_threads")
+        self.assertEqual(self.mock_db_results.call_args[1].get('limit'), 100)
+        self.assertEqual(
+            self.mock_db_results.call_args[1].get('exclusive_start_key'),
+            None
+        )
+        self.assertEqual(result_json.get('data').get('links').get('next'),
+                         None)
+
+    def test_invalid_page_size(self):
+        for page_size in ["fake", "0", "501"]:
+            self.lambda_event['qs_page_size'] = page_size
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_all_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'page[size]' parameter needs to be an integer between 1 and 500"  # NOQA
+            )
+        self.assertEqual(len(self.mock_db_results.mock_calls), 0)
+
+    def test_next_link(self):
+        last_key = {
+            "user_id": Decimal(333333),
+            "thread_id": Decimal(12345678),
+            "updated_at": Decimal(1460443217)
+        }
+        self.mock_db_results.return_value = ([], last_key)
+        self.lambda_event['qs_page_size'] = "10"
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_all_threads")
+        next_link = result_json.get('data').get('links').get('next')
+        self.assertEqual(self.mock_db_results.call_args[1].get('limit'), 10)
+        self.assertEqual(
+            next_link,
+            "/notification/threads?from=%s&page[size]=10&page[cursor]=%s" % (
+                t.from_date,
+                encode_pagination_cursor(last_key)
+            )
+        )
+
+    def test_cursor(self):
+        last_key = {
+            "user_id": 333333,
+            "thread_id": 12345678,
+            "updated_at": 1460443217
+        }
+        self.lambda_event['qs_page_cursor'] = encode_pagination_cursor(last_key)  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("find_all_threads")
+        self.assertEqual(
+            self.mock_db_results.call_args[1].get('exclusive_start_key'),
+            last_key
+        )
+
+    def test_invalid_cursor(self):
+        other_user_key = encode_pagination_cursor({
+            "user_id": 444444,
+            "thread_id": 12345678,
+            "updated_at": 1460443217
+        })
+        for cursor in ["fake", "W10", other_user_key]:
+            self.lambda_event['qs_page_cursor'] = cursor
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_all_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'page[cursor]' parameter is not valid"
+            )
+        self.assertEqual(len(self.mock_db_results.mock_calls), 0)
+
+    def test_projection(self):
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("find_all_threads")
+        self.assertEqual(
+            self.mock_db_results.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags"]  # NOQA
+        )
+
+    def test_validators(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_all_threads")
+        headers = result_json.get('headers')
+        self.assertEqual(headers.get('Last-Modified'),
+                         "Tue, 12 Apr 2016 06:40:17 GMT")
+        self.assertTrue(headers.get('ETag').startswith('"'))
+        newest_query = self.mock_db_results.mock_calls[0][2]
+        self.assertEqual(newest_query.get('limit'), 1)
+        self.assertEqual(newest_query.get('scan_index_forward'), False)
+        self.assertEqual(self.mock_db_get_item.call_args[0][2],
+                         {"user_id": "333333", "thread_id": 0})
+
+        # Any change recorded for the user gives the listing a new ETag
+        self.mock_db_get_item.return_value = {
+            "user_version": Decimal(4),
+            "changed_at": Decimal(1460443300)
+        }
+        t = NotificationThreads(self.lambda_event)
+        changed_headers = t.process_thread_event("find_all_threads").get('headers')  # NOQA
+        self.assertNotEqual(changed_headers.get('ETag'), headers.get('ETag'))
+        self.assertEqual(changed_headers.get('Last-Modified'),
+                         "Tue, 12 Apr 2016 06:41:40 GMT")
+
+    def test_change_token(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_all_threads")
+        change_token = result_json.get('data').get('meta').get('change-token')  # NOQA
+        self.assertEqual(decode_pagination_cursor(change_token), {
+            "user_id": "333333",
+            "user_version": 3,
+            "issued_at": self.mock_time.return_value
+        })
+
+    def test_if_none_match(self):
+        t = NotificationThreads(self.lambda_event)
+        etag = t.process_thread_event("find_all_threads").get('headers').get('ETag')  # NOQA
+        self.mock_db_results.reset_mock()
+
+        self.lambda_event['if_none_match'] = 'W/"fake", %s' % etag
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_all_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 304)
+        self.assertEqual(result_json.get('headers').get('ETag'), etag)
+        # Only the newest thread got read, not the page itself
+        self.assertEqual(len(self.mock_db_results.mock_calls), 1)
+
+        self.lambda_event['if_none_match'] = '"fake"'
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_all_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+
+    def test_if_none_match_default_window(self):
+        t = NotificationThreads(self.lambda_event)
+        etag = t.process_thread_event("find_all_threads").get('headers').get('ETag')  # NOQA
+
+        # The default window moved on since, the listing didn't change
+        self.mock_time.return_value += 5
+        self.lambda_event['if_none_match'] = etag
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_all_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 304)
+
+    def test_if_modified_since(self):
+        for since, status in [("Tue, 12 Apr 2016 06:40:17 GMT", 304),
+                              ("Tue, 12 Apr 2016 06:40:16 GMT", 200),
+                              ("fake", 200)]:
+            self.lambda_event['if_modified_since'] = since
+            t = NotificationThreads(self.lambda_event)
+            try:
+                result_json = t.process_thread_event("find_all_threads")
+            except TypeError as e:
+                result_json = json.loads(str(e))
+            self.assertEqual(result_json.get('http_status'), status)
@@ -0,0 +1,182 @@
+import unittest
+import json
+import jwt
+from decimal import Decimal
+from mock import patch
+from boto3.exceptions import Boto3Error
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.http import encode_pagination_cursor
+from notification_backend.http import decode_pagination_cursor
+
+
+class TestFindChangedThreads(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_query')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_query = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.get_current_epoch_time')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_time = patcher2.start()
+        self.mock_time.return_value = 1460500000
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {},
+            "resource-path": "/notification/threads",
+            "qs_since": self.change_token(7, 1460400000),
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads",  # NOQA
+            "notification_user_notification_change_dynamodb_index_name": "fakechanges"  # NOQA
+        }
+        self.mock_db_query.return_value = ([
+            {
+                "thread_id": Decimal(1),
+                "thread_url": "http://api.example.com/fake/1",
+                "thread_subscription_url": "http://api.example.com/fake/1/subscribe",  # NOQA
+                "reason": "subscribed",
+                "updated_at": Decimal(1460443217),
+                "tags": ["watching"],
+                "change_version": Decimal(8)
+            },
+            {
+                "thread_id": Decimal(2),
+                "deleted_at": Decimal(1460443300),
+                "change_version": Decimal(9)
+            }
+        ], None)
+
+    def change_token(self, user_version, issued_at, user_id="333333"):
+        return encode_pagination_cursor({
+            "user_id": user_id,
+            "user_version": user_version,
+            "issued_at": issued_at
+        })
+
+    def test_invalid_token(self):
+        for since in ["fake",
+                      encode_pagination_cursor({"user_id": "333333"}),
+                      self.change_token(7, 1460400000, "444444")]:
+            self.lambda_event['qs_since'] = since
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_changed_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'since' parameter is not a valid change token"
+            )
+        self.assertEqual(len(self.mock_db_query.mock_calls), 0)
+
+    def test_expired_token(self):
+        self.lambda_event['qs_since'] = self.change_token(7, 1459800000)
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_changed_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 410)
+        self.assertEqual(len(self.mock_db_query.mock_calls), 0)
+
+    def test_changes(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_changed_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        data = result_json.get('data')
+        self.assertEqual([d.get('id') for d in data.get('data')], [1])
+        self.assertEqual(data.get('meta').get('deleted'), [2])
+        self.assertEqual(data.get('links').get('next'), None)
+        self.assertEqual(
+            decode_pagination_cursor(data.get('meta').get('change-token')),
+            {"user_id": "333333", "user_version": 9, "issued_at": 1460500000}
+        )
+        self.assertEqual(self.mock_db_query.call_args[1].get('index_name'),
+                         "fakechanges")
+        self.assertEqual(
+            self.mock_db_query.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags", "deleted_at", "change_version", "changed_at"]  # NOQA
+        )
+
+    def test_change_on_its_way(self):
+        # Version 8 got handed out a moment ago, its write hasn't landed
+        self.mock_db_query.return_value = ([
+            {
+                "thread_id": Decimal(2),
+                "deleted_at": Decimal(1460443300),
+                "change_version": Decimal(9),
+                "changed_at": Decimal(1460499990)
+            }
+        ], {"user_id": 333333, "thread_id": 2, "change_version": 9})
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_changed_threads")
+        data = result_json.get('data')
+        self.assertEqual(data.get('meta').get('deleted'), [])
+        self.assertEqual(data.get('links').get('next'), None)
+        self.assertEqual(
+            decode_pagination_cursor(data.get('meta').get('change-token')).get('user_version'),  # NOQA
+            7
+        )
+
+        # Once settled, the missing version isn't waited for any more
+        self.mock_time.return_value = 1460500020
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_changed_threads")
+        data = result_json.get('data')
+        self.assertEqual(data.get('meta').get('deleted'), [2])
+        self.assertEqual(
+            decode_pagination_cursor(data.get('meta').get('change-token')).get('user_version'),  # NOQA
+            9
+        )
+
+    def test_changes_not_enabled(self):
+        self.lambda_event.pop('notification_user_notification_change_dynamodb_index_name')  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_changed_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+        self.assertEqual(len(self.mock_db_query.mock_calls), 0)
+
+    def test_no_changes(self):
+        self.mock_db_query.return_value = ([], None)
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_changed_threads")
+        meta = result_json.get('data').get('meta')
+        self.assertEqual(meta.get('deleted'), [])
+        self.assertEqual(
+            decode_pagination_cursor(meta.get('change-token')).get('user_version'),  # NOQA
+            7
+        )
+
+    def test_next_link(self):
+        self.mock_db_query.return_value = (
+            self.mock_db_query.return_value[0],
+            {"user_id": 333333, "thread_id": 2, "change_version": 9}
+        )
+        self.lambda_event['qs_page_size'] = "2"
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_changed_threads")
+        data = result_json.get('data')
+        self.assertEqual(self.mock_db_query.call_args[1].get('limit'), 2)
+        self.assertEqual(
+            data.get('links').get('next'),
+            "/notification/threads?since=%s&page[size]=2" % data.get('meta').get('change-token')  # NOQA
+        )
+
+    def test_datastore_error(self):
+        self.mock_db_query.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_changed_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error querying the datastore"
+        )
@@ -0,0 +1,196 @@
+import unittest
+import json
+import jwt
+import time
+from decimal import Decimal
+from datetime import datetime
+from mock import patch
+from boto3.exceptions import Boto3Error
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import AttributeBase
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.http import encode_pagination_cursor
+
+
+def describe_condition(condition):
+    # Conditions don't compare equal, what they express does
+    if isinstance(condition, AttributeBase):
+        return condition.name
+    if not hasattr(condition, 'get_expression'):
+        return condition
+    expression = condition.get_expression()
+    return (expression['operator'],
+            [describe_condition(v) for v in expression['values']])
+
+
+class TestFindFilteredThreads(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_query')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_query = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.get_current_epoch_time')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_time = patcher2.start()
+        self.mock_time.return_value = time.mktime(datetime(2016, 1, 10).timetuple())  # NOQA
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {},
+            "resource-path": "/notification/threads",
+            "qs_filter_tag": "mentioned",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads",  # NOQA
+            "notification_user_notification_tag_dynamodb_table_name": "faketags"  # NOQA
+        }
+        self.mock_db_query.return_value = ([{
+            "index_key": "333333#tag:mentioned",
+            "thread_id": Decimal(12345678),
+            "thread_url": "http://api.example.com/fake/12345678",
+            "thread_subscription_url": "http://api.example.com/fake/12345678/subscribe",  # NOQA
+            "reason": "mention",
+            "updated_at": Decimal(1460443217),
+            "tags": ["mentioned", "octocat"]
+        }], None)
+
+    def test_filter_by_tag(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_filtered_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        data = result_json.get('data').get('data')
+        self.assertEqual([d.get('id') for d in data], [12345678])
+        self.assertEqual(data[0].get('attributes').get('tags'),
+                         ["mentioned", "octocat"])
+        self.assertEqual(result_json.get('data').get('links').get('next'),
+                         None)
+
+        # Only the tag index gets read
+        self.assertEqual(len(self.mock_db_query.mock_calls), 1)
+        self.assertEqual(self.mock_db_query.call_args[0][:2],
+                         ("http://example.com", "faketags"))
+        self.assertEqual(
+            describe_condition(self.mock_db_query.call_args[0][2]),
+            describe_condition(Key('index_key').eq("333333#tag:mentioned"))
+        )
+        self.assertEqual(self.mock_db_query.call_args[1].get('limit'), 100)
+        self.assertEqual(
+            self.mock_db_query.call_args[1].get('filter_expression'),
+            None
+        )
+        self.assertEqual(
+            self.mock_db_query.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags"]  # NOQA
+        )
+
+    def test_filter_by_reason(self):
+        self.lambda_event.pop('qs_filter_tag')
+        self.lambda_event['qs_filter_reason'] = "mention"
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("find_filtered_threads")
+        self.assertEqual(
+            describe_condition(self.mock_db_query.call_args[0][2]),
+            describe_condition(Key('index_key').eq("333333#reason:mention"))
+        )
+
+    def test_filter_by_tag_and_reason(self):
+        self.lambda_event['qs_filter_reason'] = "mention"
+        self.lambda_event['qs_from'] = "1452000000"
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("find_filtered_threads")
+        self.assertEqual(
+            describe_condition(self.mock_db_query.call_args[0][2]),
+            describe_condition(Key('index_key').eq("333333#tag:mentioned"))
+        )
+        self.assertEqual(
+            describe_condition(self.mock_db_query.call_args[1].get('filter_expression')),  # NOQA
+            describe_condition(Attr('reason').eq("mention") & Attr('updated_at').gte(1452000000))  # NOQA
+        )
+
+    def test_not_enabled(self):
+        self.lambda_event.pop('notification_user_notification_tag_dynamodb_table_name')  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_filtered_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Filtering threads by tag or reason is not enabled"
+        )
+        self.assertEqual(len(self.mock_db_query.mock_calls), 0)
+
+    def test_next_link(self):
+        last_key = {
+            "index_key": "333333#tag:mentioned",
+            "thread_id": Decimal(12345678)
+        }
+        self.mock_db_query.return_value = ([], last_key)
+        self.lambda_event['qs_filter_reason'] = "team mention"
+        self.lambda_event['qs_page_size'] = "10"
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_filtered_threads")
+        self.assertEqual(
+            result_json.get('data').get('links').get('next'),
+            "/notification/threads?filter[tag]=mentioned&filter[reason]=team%%20mention&page[size]=10&page[cursor]=%s" % encode_pagination_cursor(last_key)  # NOQA
+        )
+
+    def test_cursor(self):
+        last_key = {
+            "index_key": "333333#tag:mentioned",
+            "thread_id": 12345678
+        }
+        self.lambda_event['qs_page_cursor'] = encode_pagination_cursor(last_key)  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("find_filtered_threads")
+        self.assertEqual(
+            self.mock_db_query.call_args[1].get('exclusive_start_key'),
+            last_key
+        )
+
+    def test_invalid_cursor(self):
+        other_user_key = encode_pagination_cursor({
+            "index_key": "444444#tag:mentioned",
+            "thread_id": 12345678
+        })
+        other_tag_key = encode_pagination_cursor({
+            "index_key": "333333#tag:watching",
+            "thread_id": 12345678
+        })
+        for cursor in ["fake", other_user_key, other_tag_key]:
+            self.lambda_event['qs_page_cursor'] = cursor
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_filtered_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'page[cursor]' parameter is not valid"
+            )
+        self.assertEqual(len(self.mock_db_query.mock_calls), 0)
+
+    def test_invalid_page_size(self):
+        self.lambda_event['qs_page_size'] = "501"
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_filtered_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+
+    def test_dynamodb_error(self):
+        self.mock_db_query.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_filtered_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error querying the datastore"
+        )
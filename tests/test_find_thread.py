@@ -2,14 +2,30 @@ import unittest
 from mock import patch
 import responses
 from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import github_not_found_cache
+from notification_backend.notification_threads import write_behind_queue
+from notification_backend.github import GitHubRateLimited
+from notification_backend.github import record_rate_limit
+from notification_backend.github import reserve_github_request
+from notification_backend.github import reset_github_rate_limits
 import json
 import jwt
+import time
+from mock import MagicMock
 from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
+from requests.exceptions import ConnectTimeout
 
 
 class TestFindThread(unittest.TestCase):
 
     def setUp(self):
+        github_not_found_cache.clear()
+        # Persisted synchronously, unless a test queues writes on purpose
+        patcher0 = patch.object(write_behind_queue, 'max_size', 0)
+        self.addCleanup(patcher0.stop)
+        patcher0.start()
+
         patcher1 = patch('notification_backend.notification_threads.dynamodb_results')  # NOQA
         self.addCleanup(patcher1.stop)
         self.mock_db_results = patcher1.start()
@@ -18,6 +34,15 @@ class TestFindThread(unittest.TestCase):
         self.addCleanup(patcher2.stop)
         self.mock_db_new_item = patcher2.start()
 
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_get_item')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_get_item = patcher3.start()
+        self.mock_db_get_item.return_value = None
+
+        patcher4 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher4.stop)
+        self.mock_db_update = patcher4.start()
+
         self.jwt_signing_secret = "shhsekret"
         self.token = jwt.encode({"sub": "333333"},
                                 self.jwt_signing_secret,
@@ -98,6 +123,19 @@ class TestFindThread(unittest.TestCase):
             result_json.get('data').get('errors')[0].get('detail'),
             "Error querying for thread 12345678 from the datastore"
         )
+
+    def test_datastore_throttled(self):
+        self.mock_db_results.side_effect = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "Query")  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 503)
+        self.assertEqual(result_json.get('headers'), {"Retry-After": "2"})
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error querying for thread 12345678 from the datastore"
+        )
         self.assertTrue(self.mock_db_results.mock_calls > 0)
 
     def test_single_dynamodb_result(self):
@@ -125,6 +163,29 @@ class TestFindThread(unittest.TestCase):
         self.assertEqual(result_attrs.get('reason'), "subscribed")
         self.assertEqual(result_attrs.get('updated-at'), 1460443217)
         self.assertTrue(self.mock_db_results.mock_calls > 0)
+        self.assertEqual(
+            self.mock_db_results.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags", "deleted_at", "change_version", "github_etag", "github_last_modified"]  # NOQA
+        )
+        self.assertEqual(result_json.get('headers').get('Last-Modified'),
+                         "Tue, 12 Apr 2016 06:40:17 GMT")
+
+        self.lambda_event['if_none_match'] = result_json.get('headers').get('ETag')  # NOQA
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 304)
+        self.assertEqual(result_json.get('data'), {})
+
+    def test_reserved_thread_id(self):
+        self.lambda_event['threadid'] = "0"
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 404)
+        self.assertEqual(self.mock_db_results.mock_calls, [])
 
     @responses.activate
     def test_github_api_400(self):
@@ -150,6 +211,144 @@ class TestFindThread(unittest.TestCase):
         )
         self.assertTrue(self.mock_db_results.mock_calls > 0)
 
+    @responses.activate
+    def test_github_api_timeout(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': ConnectTimeout("timed out")
+        })
+        self.mock_db_results.side_effect = StopIteration
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 404)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Could not find info for thread 12345678"
+        )
+
+    @responses.activate
+    def test_github_result_queued(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': json.dumps({
+                "id": "12345678",
+                "reason": "mention",
+                "updated_at": "2016-04-12T01:40:17Z",
+                "subject": {"type": "Issue"},
+                "repository": {"name": "left-pad", "owner": {"login": "octocat"}}  # NOQA
+            }),
+            'status': 200
+        })
+        self.mock_db_results.side_effect = StopIteration
+        write_behind_queue.max_size = 10
+        self.addCleanup(write_behind_queue.clear)
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(self.mock_db_new_item.mock_calls, [])
+        self.assertEqual(write_behind_queue.stats().get('pending'), 1)
+
+    def test_github_rate_limited(self):
+        self.mock_db_results.side_effect = StopIteration
+        with patch('notification_backend.notification_threads.github_get') as mock_github_get:  # NOQA
+            mock_github_get.side_effect = GitHubRateLimited(12.3)
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 503)
+        self.assertEqual(result_json.get('headers'), {"Retry-After": "13"})
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "GitHub rate limit nearly used up, try again in 13 seconds"
+        )
+        self.assertEqual(self.mock_db_new_item.mock_calls, [])
+
+    def find_thread_status(self):
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        return json.loads(str(cm.exception)).get('http_status')
+
+    @responses.activate
+    def test_github_not_found_cached(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': '{"message": "Not Found"}',
+            'status': 404
+        })
+        self.mock_db_results.side_effect = StopIteration
+        for i in range(3):
+            self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 1)
+
+        # The cache is per user
+        self.lambda_event['bearer_token'] = "Bearer %s" % jwt.encode(
+            {"sub": "444444"},
+            self.jwt_signing_secret,
+            algorithm='HS256'
+        )
+        self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_github_errors_not_cached(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': ConnectTimeout("timed out")
+        })
+        self.mock_db_results.side_effect = StopIteration
+        for i in range(2):
+            self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_github_not_found_shared_cache(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': '{"message": "Not Found"}',
+            'status': 404
+        })
+        self.lambda_event['notification_github_not_found_dynamodb_table_name'] = "fakenotfound"  # NOQA
+        self.mock_db_results.side_effect = StopIteration
+        self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 1)
+        table_name, item = self.mock_db_new_item.call_args[0][1:]
+        self.assertEqual(table_name, "fakenotfound")
+        self.assertEqual(item.get('thread_id'), 12345678)
+        self.assertTrue(item.get('expires_at') > time.time())
+
+        # Another process only gets to see the shared entry
+        github_not_found_cache.clear()
+        self.mock_db_get_item.return_value = {"expires_at": item.get('expires_at')}  # NOQA
+        self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(self.mock_db_get_item.call_args[0][1:],
+                         ("fakenotfound", {"user_id": "333333", "thread_id": 12345678}))  # NOQA
+
+        # ...and keeps it no longer than the shared entry lasts
+        github_not_found_cache.clear()
+        expires_at = int(time.time()) + 2
+        self.mock_db_get_item.return_value = {"expires_at": expires_at}
+        self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 1)
+        with patch('notification_backend.cache.time.time') as mock_time:
+            mock_time.return_value = expires_at
+            self.assertEqual(github_not_found_cache.get(("333333", 12345678)),  # NOQA
+                             None)
+
+        github_not_found_cache.clear()
+        self.mock_db_get_item.return_value = {"expires_at": 1460443217}
+        self.assertEqual(self.find_thread_status(), 404)
+        self.assertEqual(len(responses.calls), 2)
+
     @responses.activate
     def test_github_api_invalid_json(self):
         responses.add(**{
@@ -221,6 +420,114 @@ class TestFindThread(unittest.TestCase):
         self.assertTrue(self.mock_db_results.mock_calls > 0)
         self.assertTrue(self.mock_db_new_item.mock_calls > 0)
 
+    def github_thread_response(self):
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': json.dumps({
+                "id": "12345678",
+                "reason": "manual",
+                "updated_at": "2016-04-12T01:40:17Z",
+                "subject": {"type": "Issue"},
+                "repository": {"name": "left-pad", "owner": {"login": "octocat"}}  # NOQA
+            }),
+            'status': 200
+        })
+
+    @responses.activate
+    def test_github_thread_written_unless_stored_meanwhile(self):
+        self.github_thread_response()
+        self.mock_db_results.side_effect = StopIteration
+        ce = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")  # NOQA
+        self.mock_db_new_item.side_effect = ce
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        condition = self.mock_db_new_item.call_args[1].get('condition_expression')  # NOQA
+        self.assertEqual(condition.get_expression()['operator'],
+                         "attribute_not_exists")
+
+    @responses.activate
+    def test_deleted_thread_written_unless_changed_meanwhile(self):
+        self.github_thread_response()
+        self.mock_db_results.return_value.next.return_value = {
+            "thread_id": 12345678,
+            "deleted_at": 1460443300,
+            "change_version": 5,
+            "github_etag": '"abc"'
+        }
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        request_headers = responses.calls[-1].request.headers
+        self.assertEqual(request_headers.get('If-None-Match'), '"abc"')
+        condition = self.mock_db_new_item.call_args[1].get('condition_expression')  # NOQA
+        expression = condition.get_expression()
+        self.assertEqual(expression['operator'], "=")
+        self.assertEqual(expression['values'][0].name, "change_version")
+        self.assertEqual(expression['values'][1], 5)
+
+    @responses.activate
+    def test_deleted_thread_not_modified(self):
+        reset_github_rate_limits()
+        self.addCleanup(reset_github_rate_limits)
+        self.token = jwt.encode({"sub": "333333", "github_token": "ghtoken"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event['bearer_token'] = "Bearer %s" % self.token
+        # A single request to spare
+        record_rate_limit("ghtoken", MagicMock(headers={
+            "X-RateLimit-Limit": "60",
+            "X-RateLimit-Remaining": "51",
+            "X-RateLimit-Reset": str(int(time.time() + 60))
+        }))
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'status': 304
+        })
+        self.mock_db_results.return_value.next.return_value = {
+            "thread_id": 12345678,
+            "deleted_at": 1460443300,
+            "change_version": 5,
+            "github_etag": '"abc"',
+            "github_last_modified": "Tue, 12 Apr 2016 01:40:17 GMT"
+        }
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        # Unchanged on GitHub since it got deleted, the thread stays deleted
+        self.assertEqual(result_json.get('http_status'), 404)
+        request_headers = responses.calls[-1].request.headers
+        self.assertEqual(request_headers.get('If-None-Match'), '"abc"')
+        self.assertEqual(request_headers.get('If-Modified-Since'),
+                         "Tue, 12 Apr 2016 01:40:17 GMT")
+        self.assertEqual(self.mock_db_new_item.mock_calls, [])
+        self.assertEqual(self.mock_db_update.mock_calls, [])
+        # The request to spare is still there
+        self.assertEqual(reserve_github_request("ghtoken"), 0)
+        self.assertTrue(reserve_github_request("ghtoken") > 1)
+
+    @responses.activate
+    def test_deleted_thread(self):
+        self.mock_db_results.return_value.next.return_value = {
+            "thread_id": 12345678,
+            "deleted_at": 1460443300
+        }
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/12345678',
+            'body': '{"message": "Not Found"}',
+            'status': 404
+        })
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_thread")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 404)
+        self.assertEqual(len(responses.calls), 1)
+
     @responses.activate
     def test_github_valid_output(self):
         output = {
@@ -248,12 +555,16 @@ class TestFindThread(unittest.TestCase):
             'method': responses.GET,
             'url': 'https://api.github.com/notifications/threads/12345678',
             'body': json.dumps(output),
-            'status': 200
+            'status': 200,
+            'adding_headers': {"ETag": '"abc"'}
         })
         self.mock_db_results.side_effect = StopIteration
         t = NotificationThreads(self.lambda_event)
         result_json = t.process_thread_event("find_thread")
         self.assertEqual(result_json.get('http_status'), 200)
+        persisted = self.mock_db_new_item.call_args[0][2]
+        self.assertEqual(persisted.get('github_etag'), '"abc"')
+        self.assertFalse('github_last_modified' in persisted)
         result_attrs = result_json.get('data').get('data').get('attributes')
         self.assertEqual(result_json.get('http_status'), 200)
         self.assertEqual(result_json.get('data').get('data').get('type'), "threads")  # NOQA
@@ -0,0 +1,176 @@
+import unittest
+from mock import patch
+import responses
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import github_not_found_cache
+from notification_backend.notification_threads import write_behind_queue
+from notification_backend.github import GitHubRateLimited
+import json
+import jwt
+from boto3.exceptions import Boto3Error
+
+
+class TestFindThreads(unittest.TestCase):
+
+    def setUp(self):
+        github_not_found_cache.clear()
+        # Persisted synchronously, unless a test queues writes on purpose
+        patcher0 = patch.object(write_behind_queue, 'max_size', 0)
+        self.addCleanup(patcher0.stop)
+        patcher0.start()
+
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_batch_get')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_batch_get = patcher1.start()
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_new_item')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_new_item = patcher2.start()
+
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_update = patcher3.start()
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {},
+            "resource-path": "/notification/threads",
+            "qs_filter_id": "1,2,1",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"
+        }
+        self.mock_db_batch_get.return_value = ([
+            {
+                "thread_id": 1,
+                "thread_url": "http://api.example.com/fake/1",
+                "thread_subscription_url": "http://api.example.com/fake/1/subscribe",  # NOQA
+                "reason": "subscribed",
+                "updated_at": 1460443217,
+                "tags": ["watching"]
+            },
+            {
+                "thread_id": 2,
+                "thread_url": "http://api.example.com/fake/2",
+                "thread_subscription_url": "http://api.example.com/fake/2/subscribe",  # NOQA
+                "reason": "mention",
+                "updated_at": 1460443218,
+                "tags": ["mentioned"]
+            }
+        ], [])
+
+    def github_thread(self, thread_id):
+        return {
+            "id": str(thread_id),
+            "reason": "manual",
+            "updated_at": "2016-04-12T01:40:17Z",
+            "subject": {
+                "title": "Support AWS APIGateway",
+                "url": "https://api.github.com/repos/hashicorp/terraform/issues/3675",  # NOQA
+                "type": "Issue"
+            },
+            "repository": {
+                "name": "terraform",
+                "owner": {
+                    "login": "hashicorp"
+                }
+            },
+            "url": "https://api.github.com/notifications/threads/%s" % thread_id,  # NOQA
+            "subscription_url": "https://api.github.com/notifications/threads/%s/subscription" % thread_id  # NOQA
+        }
+
+    def test_invalid_filter(self):
+        for filter_id in ["1,fake", "0", ",".join(str(i) for i in range(1, 102))]:  # NOQA
+            self.lambda_event['qs_filter_id'] = filter_id
+            t = NotificationThreads(self.lambda_event)
+            with self.assertRaises(TypeError) as cm:
+                t.process_thread_event("find_threads")
+            result_json = json.loads(str(cm.exception))
+            self.assertEqual(result_json.get('http_status'), 400)
+            self.assertEqual(
+                result_json.get('data').get('errors')[0].get('detail'),
+                "'filter[id]' parameter needs to be a comma separated list of at most 100 thread ids"  # NOQA
+            )
+        self.assertEqual(len(self.mock_db_batch_get.mock_calls), 0)
+
+    def test_datastore_error(self):
+        self.mock_db_batch_get.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error querying the datastore"
+        )
+
+    def test_unprocessed_keys(self):
+        self.mock_db_batch_get.return_value = ([], [{"thread_id": 1}])
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("find_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+
+    def test_all_found(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        keys = self.mock_db_batch_get.call_args[0][2]
+        self.assertEqual(keys, [
+            {"user_id": "333333", "thread_id": 1},
+            {"user_id": "333333", "thread_id": 2}
+        ])
+        data = result_json.get('data').get('data')
+        self.assertEqual([d.get('id') for d in data], [1, 2])
+        self.assertEqual(data[1].get('attributes').get('tags'), ["mentioned"])  # NOQA
+        self.assertEqual(result_json.get('data').get('meta').get('not-found'), [])  # NOQA
+        self.assertEqual(len(self.mock_db_new_item.mock_calls), 0)
+        self.assertEqual(
+            self.mock_db_batch_get.call_args[1].get('projection'),
+            ["thread_id", "thread_url", "thread_subscription_url", "reason", "updated_at", "tags", "deleted_at", "change_version", "github_etag", "github_last_modified"]  # NOQA
+        )
+
+    @responses.activate
+    def test_github_fallback(self):
+        self.lambda_event['qs_filter_id'] = "3,1,4"
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/3',
+            'body': json.dumps(self.github_thread(3)),
+            'status': 200
+        })
+        responses.add(**{
+            'method': responses.GET,
+            'url': 'https://api.github.com/notifications/threads/4',
+            'body': '{"message": "Not Found"}',
+            'status': 404
+        })
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("find_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        data = result_json.get('data').get('data')
+        self.assertEqual([d.get('id') for d in data], [3, 1])
+        self.assertEqual(data[0].get('attributes').get('updated-at'), 1460425217)  # NOQA
+        self.assertTrue('subscribed' in data[0].get('attributes').get('tags'))  # NOQA
+        self.assertEqual(result_json.get('data').get('meta').get('not-found'), [4])  # NOQA
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(len(self.mock_db_new_item.mock_calls), 1)
+        self.assertEqual(self.mock_db_new_item.call_args[0][2].get('thread_id'), 3)  # NOQA
+
+    def test_github_rate_limited(self):
+        self.lambda_event['qs_filter_id'] = "3,1"
+        with patch('notification_backend.notification_threads.github_get') as mock_github_get:  # NOQA
+            mock_github_get.side_effect = GitHubRateLimited(12.3)
+            t = NotificationThreads(self.lambda_event)
+            result_json = t.process_thread_event("find_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(result_json.get('headers'), {"Retry-After": "13"})
+        meta = result_json.get('data').get('meta')
+        self.assertEqual(meta.get('not-found'), [])
+        self.assertEqual(meta.get('deferred'), [3])
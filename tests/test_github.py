@@ -0,0 +1,183 @@
+import unittest
+import BaseHTTPServer
+import json
+import threading
+import time
+from mock import patch
+from mock import MagicMock
+from requests.exceptions import Timeout
+from notification_backend.github import github_get
+from notification_backend.github import github_poll_interval
+from notification_backend.github import reset_github_rate_limits
+from notification_backend.github import GitHubRateLimited
+from notification_backend.github import record_rate_limit
+from notification_backend.github import reserve_github_request
+from notification_backend.github import github_session
+from notification_backend.github import reset_github_session
+from notification_backend.github import github_latency
+
+
+class StubGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append({
+            "path": self.path,
+            "client_port": self.client_address[1],
+            "headers": dict(self.headers)
+        })
+        time.sleep(self.server.delay)
+        body = json.dumps({"path": self.path})
+        if self.server.status == 304:
+            body = ""
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in self.server.response_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestGitHub(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                StubGitHubHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.status = 200
+        self.server.response_headers = {}
+        server_thread = threading.Thread(target=self.server.serve_forever,
+                                         args=(0.05,))
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        patcher1 = patch('notification_backend.github.GITHUB_API_URL',
+                         "http://127.0.0.1:%s" % self.server.server_port)
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+
+        reset_github_session()
+        self.addCleanup(reset_github_session)
+        reset_github_rate_limits()
+        self.addCleanup(reset_github_rate_limits)
+
+    def rate_limit_headers(self, remaining, reset_in=60):
+        return {
+            "X-RateLimit-Limit": "5000",
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": str(int(time.time() + reset_in))
+        }
+
+    def test_session_reused(self):
+        self.assertIs(github_session(), github_session())
+
+    def test_github_get(self):
+        r = github_get("/notifications/threads/1234", "ghtoken")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json().get('path'), "/notifications/threads/1234")
+        headers = self.server.requests[0].get('headers')
+        self.assertEqual(headers.get('authorization'), "Bearer ghtoken")
+        self.assertEqual(headers.get('accept'), "application/json")
+
+    def test_extra_headers_and_params(self):
+        github_get("/notifications",
+                   "ghtoken",
+                   headers={"If-None-Match": '"abc"'},
+                   params={"all": "true"})
+        request = self.server.requests[0]
+        self.assertEqual(request.get('path'), "/notifications?all=true")
+        self.assertEqual(request.get('headers').get('if-none-match'), '"abc"')
+
+    def test_connection_kept_alive(self):
+        github_get("/notifications/threads/1", "ghtoken")
+        github_get("/notifications/threads/2", "ghtoken")
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0].get('client_port'),
+                         self.server.requests[1].get('client_port'))
+
+    @patch('notification_backend.github.GITHUB_READ_TIMEOUT', 0.05)
+    def test_read_timeout(self):
+        self.server.delay = 0.2
+        with self.assertRaises(Timeout):
+            github_get("/notifications/threads/1234", "ghtoken")
+
+    def test_latency(self):
+        github_latency.reset()
+        self.addCleanup(github_latency.reset)
+        with patch('notification_backend.github.GITHUB_READ_TIMEOUT', 0.05):
+            self.server.delay = 0.2
+            with self.assertRaises(Timeout):
+                github_get("/notifications/threads/1234", "ghtoken")
+        self.server.delay = 0
+        github_get("/notifications/threads/1234", "ghtoken")
+        counts = github_latency.collect()
+        self.assertEqual(sum(counts[("200",)][:-1]), 1)
+        self.assertEqual(sum(counts[("error",)][:-1]), 1)
+        self.assertTrue(counts[("error",)][-1] >= 0.05)
+
+    def test_poll_interval(self):
+        self.assertEqual(github_poll_interval("ghtoken"), None)
+        self.server.response_headers = self.rate_limit_headers(4000)
+        self.server.response_headers["X-Poll-Interval"] = "60"
+        github_get("/notifications", "ghtoken")
+        self.assertEqual(github_poll_interval("ghtoken"), 60)
+        self.assertEqual(github_poll_interval("otherghtoken"), None)
+
+    def test_rate_limit_deferred(self):
+        self.server.response_headers = self.rate_limit_headers(50)
+        github_get("/notifications/threads/1", "ghtoken")
+        with self.assertRaises(GitHubRateLimited) as cm:
+            github_get("/notifications/threads/2", "ghtoken")
+        self.assertTrue(55 < cm.exception.retry_after <= 60)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Each token has a budget of its own
+        github_get("/notifications/threads/2", "otherghtoken")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_not_modified_free(self):
+        # A single request to spare (out of few enough not to be paced)
+        headers = self.rate_limit_headers(51)
+        headers["X-RateLimit-Limit"] = "60"
+        record_rate_limit("ghtoken", MagicMock(headers=headers))
+        self.server.status = 304
+        for i in range(3):
+            r = github_get("/notifications/threads/1",
+                           "ghtoken",
+                           headers={"If-None-Match": '"abc"'})
+            self.assertEqual(r.status_code, 304)
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.status = 200
+        github_get("/notifications/threads/1", "ghtoken")
+        with self.assertRaises(GitHubRateLimited):
+            github_get("/notifications/threads/1", "ghtoken")
+
+    def test_rate_limit_pacing(self):
+        # Plenty left, no need to hold anything back
+        record_rate_limit("ghtoken", MagicMock(headers=self.rate_limit_headers(4000)))  # NOQA
+        self.assertEqual([reserve_github_request("ghtoken") for i in range(3)],
+                         [0, 0, 0])
+
+        # 100 requests to spare for the next 40 seconds
+        record_rate_limit("otherghtoken", MagicMock(headers=self.rate_limit_headers(150, 40)))  # NOQA
+        self.assertEqual(reserve_github_request("otherghtoken"), 0)
+        self.assertTrue(0.3 < reserve_github_request("otherghtoken") < 0.5)
+        self.assertTrue(0.7 < reserve_github_request("otherghtoken") < 0.9)
+        # Anything further out than GITHUB_MAX_PACING_DELAY isn't booked
+        self.assertTrue(reserve_github_request("otherghtoken") > 1)
+        self.assertTrue(reserve_github_request("otherghtoken") > 1)
+
+    def test_rate_limit_reset(self):
+        self.server.response_headers = self.rate_limit_headers(10, -1)
+        for i in range(2):
+            github_get("/notifications/threads/1", "ghtoken")
+        self.assertEqual(len(self.server.requests), 2)
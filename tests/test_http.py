@@ -1,10 +1,39 @@
 import unittest
+import json
+import jwt
+import threading
+import time
+from decimal import Decimal
 from mock import patch
 from mock import call
+from boto3.exceptions import Boto3Error
+from botocore.exceptions import ClientError
 from notification_backend.http import dynamodb_results
 from notification_backend.http import dynamodb_new_item
 from notification_backend.http import dynamodb_delete_item
 from notification_backend.http import dynamodb_update_item
+from notification_backend.http import dynamodb_table
+from notification_backend.http import dynamodb_query
+from notification_backend.http import dynamodb_get_item
+from notification_backend.http import dynamodb_scan_results
+from notification_backend.http import dynamodb_parallel_scan_results
+from notification_backend.http import format_stream_response
+from notification_backend.http import format_response
+from notification_backend.http import dynamodb_batch_get
+from notification_backend.http import dynamodb_batch_write
+from notification_backend.http import validate_jwt
+from notification_backend.http import jwt_cache
+from notification_backend.http import jwt_cache_stats
+from notification_backend.http import encode_pagination_cursor
+from notification_backend.http import decode_pagination_cursor
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.http import dynamodb_retry_policy
+from notification_backend.http import dynamodb_retry_stats
+from notification_backend.http import dynamodb_capacity
+from notification_backend.http import dynamodb_capacity_stats
+from notification_backend.http import dynamodb_latency
+from notification_backend.capacity import start_metering
+from notification_backend.capacity import stop_metering
 
 
 class TestHttp(unittest.TestCase):
@@ -14,6 +43,28 @@ class TestHttp(unittest.TestCase):
         self.addCleanup(patcher1.stop)
         self.mock_boto = patcher1.start()
 
+        patcher2 = patch.object(dynamodb_retry_policy, 'sleep')
+        self.addCleanup(patcher2.stop)
+        self.mock_sleep = patcher2.start()
+
+        # Backoff without the jitter, and without pacing throttled tables
+        patcher3 = patch('notification_backend.retry.random.uniform')
+        self.addCleanup(patcher3.stop)
+        patcher3.start().side_effect = lambda low, high: high
+
+        patcher4 = patch.object(dynamodb_retry_policy, 'pace')
+        self.addCleanup(patcher4.stop)
+        patcher4.start()
+
+        # Writes hand back the capacity they consumed, if nothing else
+        table = self.mock_boto.return_value.Table.return_value
+        table.put_item.return_value = {}
+        table.delete_item.return_value = {}
+        table.update_item.return_value = {}
+        dynamodb_retry_policy.reset()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+
     def test_db_results_no_index_name(self):
         mock_results = [
             {
@@ -28,7 +79,7 @@ class TestHttp(unittest.TestCase):
                                    key="key")
         result = results.next()
         self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
-                         [call(KeyConditionExpression='key')])
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key')])  # NOQA
         self.assertEqual(result, {"one": "item one"})
         with self.assertRaises(StopIteration):
             results.next()
@@ -54,33 +105,33 @@ class TestHttp(unittest.TestCase):
                                    index_name="index")
         result = results.next()
         self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
-                         [call(KeyConditionExpression='key', IndexName='index')])  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', IndexName='index')])  # NOQA
         self.assertEqual(result, {"one": "item one"})
         result = results.next()
         self.assertEqual(len(self.mock_boto.return_value.Table.return_value.query.mock_calls), 2)  # NOQA
-        self.assertTrue(call(KeyConditionExpression='key', IndexName='index') in self.mock_boto.return_value.Table.return_value.query.mock_calls)  # NOQA
-        self.assertTrue(call(KeyConditionExpression='key', IndexName='index', ExclusiveStartKey='paginationkey') in self.mock_boto.return_value.Table.return_value.query.mock_calls)  # NOQA
+        self.assertTrue(call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', IndexName='index') in self.mock_boto.return_value.Table.return_value.query.mock_calls)  # NOQA
+        self.assertTrue(call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', IndexName='index', ExclusiveStartKey='paginationkey') in self.mock_boto.return_value.Table.return_value.query.mock_calls)  # NOQA
         self.assertEqual(result, {"two": "item two"})
 
     def test_db_new_item_no_condition_expression(self):
         dynamodb_new_item(endpoint_url="endpoint",
                           table_name="table",
                           item="item")
-        self.assertEqual(self.mock_boto.return_value.Table.return_value.put_item.mock_calls, [call(Item='item')])  # NOQA
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.put_item.mock_calls, [call(ReturnConsumedCapacity='TOTAL', Item='item')])  # NOQA
 
     def test_db_new_item(self):
         dynamodb_new_item(endpoint_url="endpoint",
                           table_name="table",
                           item="item",
                           condition_expression="condition")
-        self.assertEqual(self.mock_boto.return_value.Table.return_value.put_item.mock_calls, [call(Item='item', ConditionExpression="condition")])  # NOQA
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.put_item.mock_calls, [call(ReturnConsumedCapacity='TOTAL', Item='item', ConditionExpression="condition")])  # NOQA
 
     def test_db_delete_item(self):
         dynamodb_delete_item(endpoint_url="endpoint",
                              table_name="table",
                              key="key",
                              condition_expression="condition")
-        self.assertEqual(self.mock_boto.return_value.Table.return_value.delete_item.mock_calls, [call(Key='key', ConditionExpression="condition")])  # NOQA
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.delete_item.mock_calls, [call(ReturnConsumedCapacity='TOTAL', Key='key', ConditionExpression="condition")])  # NOQA
 
     def test_db_update_item_no_condition_expression(self):
         dynamodb_update_item(endpoint_url="endpoint",
@@ -89,7 +140,7 @@ class TestHttp(unittest.TestCase):
                              update_expression="updateexpression",
                              expr_attribute_values="exprvalues")
         self.assertEqual(self.mock_boto.return_value.Table.return_value.update_item.mock_calls,  # NOQA
-                         [call(Key='key', UpdateExpression='updateexpression', ExpressionAttributeValues='exprvalues', ReturnValues='UPDATED_NEW')])  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', Key='key', UpdateExpression='updateexpression', ExpressionAttributeValues='exprvalues', ReturnValues='UPDATED_NEW')])  # NOQA
 
     def test_db_update_item(self):
         dynamodb_update_item(endpoint_url="endpoint",
@@ -99,4 +150,395 @@ class TestHttp(unittest.TestCase):
                              expr_attribute_values="exprvalues",
                              condition_expression="condition")
         self.assertEqual(self.mock_boto.return_value.Table.return_value.update_item.mock_calls,  # NOQA
-                         [call(Key='key', UpdateExpression='updateexpression', ExpressionAttributeValues='exprvalues', ReturnValues='UPDATED_NEW', ConditionExpression='condition')])  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', Key='key', UpdateExpression='updateexpression', ExpressionAttributeValues='exprvalues', ReturnValues='UPDATED_NEW', ConditionExpression='condition')])  # NOQA
+
+    def test_db_table_reused(self):
+        table1 = dynamodb_table(endpoint_url="endpoint", table_name="table")
+        table2 = dynamodb_table(endpoint_url="endpoint", table_name="table")
+        self.assertIs(table1, table2)
+        self.assertEqual(self.mock_boto.call_count, 1)
+        self.assertEqual(self.mock_boto.return_value.Table.mock_calls,
+                         [call('table')])
+
+    def test_db_table_per_endpoint_and_name(self):
+        dynamodb_table(endpoint_url="endpoint1", table_name="table")
+        dynamodb_table(endpoint_url="endpoint1", table_name="othertable")
+        dynamodb_table(endpoint_url="endpoint2", table_name="table")
+        self.assertEqual(self.mock_boto.call_count, 2)
+        self.assertEqual(self.mock_boto.return_value.Table.call_count, 3)
+        endpoints = [c[2].get('endpoint_url') for c in self.mock_boto.mock_calls if c[0] == '']  # NOQA
+        self.assertEqual(endpoints, ["endpoint1", "endpoint2"])
+
+    def test_db_resource_pool_size(self):
+        dynamodb_table(endpoint_url="endpoint", table_name="table")
+        config = self.mock_boto.call_args[1].get('config')
+        self.assertEqual(config.max_pool_connections, 10)
+
+    def test_db_botocore_retries_disabled(self):
+        dynamodb_table(endpoint_url="endpoint", table_name="table")
+        self.assertEqual(
+            self.mock_boto.return_value.meta.client.meta.events.unregister.mock_calls,  # NOQA
+            [call('needs-retry.dynamodb', unique_id='retry-config-dynamodb')]
+        )
+
+    def test_db_throttled_request_retried(self):
+        throttled = ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "GetItem")  # NOQA
+        self.mock_boto.return_value.Table.return_value.get_item.side_effect = [  # NOQA
+            throttled,
+            throttled,
+            {"Item": {"thread_id": 1}}
+        ]
+        item = dynamodb_get_item(endpoint_url="endpoint",
+                                 table_name="table",
+                                 key={"thread_id": 1})
+        self.assertEqual(item, {"thread_id": 1})
+        self.assertEqual(self.mock_sleep.mock_calls, [call(0.05), call(0.1)])
+        stats = dynamodb_retry_stats()
+        self.assertEqual(stats.get('throttles'), 2)
+        self.assertEqual(stats.get('retries'), 2)
+        self.assertEqual(stats.get('requests'), 3)
+
+    def test_db_other_errors_not_retried(self):
+        self.mock_boto.return_value.Table.return_value.put_item.side_effect = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")  # NOQA
+        with self.assertRaises(ClientError):
+            dynamodb_new_item(endpoint_url="endpoint",
+                              table_name="table",
+                              item="item")
+        self.assertEqual(len(self.mock_boto.return_value.Table.return_value.put_item.mock_calls), 1)  # NOQA
+        self.assertEqual(self.mock_sleep.mock_calls, [])
+
+    def test_db_helpers_share_table(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {"Items": []}  # NOQA
+        list(dynamodb_results(endpoint_url="endpoint",
+                              table_name="table",
+                              key="key"))
+        dynamodb_new_item(endpoint_url="endpoint",
+                          table_name="table",
+                          item="item")
+        dynamodb_delete_item(endpoint_url="endpoint",
+                             table_name="table",
+                             key="key",
+                             condition_expression="condition")
+        self.assertEqual(self.mock_boto.call_count, 1)
+        self.assertEqual(self.mock_boto.return_value.Table.call_count, 1)
+
+    def test_db_query_single_page(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {
+            "Items": [{"one": "item one"}],
+            "LastEvaluatedKey": {"user_id": 1, "thread_id": 2}
+        }
+        items, last_key = dynamodb_query(endpoint_url="endpoint",
+                                         table_name="table",
+                                         key="key",
+                                         index_name="index",
+                                         limit=10,
+                                         exclusive_start_key={"user_id": 1})
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', IndexName='index', Limit=10, ExclusiveStartKey={"user_id": 1})])  # NOQA
+        self.assertEqual(items, [{"one": "item one"}])
+        self.assertEqual(last_key, {"user_id": 1, "thread_id": 2})
+
+    def test_pagination_cursor_roundtrip(self):
+        last_key = {
+            "user_id": Decimal(333333),
+            "thread_id": Decimal(12345678),
+            "updated_at": Decimal(1460443217)
+        }
+        cursor = encode_pagination_cursor(last_key)
+        self.assertFalse("=" in cursor)
+        self.assertEqual(decode_pagination_cursor(cursor), last_key)
+
+    def test_invalid_pagination_cursor(self):
+        for cursor in ["!!!", "e30x", "MTIz"]:
+            with self.assertRaises(ValueError):
+                decode_pagination_cursor(cursor)
+
+    def test_db_batch_get_unprocessed_retry(self):
+        keys = [{"thread_id": 1}, {"thread_id": 2}]
+        self.mock_boto.return_value.batch_get_item.side_effect = [
+            {
+                "Responses": {"table": [{"thread_id": 1}]},
+                "UnprocessedKeys": {"table": {"Keys": [{"thread_id": 2}]}}
+            },
+            {
+                "Responses": {"table": [{"thread_id": 2}]},
+                "UnprocessedKeys": {}
+            }
+        ]
+        items, unprocessed = dynamodb_batch_get(endpoint_url="endpoint",
+                                                table_name="table",
+                                                keys=keys)
+        self.assertEqual(items, [{"thread_id": 1}, {"thread_id": 2}])
+        self.assertEqual(unprocessed, [])
+        self.assertEqual(self.mock_boto.return_value.batch_get_item.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', RequestItems={"table": {"Keys": keys}}),  # NOQA
+                          call(ReturnConsumedCapacity='TOTAL', RequestItems={"table": {"Keys": [{"thread_id": 2}]}})])  # NOQA
+        self.assertEqual(self.mock_sleep.mock_calls, [call(0.05)])
+
+    def test_db_batch_get_gives_up(self):
+        self.mock_boto.return_value.batch_get_item.return_value = {
+            "Responses": {},
+            "UnprocessedKeys": {"table": {"Keys": [{"thread_id": 1}]}}
+        }
+        items, unprocessed = dynamodb_batch_get(endpoint_url="endpoint",
+                                                table_name="table",
+                                                keys=[{"thread_id": 1}],
+                                                max_attempts=3)
+        self.assertEqual(items, [])
+        self.assertEqual(unprocessed, [{"thread_id": 1}])
+        self.assertEqual(self.mock_sleep.mock_calls, [call(0.05), call(0.1)])
+
+    def test_db_batch_get_chunked(self):
+        keys = [{"thread_id": i} for i in range(150)]
+        self.mock_boto.return_value.batch_get_item.return_value = {
+            "Responses": {"table": []}
+        }
+        dynamodb_batch_get(endpoint_url="endpoint",
+                           table_name="table",
+                           keys=keys)
+        batch_calls = self.mock_boto.return_value.batch_get_item.mock_calls
+        self.assertEqual(len(batch_calls), 2)
+        self.assertEqual(len(batch_calls[0][2]['RequestItems']['table']['Keys']), 100)  # NOQA
+        self.assertEqual(len(batch_calls[1][2]['RequestItems']['table']['Keys']), 50)  # NOQA
+
+    def test_db_batch_write(self):
+        put_items = [{"thread_id": i} for i in range(30)]
+        self.mock_boto.return_value.batch_write_item.side_effect = [
+            {"UnprocessedItems": {}},
+            {"UnprocessedItems": {"table": [{"DeleteRequest": {"Key": {"thread_id": 99}}}]}},  # NOQA
+            {"UnprocessedItems": {}}
+        ]
+        unprocessed = dynamodb_batch_write(endpoint_url="endpoint",
+                                           table_name="table",
+                                           put_items=put_items,
+                                           delete_keys=[{"thread_id": 99}])
+        self.assertEqual(unprocessed, [])
+        batch_calls = self.mock_boto.return_value.batch_write_item.mock_calls
+        self.assertEqual(len(batch_calls), 3)
+        self.assertEqual(len(batch_calls[0][2]['RequestItems']['table']), 25)
+        self.assertEqual(batch_calls[0][2]['RequestItems']['table'][0],
+                         {"PutRequest": {"Item": {"thread_id": 0}}})
+        self.assertEqual(len(batch_calls[1][2]['RequestItems']['table']), 6)
+        self.assertEqual(batch_calls[2][2]['RequestItems']['table'],
+                         [{"DeleteRequest": {"Key": {"thread_id": 99}}}])
+        self.assertEqual(self.mock_sleep.mock_calls, [call(0.05)])
+
+    def test_db_batch_write_gives_up(self):
+        unprocessed_items = {"table": [{"PutRequest": {"Item": {"thread_id": 1}}}]}  # NOQA
+        self.mock_boto.return_value.batch_write_item.return_value = {
+            "UnprocessedItems": unprocessed_items
+        }
+        unprocessed = dynamodb_batch_write(endpoint_url="endpoint",
+                                           table_name="table",
+                                           put_items=[{"thread_id": 1}],
+                                           max_attempts=2)
+        self.assertEqual(unprocessed, unprocessed_items["table"])
+        self.assertEqual(len(self.mock_boto.return_value.batch_write_item.mock_calls), 2)  # NOQA
+
+    def test_consumed_capacity(self):
+        table = self.mock_boto.return_value.Table.return_value
+        table.query.return_value = {
+            "Items": [],
+            "ConsumedCapacity": {"TableName": "table", "CapacityUnits": 2.5}
+        }
+        table.put_item.return_value = {
+            "ConsumedCapacity": {"TableName": "table", "CapacityUnits": 1.0}
+        }
+        self.mock_boto.return_value.batch_write_item.return_value = {
+            "UnprocessedItems": {},
+            "ConsumedCapacity": [{"TableName": "table", "CapacityUnits": 3.0}]
+        }
+        usage = start_metering()
+        self.addCleanup(stop_metering)
+        self.addCleanup(dynamodb_capacity.reset)
+        dynamodb_query(endpoint_url="endpoint", table_name="table", key="key")
+        dynamodb_new_item(endpoint_url="endpoint",
+                          table_name="table",
+                          item="item")
+        dynamodb_batch_write(endpoint_url="endpoint",
+                             table_name="table",
+                             put_items=[{"thread_id": 1}])
+        self.assertEqual(usage.totals(), (2.5, 4.0))
+
+        # Requests made outside of invocations are accounted for separately
+        stop_metering()
+        dynamodb_capacity.reset()
+        dynamodb_query(endpoint_url="endpoint", table_name="table", key="key")
+        stats = dynamodb_capacity_stats()
+        self.assertEqual(stats['unattributed_read_units'], 2.5)
+        self.assertEqual(stats['routes'], {})
+
+    def test_validate_jwt_cached(self):
+        jwt_cache.clear()
+        token = "Bearer %s" % jwt.encode({"sub": "1"}, "secret")
+        with patch('notification_backend.http.jwt.decode', wraps=jwt.decode) as mock_decode:  # NOQA
+            self.assertEqual(validate_jwt(token, "secret"), {"sub": "1"})
+            self.assertEqual(validate_jwt(token, "secret"), {"sub": "1"})
+            self.assertEqual(validate_jwt(token, "othersecret"), None)
+        self.assertEqual(len(mock_decode.mock_calls), 2)
+        self.assertEqual(jwt_cache_stats(), {"hits": 1, "misses": 2, "size": 1})  # NOQA
+
+    def test_validate_jwt_cache_expiry(self):
+        jwt_cache.clear()
+        exp = int(time.time()) + 60
+        token = "Bearer %s" % jwt.encode({"sub": "1", "exp": exp}, "secret")
+        validate_jwt(token, "secret")
+        with patch('notification_backend.cache.time.time') as mock_time:
+            mock_time.return_value = exp - 1
+            self.assertEqual(validate_jwt(token, "secret").get('sub'), "1")
+            mock_time.return_value = exp
+            with patch('notification_backend.http.jwt.decode') as mock_decode:  # NOQA
+                mock_decode.side_effect = jwt.exceptions.ExpiredSignatureError  # NOQA
+                self.assertEqual(validate_jwt(token, "secret"), None)
+        self.assertEqual(jwt_cache_stats().get('size'), 0)
+
+    def test_db_query_projection(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {"Items": []}  # NOQA
+        dynamodb_query(endpoint_url="endpoint",
+                       table_name="table",
+                       key="key",
+                       projection=["thread_id", "reason"])
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', ProjectionExpression='#p0, #p1', ExpressionAttributeNames={'#p0': 'thread_id', '#p1': 'reason'})])  # NOQA
+
+    def test_db_query_filter_expression(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {"Items": []}  # NOQA
+        dynamodb_query(endpoint_url="endpoint",
+                       table_name="table",
+                       key="key",
+                       filter_expression="filter")
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', FilterExpression='filter')])  # NOQA
+
+    def test_db_new_item_return_values(self):
+        self.mock_boto.return_value.Table.return_value.put_item.return_value = {"Attributes": {"reason": "mention"}}  # NOQA
+        result = dynamodb_new_item(endpoint_url="endpoint",
+                                   table_name="table",
+                                   item="item",
+                                   return_values="ALL_OLD")
+        self.assertEqual(result, {"reason": "mention"})
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.put_item.mock_calls, [call(ReturnConsumedCapacity='TOTAL', Item='item', ReturnValues="ALL_OLD")])  # NOQA
+
+    def test_db_results_projection(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {"Items": []}  # NOQA
+        list(dynamodb_results(endpoint_url="endpoint",
+                              table_name="table",
+                              key="key",
+                              projection=["name"]))
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', ProjectionExpression='#p0', ExpressionAttributeNames={'#p0': 'name'})])  # NOQA
+
+    def test_db_batch_get_projection(self):
+        self.mock_boto.return_value.batch_get_item.return_value = {
+            "Responses": {"table": []}
+        }
+        dynamodb_batch_get(endpoint_url="endpoint",
+                           table_name="table",
+                           keys=[{"thread_id": 1}],
+                           projection=["thread_id"])
+        self.assertEqual(self.mock_boto.return_value.batch_get_item.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', RequestItems={"table": {"Keys": [{"thread_id": 1}], "ProjectionExpression": "#p0", "ExpressionAttributeNames": {"#p0": "thread_id"}}})])  # NOQA
+
+    def test_db_get_item(self):
+        self.mock_boto.return_value.Table.return_value.get_item.return_value = {}  # NOQA
+        item = dynamodb_get_item(endpoint_url="endpoint",
+                                 table_name="table",
+                                 key="key",
+                                 projection=["name"])
+        self.assertEqual(item, None)
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.get_item.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', Key='key', ProjectionExpression='#p0', ExpressionAttributeNames={'#p0': 'name'})])  # NOQA
+
+    def test_db_latency(self):
+        dynamodb_latency.reset()
+        self.addCleanup(dynamodb_latency.reset)
+        self.mock_boto.return_value.Table.return_value.get_item.return_value = {}  # NOQA
+        self.mock_boto.return_value.Table.return_value.query.side_effect = Boto3Error("oops")  # NOQA
+        dynamodb_get_item(endpoint_url="endpoint", table_name="table", key="key")  # NOQA
+        with self.assertRaises(Boto3Error):
+            dynamodb_query(endpoint_url="endpoint", table_name="table", key="key")  # NOQA
+        self.assertEqual(
+            sorted((labels, sum(counts[:-1])) for labels, counts in dynamodb_latency.collect().items()),  # NOQA
+            [(("get_item",), 1), (("query",), 1)]
+        )
+
+    def test_db_query_descending(self):
+        self.mock_boto.return_value.Table.return_value.query.return_value = {"Items": []}  # NOQA
+        dynamodb_query(endpoint_url="endpoint",
+                       table_name="table",
+                       key="key",
+                       limit=1,
+                       scan_index_forward=False)
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.query.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', KeyConditionExpression='key', Limit=1, ScanIndexForward=False)])  # NOQA
+
+    def test_format_response_headers(self):
+        response = format_response(200, {}, {"ETag": '"1"'})
+        self.assertEqual(response.get('headers'), {"ETag": '"1"'})
+        with self.assertRaises(TypeError) as cm:
+            format_response(304, {}, {"ETag": '"1"'})
+        self.assertEqual(json.loads(str(cm.exception)).get('headers'),
+                         {"ETag": '"1"'})
+
+    def test_db_scan_results_paginated(self):
+        self.mock_boto.return_value.Table.return_value.scan.side_effect = [
+            {"Items": [{"one": "item one"}], "LastEvaluatedKey": "key"},
+            {"Items": [{"two": "item two"}]}
+        ]
+        results = dynamodb_scan_results(endpoint_url="endpoint",
+                                        table_name="table",
+                                        filter_expression="filter",
+                                        segment=1,
+                                        total_segments=4,
+                                        projection=["one"])
+        self.assertEqual(list(results),
+                         [{"one": "item one"}, {"two": "item two"}])
+        self.assertEqual(self.mock_boto.return_value.Table.return_value.scan.mock_calls,  # NOQA
+                         [call(ReturnConsumedCapacity='TOTAL', FilterExpression='filter', Segment=1, TotalSegments=4, ProjectionExpression='#p0', ExpressionAttributeNames={'#p0': 'one'}),  # NOQA
+                          call(ReturnConsumedCapacity='TOTAL', FilterExpression='filter', Segment=1, TotalSegments=4, ExclusiveStartKey='key', ProjectionExpression='#p0', ExpressionAttributeNames={'#p0': 'one'})])  # NOQA
+
+    def test_db_parallel_scan(self):
+        def scan(**kwargs):
+            segment = kwargs.get('Segment')
+            if 'ExclusiveStartKey' in kwargs:
+                return {"Items": [{"segment": segment, "page": 2}]}
+            return {"Items": [{"segment": segment, "page": 1}],
+                    "LastEvaluatedKey": "key"}
+        self.mock_boto.return_value.Table.return_value.scan.side_effect = scan  # NOQA
+        results = dynamodb_parallel_scan_results(endpoint_url="endpoint",
+                                                 table_name="table",
+                                                 total_segments=3)
+        items = sorted(list(results))
+        self.assertEqual(len(items), 6)
+        self.assertEqual(set(i.get('segment') for i in items), set([0, 1, 2]))  # NOQA
+        self.assertEqual(len(self.mock_boto.return_value.Table.return_value.scan.mock_calls), 6)  # NOQA
+
+    def test_db_parallel_scan_error(self):
+        self.mock_boto.return_value.Table.return_value.scan.side_effect = Boto3Error  # NOQA
+        results = dynamodb_parallel_scan_results(endpoint_url="endpoint",
+                                                 table_name="table",
+                                                 total_segments=2)
+        with self.assertRaises(Boto3Error):
+            list(results)
+
+    def test_db_parallel_scan_abandoned(self):
+        self.mock_boto.return_value.Table.return_value.scan.return_value = {
+            "Items": [{"thread_id": i} for i in range(10)],
+            "LastEvaluatedKey": "key"
+        }
+        results = dynamodb_parallel_scan_results(endpoint_url="endpoint",
+                                                 table_name="table",
+                                                 total_segments=2)
+        results.next()
+        threads = threading.active_count()
+        # The scans stop once nobody is reading their results any more
+        results.close()
+        self.assertEqual(threading.active_count(), threads - 2)
+
+    def test_format_stream_response(self):
+        lines = iter(["line\n"])
+        response = format_stream_response(lines, {"Content-Type": "application/x-ndjson"})  # NOQA
+        self.assertEqual(response.get('http_status'), 200)
+        self.assertIs(response.get('stream'), lines)
+        self.assertEqual(response.get('headers'),
+                         {"Content-Type": "application/x-ndjson"})
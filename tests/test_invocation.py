@@ -0,0 +1,56 @@
+import unittest
+import threading
+from multiprocessing.pool import ThreadPool
+from notification_backend.invocation import current_invocation
+from notification_backend.invocation import bind_invocation
+from notification_backend.tracing import start_trace
+from notification_backend.tracing import stop_trace
+from notification_backend.tracing import current_trace
+from notification_backend.capacity import start_metering
+from notification_backend.capacity import stop_metering
+from notification_backend.capacity import current_usage
+from notification_backend.http import dynamodb_retry_policy
+
+
+def invocation_state():
+    return (current_trace(),
+            current_usage(),
+            dynamodb_retry_policy.time_left() is not None)
+
+
+class TestInvocation(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(stop_trace)
+        self.addCleanup(stop_metering)
+        self.addCleanup(dynamodb_retry_policy.set_deadline, None)
+
+    def test_not_bound(self):
+        self.assertIs(bind_invocation(invocation_state), invocation_state)
+
+    def test_bound_to_other_threads(self):
+        trace = start_trace()
+        usage = start_metering()
+        dynamodb_retry_policy.set_deadline(10)
+        pool = ThreadPool(2)
+        self.addCleanup(pool.terminate)
+        states = pool.map(bind_invocation(lambda i: invocation_state()),
+                          range(4))
+        self.assertEqual(states, [(trace, usage, True)] * 4)
+
+        # Pool threads are left working on nothing once done
+        stop_trace()
+        stop_metering()
+        dynamodb_retry_policy.set_deadline(None)
+        self.assertEqual(pool.map(lambda i: invocation_state(), range(4)),
+                         [(None, None, False)] * 4)
+
+    def test_threads_have_their_own(self):
+        start_metering()
+        states = []
+        worker = threading.Thread(
+            target=lambda: states.append(current_invocation().state())
+        )
+        worker.start()
+        worker.join()
+        self.assertEqual(states, [(None, None, None, None)])
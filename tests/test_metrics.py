@@ -0,0 +1,92 @@
+import unittest
+import threading
+from notification_backend.metrics import Counter
+from notification_backend.metrics import Gauge
+from notification_backend.metrics import Histogram
+from notification_backend.metrics import Snapshot
+from notification_backend.metrics import render
+
+
+class TestMetrics(unittest.TestCase):
+
+    def run_threads(self, target, count=4):
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests", ["route"])
+        counter.inc(("/ping",))
+
+        def count():
+            for i in range(1000):
+                counter.inc(("/threads",))
+        self.run_threads(count)
+        self.assertEqual(counter.collect(), {("/ping",): 1, ("/threads",): 4000})  # NOQA
+        # The shards of the threads that are gone got folded into one
+        self.assertEqual(len(counter._shards), 1)
+        self.run_threads(count)
+        self.assertEqual(counter.collect()[("/threads",)], 8000)
+
+    def test_gauge(self):
+        gauge = Gauge("in_flight", "Requests being worked on")
+        gauge.inc()
+        self.run_threads(lambda: gauge.dec(), 1)
+        gauge.inc()
+        self.assertEqual(gauge.collect(), {(): 1})
+
+    def test_histogram(self):
+        histogram = Histogram("latency_seconds", "Latency", ["route"],
+                              buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value, ("/ping",))
+        self.assertEqual(histogram.samples(), [
+            ("_bucket", [("route", "/ping"), ("le", "0.1")], 2),
+            ("_bucket", [("route", "/ping"), ("le", "1.0")], 3),
+            ("_bucket", [("route", "/ping"), ("le", "+Inf")], 4),
+            ("_sum", [("route", "/ping")], 2.65),
+            ("_count", [("route", "/ping")], 4)
+        ])
+
+    def test_histogram_timed(self):
+        histogram = Histogram("latency_seconds", "Latency", ["operation"])
+
+        @histogram.timed("query")
+        def query():
+            raise ValueError("oops")
+
+        with self.assertRaises(ValueError):
+            query()
+        self.assertEqual(histogram.samples()[-1],
+                         ("_count", [("operation", "query")], 1))
+
+    def test_reset(self):
+        counter = Counter("requests_total", "Requests")
+        self.run_threads(lambda: counter.inc())
+        counter.inc()
+        counter.reset()
+        self.assertEqual(counter.collect(), {})
+
+    def test_render(self):
+        counter = Counter("requests_total", "Requests", ["route"])
+        counter.inc(('/say "hi"\n',), 2)
+        histogram = Histogram("latency_seconds", "Latency", buckets=(0.5,))
+        histogram.observe(0.25)
+        snapshot = Snapshot("cache_hit_ratio", "Hits", "gauge", ["cache"],
+                            {("jwt",): 0.5})
+        self.assertEqual(render([counter, histogram, snapshot]), "\n".join([
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/say \\"hi\\"\\n"} 2',
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.5"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            "latency_seconds_sum 0.25",
+            "latency_seconds_count 1",
+            "# HELP cache_hit_ratio Hits",
+            "# TYPE cache_hit_ratio gauge",
+            'cache_hit_ratio{cache="jwt"} 0.5'
+        ]) + "\n")
@@ -0,0 +1,143 @@
+import unittest
+from mock import patch
+from mock import call
+from mock import MagicMock
+import threading
+from botocore.exceptions import ClientError
+from botocore.exceptions import EndpointConnectionError
+from notification_backend.retry import AdaptiveRateLimiter
+from notification_backend.retry import RetryPolicy
+from notification_backend.invocation import bind_invocation
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.retry.random.uniform')
+        self.addCleanup(patcher1.stop)
+        patcher1.start().side_effect = lambda low, high: high
+
+        self.policy = RetryPolicy(4, 0.05, 0.08, 5, 0.5)
+        patcher2 = patch.object(self.policy, 'sleep')
+        self.addCleanup(patcher2.stop)
+        self.mock_sleep = patcher2.start()
+        self.throttled = ClientError({"Error": {"Code": "ThrottlingException"}}, "Query")  # NOQA
+
+    def test_limiter_unlimited(self):
+        limiter = AdaptiveRateLimiter(5)
+        for i in range(10):
+            self.assertEqual(limiter.acquire(), 0)
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, None)
+
+    def test_limiter_throttled(self):
+        limiter = AdaptiveRateLimiter(5)
+        limiter.measured_rate = 100
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 70)
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 49)
+
+        # Requests are spread out at the reduced rate
+        limiter.acquire()
+        self.assertTrue(0.015 < limiter.acquire() <= 1.0 / 49)
+
+        for i in range(20):
+            limiter.throttled()
+        self.assertEqual(limiter.rate, 5)
+
+    def test_limiter_recovers(self):
+        limiter = AdaptiveRateLimiter(5, growth=2)
+        limiter.measured_rate = 40
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 28)
+        limiter.succeeded()
+        # The limit is lifted once back at the rate that got throttled
+        self.assertEqual(limiter.throttled_rate, None)
+        self.assertEqual(limiter.rate, None)
+
+    def test_policy_retries_throttles(self):
+        operation = MagicMock(side_effect=[self.throttled, "result"])
+        result = self.policy.call(("endpoint", "table"), operation, Key="key")  # NOQA
+        self.assertEqual(result, "result")
+        self.assertEqual(operation.mock_calls, [call(Key="key")] * 2)
+        self.assertEqual(self.mock_sleep.mock_calls, [call(0.05)])
+
+    @patch('notification_backend.retry.RetryPolicy.pace')
+    def test_policy_gives_up(self, mock_pace):
+        operation = MagicMock(side_effect=self.throttled)
+        with self.assertRaises(ClientError):
+            self.policy.call(("endpoint", "table"), operation)
+        self.assertEqual(len(operation.mock_calls), 4)
+        # Backoff is capped
+        self.assertEqual(self.mock_sleep.mock_calls,
+                         [call(0.05), call(0.08), call(0.08)])
+        stats = self.policy.stats()
+        self.assertEqual(stats.get('throttles'), 4)
+        self.assertEqual(stats.get('retries'), 3)
+        self.assertEqual(stats.get('exhausted'), 1)
+        self.assertEqual(stats.get('rate_limited_tables'), 1)
+
+    def test_policy_deadline(self):
+        operation = MagicMock(side_effect=self.throttled)
+        # Only the reserved time left, no time for retries
+        self.policy.set_deadline(0.5)
+        self.addCleanup(self.policy.set_deadline, None)
+        with self.assertRaises(ClientError):
+            self.policy.call(("endpoint", "table"), operation)
+        self.assertEqual(len(operation.mock_calls), 1)
+        self.assertEqual(self.policy.stats().get('exhausted'), 1)
+
+    def test_policy_pacing(self):
+        limiter = self.policy.limiter(("endpoint", "table"))
+        limiter.rate = 2
+        limiter.throttled_rate = 100
+        self.policy.call(("endpoint", "table"), MagicMock())
+        self.policy.call(("endpoint", "table"), MagicMock())
+        self.assertEqual(len(self.mock_sleep.mock_calls), 1)
+        self.assertTrue(0.4 < self.mock_sleep.call_args[0][0] <= 0.5)
+        stats = self.policy.stats()
+        self.assertEqual(stats.get('paced'), 1)
+        self.assertEqual(stats.get('requests'), 2)
+
+    def test_policy_other_errors(self):
+        operation = MagicMock(side_effect=ClientError({"Error": {"Code": "ValidationException"}}, "Query"))  # NOQA
+        with self.assertRaises(ClientError):
+            self.policy.call(("endpoint", "table"), operation)
+        self.assertEqual(len(operation.mock_calls), 1)
+        self.assertEqual(self.policy.stats().get('throttles'), 0)
+
+    def test_policy_retries_transient_errors(self):
+        server_error = ClientError({
+            "Error": {"Code": "InternalServerError"},
+            "ResponseMetadata": {"HTTPStatusCode": 500}
+        }, "Query")
+        unavailable = ClientError({
+            "Error": {"Code": "Unknown"},
+            "ResponseMetadata": {"HTTPStatusCode": 503}
+        }, "Query")
+        connection_error = EndpointConnectionError(endpoint_url="endpoint")
+        operation = MagicMock(side_effect=[server_error,
+                                           unavailable,
+                                           connection_error,
+                                           "result"])
+        result = self.policy.call(("endpoint", "table"), operation)
+        self.assertEqual(result, "result")
+        stats = self.policy.stats()
+        self.assertEqual(stats.get('errors'), 3)
+        self.assertEqual(stats.get('retries'), 3)
+        # Failures don't slow the table down, unlike throttles
+        self.assertEqual(stats.get('throttles'), 0)
+        self.assertEqual(stats.get('rate_limited_tables'), 0)
+
+    def test_deadline_bound_to_other_threads(self):
+        time_left = []
+
+        def work():
+            time_left.append(self.policy.time_left())
+        self.policy.set_deadline(10)
+        self.addCleanup(self.policy.set_deadline, None)
+        worker = threading.Thread(target=bind_invocation(work))
+        worker.start()
+        worker.join()
+        self.assertTrue(9 < time_left[0] <= 9.5)
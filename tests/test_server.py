@@ -0,0 +1,394 @@
+import unittest
+import BaseHTTPServer
+import httplib
+import json
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import jwt
+from mock import patch
+from mock import MagicMock
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+import server
+
+
+class SlowGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = json.dumps({"message": "Not Found"})
+        self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('server.handle_request')
+        self.addCleanup(patcher1.stop)
+        self.mock_handle_request = patcher1.start()
+        self.mock_handle_request.return_value = (200, {"data": []}, {})
+
+    def start_server(self, argv):
+        httpd = server.create_server(server.parse_args(argv))
+        server_thread = threading.Thread(target=httpd.serve_forever,
+                                         args=(0.05,))
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        return httpd
+
+    def test_default_server(self):
+        args = server.parse_args(["127.0.0.1", "8081"])
+        self.assertEqual(args.threads, 0)
+        self.assertEqual(args.queue_size, 64)
+        httpd = self.start_server(["127.0.0.1", "0"])
+        self.assertFalse(isinstance(httpd, server.ThreadPoolHTTPServer))
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        conn.request("GET", "/notification/ping")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read()), {"data": []})
+
+    def test_keep_alive(self):
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "2"])
+        self.assertTrue(isinstance(httpd, server.ThreadPoolHTTPServer))
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        for i in range(3):
+            conn.request("GET", "/notification/threads")
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.version, 11)
+            self.assertEqual(json.loads(response.read()), {"data": []})
+        conn.request("PATCH", "/notification/threads/1", json.dumps({"a": 1}))  # NOQA
+        response = conn.getresponse()
+        response.read()
+        self.assertEqual(self.mock_handle_request.call_args[0][0], {"a": 1})
+        self.assertEqual(len(self.mock_handle_request.mock_calls), 4)
+
+    def test_concurrent_requests(self):
+        def slow_request(*args):
+            time.sleep(0.3)
+            return (200, {"data": []}, {})
+        self.mock_handle_request.side_effect = slow_request
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "4"])
+
+        def make_request():
+            conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+            conn.request("GET", "/notification/threads")
+            conn.getresponse().read()
+            conn.close()
+
+        clients = [threading.Thread(target=make_request) for i in range(4)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.assertTrue(time.time() - start < 0.9)
+        self.assertEqual(len(self.mock_handle_request.mock_calls), 4)
+
+    def test_not_modified(self):
+        self.mock_handle_request.return_value = (304, {}, {"ETag": '"abc"'})
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "1"])
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        for i in range(2):
+            conn.request("GET", "/notification/threads",
+                         headers={"If-None-Match": '"abc"'})
+            response = conn.getresponse()
+            self.assertEqual(response.status, 304)
+            self.assertEqual(response.getheader("ETag"), '"abc"')
+            self.assertEqual(response.read(), "")
+        headers = self.mock_handle_request.call_args[0][1]
+        self.assertEqual(headers.get("If-None-Match"), '"abc"')
+
+    def test_streamed_response(self):
+        lines = ['{"id": %s}\n' % i for i in range(3)]
+        self.mock_handle_request.side_effect = lambda *args: (
+            200,
+            iter(lines),
+            {"Content-Type": "application/x-ndjson"}
+        )
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "1"])
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        for i in range(2):
+            conn.request("GET", "/notification/threads/export")
+            response = conn.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")  # NOQA
+            self.assertEqual(response.getheader("Content-Type"),
+                             "application/x-ndjson")
+            self.assertEqual(response.read(), "".join(lines))
+
+        conn.request("GET", "/notification/threads/export",
+                     headers={"Accept-Encoding": "gzip"})
+        response = conn.getresponse()
+        self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+        self.assertEqual(zlib.decompress(response.read(), 16 + zlib.MAX_WBITS),  # NOQA
+                         "".join(lines))
+
+    def test_streamed_response_http10(self):
+        self.mock_handle_request.return_value = (200, iter(["a\n", "b\n"]), {})  # NOQA
+        httpd = self.start_server(["127.0.0.1", "0"])
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        conn.request("GET", "/notification/threads/export")
+        response = conn.getresponse()
+        self.assertEqual(response.getheader("Transfer-Encoding"), None)
+        self.assertEqual(response.read(), "a\nb\n")
+
+    def test_streamed_response_aborted(self):
+        def lines():
+            yield "a\n"
+            raise ValueError("datastore went away")
+        self.mock_handle_request.return_value = (200, lines(), {})
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "1"])
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        conn.request("GET", "/notification/threads/export")
+        response = conn.getresponse()
+        # The response never gets its last chunk
+        with self.assertRaises(httplib.IncompleteRead):
+            response.read()
+
+    def test_stream_chunks(self):
+        chunks = list(server.stream_chunks(["aaa", "bb", "c", "dddd"], 4))
+        self.assertEqual(chunks, ["aaabb", "cdddd"])
+        self.assertEqual(list(server.stream_chunks([], 4)), [])
+
+    def test_metrics(self):
+        server.request_latency.reset()
+        self.addCleanup(server.request_latency.reset)
+        self.mock_handle_request.side_effect = [
+            (200, {"data": []}, {}),
+            (404, {"errors": []}, {})
+        ]
+        httpd = self.start_server(["127.0.0.1", "0", "--threads", "1"])
+        conn = httplib.HTTPConnection("127.0.0.1", httpd.server_port)
+        for path in ["/notification/threads/1", "/notification/threads/2"]:
+            conn.request("GET", path)
+            conn.getresponse().read()
+        conn.request("GET", "/notification/metrics")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Content-Type"),
+                         "text/plain; version=0.0.4")
+        lines = response.read().split("\n")
+        for status in ["200", "404"]:
+            self.assertTrue('notification_http_request_duration_seconds_count{route="/notification/threads/{thread-id}",method="GET",status="%s"} 1' % status in lines)  # NOQA
+        # ...along with the request for the metrics themselves
+        self.assertTrue("notification_http_requests_in_flight 1" in lines)
+        self.assertTrue("notification_http_requests_queued 0" in lines)
+        self.assertTrue(any(l.startswith('notification_cache_hit_ratio{cache="jwt"} ') for l in lines))  # NOQA
+        self.assertTrue(any(l.startswith("notification_write_behind_pending ") for l in lines))  # NOQA
+        self.assertEqual(len(self.mock_handle_request.mock_calls), 2)
+
+    def test_metric_route(self):
+        self.assertEqual(server.metric_route("/notification/threads/123?a=1"),  # NOQA
+                         "/notification/threads/{thread-id}")
+        self.assertEqual(server.metric_route("/notification/sync"),
+                         "/notification/sync")
+        self.assertEqual(server.metric_route("/favicon.ico"), "other")
+
+    def test_queue_full(self):
+        httpd = server.ThreadPoolHTTPServer(("127.0.0.1", 0),
+                                            server.KeepAliveNotificationBackend,  # NOQA
+                                            0,
+                                            1)
+        self.addCleanup(httpd.server_close)
+        httpd.process_request(MagicMock(), ("127.0.0.1", 1111))
+        rejected = MagicMock()
+        httpd.process_request(rejected, ("127.0.0.1", 2222))
+        self.assertTrue(rejected.sendall.call_args[0][0].startswith("HTTP/1.1 503"))  # NOQA
+        self.assertEqual(httpd.pending_requests.qsize(), 1)
+
+
+class TestHandleRequest(unittest.TestCase):
+
+    def test_conditional_request_headers(self):
+        with patch('server.handler') as mock_handler:
+            mock_handler.return_value = {
+                "http_status": 200,
+                "data": {},
+                "headers": {"ETag": '"abc"'}
+            }
+            with patch.dict('os.environ', {
+                "DYNAMODB_ENDPOINT_URL": "http://localhost:1",
+                "NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME": "table",
+                "NOTIFICATION_USER_NOTIFICATION_DATE_DYNAMODB_INDEX_NAME": "index",  # NOQA
+                "NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME": "changes"  # NOQA
+            }):
+                result = server.handle_request({}, {
+                    "If-None-Match": '"abc"',
+                    "If-Modified-Since": "Tue, 12 Apr 2016 06:40:17 GMT",
+                    "X-Debug-Timings": "1"
+                }, "/notification/threads", "GET")
+        self.assertEqual(result, (200, {}, {"ETag": '"abc"'}))
+        event = mock_handler.call_args[0][0]
+        self.assertEqual(event.get('if_none_match'), '"abc"')
+        self.assertEqual(event.get('if_modified_since'),
+                         "Tue, 12 Apr 2016 06:40:17 GMT")
+        self.assertEqual(event.get('debug_timings'), "1")
+
+    @patch('notification_backend.http.STORAGE_ENGINE', 'memory')
+    def test_create_storage_tables(self):
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        with patch.dict('os.environ', {
+            "DYNAMODB_ENDPOINT_URL": "http://localhost:1",
+            "NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME": "table",
+            "NOTIFICATION_USER_NOTIFICATION_DATE_DYNAMODB_INDEX_NAME": "index",  # NOQA
+            "NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME": "changes",  # NOQA
+            "NOTIFICATION_USER_NOTIFICATION_TAG_DYNAMODB_TABLE_NAME": "tags"  # NOQA
+        }):
+            os.environ.pop('NOTIFICATION_GITHUB_NOT_FOUND_DYNAMODB_TABLE_NAME', None)  # NOQA
+            server.create_storage_tables()
+        engine = storage_engine("http://localhost:1")
+        engine.put_item("table", {"user_id": 1, "thread_id": 1, "updated_at": 10})  # NOQA
+        items, last_key = engine.query("table",
+                                       Key('user_id').eq(1),
+                                       index_name="index")
+        self.assertEqual(len(items), 1)
+        engine.put_item("tags", {"index_key": "1#tag:x", "thread_id": 1})
+        with self.assertRaises(ClientError):
+            engine.get_item("github-not-found", {"user_id": 1, "thread_id": 1})  # NOQA
+
+
+class TestPreforkServer(unittest.TestCase):
+
+    def start_process(self, extra_env=None, threads=2):
+        free_socket = socket.socket()
+        free_socket.bind(("127.0.0.1", 0))
+        self.port = free_socket.getsockname()[1]
+        free_socket.close()
+
+        env = dict(os.environ)
+        env.update({
+            "DYNAMODB_ENDPOINT_URL": "http://localhost:1",
+            "NOTIFICATION_USER_NOTIFICATION_DYNAMODB_TABLE_NAME": "table",
+            "NOTIFICATION_USER_NOTIFICATION_DATE_DYNAMODB_INDEX_NAME": "index",
+            "NOTIFICATION_USER_NOTIFICATION_CHANGE_DYNAMODB_INDEX_NAME": "changes"  # NOQA
+        })
+        env.update(extra_env or {})
+        server_path = os.path.join(os.path.dirname(__file__), "..", "server.py")  # NOQA
+        self.process = subprocess.Popen(
+            [sys.executable, server_path, "127.0.0.1", str(self.port),
+             "--workers", "2", "--threads", str(threads)],
+            stderr=subprocess.PIPE,
+            env=env
+        )
+        self.addCleanup(self.stop_process)
+        self.log_lines = []
+        log_thread = threading.Thread(target=self.read_log)
+        log_thread.daemon = True
+        log_thread.start()
+
+    def stop_process(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def read_log(self):
+        for line in iter(self.process.stderr.readline, ""):
+            self.log_lines.append(line)
+
+    def wait_for_log(self, text, count, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if len([l for l in self.log_lines if text in l]) >= count:
+                return
+            time.sleep(0.05)
+        self.fail("'%s' was not logged %s times: %s" % (text, count, self.log_lines))  # NOQA
+
+    def ping(self):
+        conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("GET", "/notification/ping")
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertTrue("version" in json.loads(response.read()).get('meta'))  # NOQA
+        conn.close()
+
+    def test_workers(self):
+        self.start_process()
+        self.wait_for_log("(generation 0)", 2)
+        for i in range(5):
+            self.ping()
+
+        self.process.send_signal(signal.SIGHUP)
+        self.wait_for_log("(generation 1)", 2)
+        self.wait_for_log("exited with status 0", 2)
+        self.ping()
+
+        self.process.send_signal(signal.SIGUSR1)
+        self.wait_for_log("generation 1, up", 2)
+
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(), 0)
+        self.wait_for_log("exited with status 0", 4)
+
+    def test_workers_open_their_own_storage(self):
+        database_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, database_dir)
+        database = os.path.join(database_dir, "notifications.db")
+        self.start_process({
+            "STORAGE_ENGINE": "sqlite",
+            "SQLITE_DATABASE": database
+        })
+        self.wait_for_log("(generation 0)", 2)
+        self.ping()
+        # The tables got created by the workers, on connections of their own
+        tables = sqlite3.connect(database).execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        self.assertEqual(tables, [("table",)])
+
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(), 0)
+
+    def test_slow_request(self):
+        github = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), SlowGitHubHandler)  # NOQA
+        github.delay = 4
+        github_thread = threading.Thread(target=github.serve_forever,
+                                         args=(0.05,))
+        github_thread.daemon = True
+        github_thread.start()
+        self.addCleanup(github.server_close)
+        self.addCleanup(github.shutdown)
+
+        # Workers without threads of their own, busy with the request for
+        # longer than HEARTBEAT_TIMEOUT
+        self.start_process({
+            "STORAGE_ENGINE": "memory",
+            "GITHUB_API_URL": "http://127.0.0.1:%s" % github.server_port,
+            "HEARTBEAT_TIMEOUT": "2"
+        }, threads=0)
+        self.wait_for_log("(generation 0)", 2)
+        token = jwt.encode({"sub": "333333", "github_token": "ghtoken"},
+                           "supersekr3t",
+                           algorithm='HS256')
+        conn = httplib.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        conn.request("GET", "/notification/threads/12345678",
+                     headers={"Authorization": "Bearer %s" % token})
+        response = conn.getresponse()
+        self.assertEqual(response.status, 404)
+        conn.close()
+        self.assertEqual([l for l in self.log_lines if "missed its heartbeats" in l], [])  # NOQA
+
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(), 0)
@@ -0,0 +1,309 @@
+import unittest
+import jwt
+from decimal import Decimal
+from mock import patch
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key, Attr
+from notification_backend.storage import MemoryStorage
+from notification_backend.storage import SQLiteStorage
+from notification_backend.http import dynamodb_query
+from notification_backend.http import dynamodb_new_item
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.notification_threads import NotificationThreads
+
+
+class StorageTests(object):
+
+    def setUp(self):
+        self.storage = self.create_storage()
+        self.storage.create_table(
+            "threads",
+            [("user_id", "N"), ("thread_id", "N")],
+            indexes={
+                "threads-date": ("updated_at", "N"),
+                "threads-change": ("change_version", "N")
+            }
+        )
+        for thread_id, updated_at in [(3, 30), (1, 10), (2, 20), (4, 20)]:
+            self.storage.put_item("threads", {
+                "user_id": 1,
+                "thread_id": thread_id,
+                "updated_at": updated_at,
+                "reason": "mention" if thread_id % 2 else "comment",
+                "tags": ["tag%s" % thread_id]
+            })
+        # Without an updated_at, so not in the date index
+        self.storage.put_item("threads", {
+            "user_id": 1,
+            "thread_id": 0,
+            "user_version": 4
+        })
+        self.storage.put_item("threads", {
+            "user_id": 2,
+            "thread_id": 1,
+            "updated_at": 10
+        })
+
+    def thread_ids(self, items):
+        return [int(i['thread_id']) for i in items]
+
+    def test_get_item(self):
+        item = self.storage.get_item("threads",
+                                     {"user_id": "1", "thread_id": 2},
+                                     projection=["updated_at", "tags"])
+        self.assertEqual(item, {"updated_at": Decimal(20), "tags": ["tag2"]})
+        self.assertTrue(isinstance(item['updated_at'], Decimal))
+        self.assertEqual(self.storage.get_item("threads", {"user_id": 1, "thread_id": 9}), None)  # NOQA
+
+    def test_query(self):
+        items, last_key = self.storage.query(
+            "threads",
+            Key('user_id').eq(1) & Key('thread_id').gt(0)
+        )
+        self.assertEqual(self.thread_ids(items), [1, 2, 3, 4])
+        self.assertEqual(last_key, None)
+
+    def test_query_pages(self):
+        key = Key('user_id').eq("1") & Key('thread_id').between(1, 4)
+        items, last_key = self.storage.query("threads", key, limit=3)
+        self.assertEqual(self.thread_ids(items), [1, 2, 3])
+        self.assertEqual(last_key, {"user_id": 1, "thread_id": 3})
+        items, last_key = self.storage.query("threads", key, limit=3,
+                                             exclusive_start_key=last_key)
+        self.assertEqual(self.thread_ids(items), [4])
+        self.assertEqual(last_key, None)
+
+    def test_query_index(self):
+        key = Key('user_id').eq(1) & Key('updated_at').gte(20)
+        items, last_key = self.storage.query("threads", key,
+                                             index_name="threads-date")
+        self.assertEqual(self.thread_ids(items), [2, 4, 3])
+
+        items, last_key = self.storage.query("threads", key,
+                                             index_name="threads-date",
+                                             scan_index_forward=False,
+                                             limit=2)
+        self.assertEqual(self.thread_ids(items), [3, 4])
+        self.assertEqual(last_key,
+                         {"user_id": 1, "thread_id": 4, "updated_at": 20})
+        items, last_key = self.storage.query("threads", key,
+                                             index_name="threads-date",
+                                             scan_index_forward=False,
+                                             exclusive_start_key=last_key)
+        self.assertEqual(self.thread_ids(items), [2])
+
+        # Items without the index's sort key are not in the index
+        items, last_key = self.storage.query("threads",
+                                             Key('user_id').eq(1),
+                                             index_name="threads-date")
+        self.assertEqual(self.thread_ids(items), [1, 2, 4, 3])
+
+    def test_query_filter(self):
+        items, last_key = self.storage.query(
+            "threads",
+            Key('user_id').eq(1),
+            filter_expression=Attr('reason').eq("mention") & Attr('tags').contains("tag3")  # NOQA
+        )
+        self.assertEqual(self.thread_ids(items), [3])
+
+    def test_conditional_put(self):
+        condition = Attr("user_id").eq("1") & Attr("deleted_at").not_exists()
+        old_item = self.storage.put_item(
+            "threads",
+            {"user_id": 1, "thread_id": 2, "deleted_at": 50},
+            condition_expression=condition,
+            return_values="ALL_OLD"
+        )
+        self.assertEqual(old_item.get('reason'), "comment")
+        with self.assertRaises(ClientError) as cm:
+            self.storage.put_item(
+                "threads",
+                {"user_id": 1, "thread_id": 2, "deleted_at": 60},
+                condition_expression=condition
+            )
+        self.assertEqual(cm.exception.response['Error']['Code'],
+                         "ConditionalCheckFailedException")
+        self.assertEqual(
+            self.storage.get_item("threads", {"user_id": 1, "thread_id": 2}),
+            {"user_id": 1, "thread_id": 2, "deleted_at": 50}
+        )
+
+    def test_update_item(self):
+        result = self.storage.update_item(
+            "threads",
+            {"user_id": 1, "thread_id": 0},
+            "add user_version :n set changed_at=:now",
+            {":n": 2, ":now": 100}
+        )
+        self.assertEqual(result, {"Attributes": {"user_version": 6, "changed_at": 100}})  # NOQA
+
+        result = self.storage.update_item(
+            "threads",
+            {"user_id": "1", "thread_id": 3},
+            "set reason=:r, change_version=:c remove tags, deleted_at",
+            {":r": "comment", ":c": 7},
+            return_values="ALL_OLD"
+        )
+        self.assertEqual(result['Attributes'].get('reason'), "mention")
+        items, last_key = self.storage.query(
+            "threads",
+            Key('user_id').eq(1) & Key('change_version').gt(5),
+            index_name="threads-change"
+        )
+        self.assertEqual(items, [{
+            "user_id": 1,
+            "thread_id": 3,
+            "updated_at": 30,
+            "reason": "comment",
+            "change_version": 7
+        }])
+
+        # Updates of missing items create them
+        self.storage.update_item("threads", {"user_id": 3, "thread_id": 0},
+                                 "add user_version :n", {":n": 1})
+        self.assertEqual(
+            self.storage.get_item("threads", {"user_id": 3, "thread_id": 0}),
+            {"user_id": 3, "thread_id": 0, "user_version": 1}
+        )
+
+    def test_delete_item(self):
+        with self.assertRaises(ClientError):
+            self.storage.delete_item("threads",
+                                     {"user_id": 1, "thread_id": 1},
+                                     condition_expression=Attr('reason').eq("comment"))  # NOQA
+        self.storage.delete_item("threads", {"user_id": 1, "thread_id": 1})
+        items, last_key = self.storage.query("threads",
+                                             Key('user_id').eq(1),
+                                             index_name="threads-date")
+        self.assertEqual(self.thread_ids(items), [2, 4, 3])
+
+    def test_batches(self):
+        unprocessed = self.storage.batch_write(
+            "threads",
+            put_items=[{"user_id": 1, "thread_id": 5, "updated_at": 50}],
+            delete_keys=[{"user_id": 1, "thread_id": 4}]
+        )
+        self.assertEqual(unprocessed, [])
+        items, unprocessed_keys = self.storage.batch_get(
+            "threads",
+            [{"user_id": 1, "thread_id": t} for t in [3, 4, 5]],
+            projection=["thread_id"]
+        )
+        self.assertEqual(items, [{"thread_id": 3}, {"thread_id": 5}])
+        self.assertEqual(unprocessed_keys, [])
+
+    def test_scan_segments(self):
+        segments = []
+        for segment in range(3):
+            items, last_key = self.storage.scan(
+                "threads",
+                filter_expression=Attr('thread_id').gt(0),
+                segment=segment,
+                total_segments=3,
+                projection=["user_id", "thread_id"]
+            )
+            segments.extend((i['user_id'], i['thread_id']) for i in items)
+        self.assertEqual(sorted(segments),
+                         [(1, 1), (1, 2), (1, 3), (1, 4), (2, 1)])
+
+    def test_missing_table(self):
+        with self.assertRaises(ClientError) as cm:
+            self.storage.get_item("fake", {"user_id": 1, "thread_id": 1})
+        self.assertEqual(cm.exception.response['Error']['Code'],
+                         "ResourceNotFoundException")
+
+    def test_floats_refused(self):
+        with self.assertRaises(TypeError):
+            self.storage.put_item("threads",
+                                  {"user_id": 1, "thread_id": 9, "f": 0.5})
+
+
+class TestMemoryStorage(StorageTests, unittest.TestCase):
+
+    def create_storage(self):
+        return MemoryStorage()
+
+
+class TestSQLiteStorage(StorageTests, unittest.TestCase):
+
+    def create_storage(self):
+        return SQLiteStorage(":memory:")
+
+    def test_batch_is_one_transaction(self):
+        with self.assertRaises(TypeError):
+            self.storage.batch_write("threads", put_items=[
+                {"user_id": 1, "thread_id": 5},
+                {"user_id": 1, "thread_id": 6, "f": 0.5}
+            ])
+        self.assertEqual(
+            self.storage.get_item("threads", {"user_id": 1, "thread_id": 5}),
+            None
+        )
+
+
+class TestStorageEngine(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+
+        storage_engine("http://example.com").create_table(
+            "fakethreads",
+            [("user_id", "N"), ("thread_id", "N")]
+        )
+        self.token = jwt.encode({"sub": "333333"}, "shhsekret",
+                                algorithm='HS256')
+
+    def test_engine_per_endpoint(self):
+        dynamodb_new_item("http://example.com", "fakethreads",
+                          {"user_id": 1, "thread_id": 1})
+        items, last_key = dynamodb_query("http://example.com", "fakethreads",
+                                         Key('user_id').eq(1))
+        self.assertEqual(items, [{"user_id": 1, "thread_id": 1}])
+        self.assertTrue(storage_engine("http://example.com") is storage_engine("http://example.com"))  # NOQA
+        self.assertFalse(storage_engine("http://example.com") is storage_engine("http://example.org"))  # NOQA
+
+    @patch('notification_backend.http.STORAGE_ENGINE', 'fake')
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            storage_engine("http://example.org")
+
+    def test_notification_threads(self):
+        lambda_event = {
+            "jwt_signing_secret": "shhsekret",
+            "bearer_token": "Bearer %s" % self.token,
+            "resource-path": "/notification/threads/{thread-id}",
+            "threadid": "123456",
+            "payload": {
+                "data": {
+                    "id": 123456,
+                    "type": "threads",
+                    "attributes": {
+                        "reason": "mention",
+                        "updated-at": 1460443217,
+                        "tags": ["mentioned"]
+                    }
+                }
+            },
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"  # NOQA
+        }
+        t = NotificationThreads(lambda_event)
+        t.process_thread_event("update_thread")
+
+        t = NotificationThreads(lambda_event)
+        result_json = t.process_thread_event("find_thread")
+        attributes = result_json.get('data').get('data').get('attributes')
+        self.assertEqual(attributes.get('reason'), "mention")
+        self.assertEqual(attributes.get('tags'), ["mentioned"])
+
+        t = NotificationThreads(lambda_event)
+        result_json = t.process_thread_event("delete_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        with self.assertRaises(TypeError):
+            # Already deleted
+            NotificationThreads(lambda_event).process_thread_event("delete_thread")  # NOQA
@@ -0,0 +1,360 @@
+import unittest
+import BaseHTTPServer
+import json
+import jwt
+import threading
+import urlparse
+from decimal import Decimal
+from mock import patch
+from boto3.exceptions import Boto3Error
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import parse_github_thread
+from notification_backend.github import GitHubRateLimited
+from notification_backend.github import reset_github_rate_limits
+from notification_backend.github import reset_github_session
+
+
+class StubGitHubNotificationsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        self.server.requests.append({"path": url.path, "query": query})
+        page = int(query.get('page', 1))
+        status = self.server.statuses.get(page, 200)
+        body = json.dumps(self.server.pages[page - 1])
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Poll-Interval", "60")
+        self.send_header("X-RateLimit-Remaining", "4000")
+        if page < len(self.server.pages):
+            self.send_header("Link", '<http://127.0.0.1:%s/notifications?page=%s>; rel="next"' % (self.server.server_port, page + 1))  # NOQA
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def github_notification(thread_id, reason, updated_at):
+    return {
+        "id": str(thread_id),
+        "reason": reason,
+        "updated_at": updated_at,
+        "url": "https://api.github.com/notifications/threads/%s" % thread_id,
+        "subscription_url": "https://api.github.com/notifications/threads/%s/subscription" % thread_id,  # NOQA
+        "subject": {
+            "title": "Thread %s" % thread_id,
+            "url": "https://api.github.com/repos/octocat/left-pad/issues/%s" % thread_id,  # NOQA
+            "type": "Issue"
+        },
+        "repository": {
+            "name": "left-pad",
+            "owner": {"login": "octocat"}
+        }
+    }
+
+
+class TestSyncThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                StubGitHubNotificationsHandler)  # NOQA
+        self.server.requests = []
+        self.server.statuses = {}
+        self.server.pages = [
+            [
+                github_notification(1, "mention", "2016-04-12T01:40:17Z"),
+                github_notification(2, "subscribed", "2016-04-12T01:30:00Z")
+            ],
+            [
+                github_notification(3, "comment", "2016-04-12T01:20:00Z")
+            ]
+        ]
+        server_thread = threading.Thread(target=self.server.serve_forever,
+                                         args=(0.05,))
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        patcher1 = patch('notification_backend.github.GITHUB_API_URL',
+                         "http://127.0.0.1:%s" % self.server.server_port)
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_github_session()
+        self.addCleanup(reset_github_session)
+        reset_github_rate_limits()
+        self.addCleanup(reset_github_rate_limits)
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_get_item')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_get_item = patcher2.start()
+        self.mock_db_get_item.return_value = None
+
+        patcher3 = patch('notification_backend.notification_threads.dynamodb_batch_get')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_db_batch_get = patcher3.start()
+        self.mock_db_batch_get.return_value = ([], [])
+
+        patcher4 = patch('notification_backend.notification_threads.dynamodb_batch_write')  # NOQA
+        self.addCleanup(patcher4.stop)
+        self.mock_db_batch_write = patcher4.start()
+        self.mock_db_batch_write.return_value = []
+
+        patcher5 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher5.stop)
+        self.mock_db_update = patcher5.start()
+        self.mock_db_update.return_value = {
+            "Attributes": {"user_version": 12}
+        }
+
+        patcher6 = patch('notification_backend.notification_threads.get_current_epoch_time')  # NOQA
+        self.addCleanup(patcher6.stop)
+        patcher6.start().return_value = 1460500000
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333", "github_token": "ghtoken"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "payload": {},
+            "resource-path": "/notification/sync",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"  # NOQA
+        }
+
+    def put_items(self):
+        return self.mock_db_batch_write.call_args[1].get('put_items')
+
+    def test_sync(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        self.assertEqual(result_json.get('http_status'), 200)
+        data = result_json.get('data')
+        self.assertEqual([d.get('id') for d in data.get('data')], [1, 2, 3])
+        self.assertEqual(data.get('data')[0].get('attributes').get('tags'),
+                         ["mentioned", "issue", "octocat", "left-pad"])
+        self.assertEqual(data.get('meta'), {
+            "since": 1460500000 - 604800,
+            "complete": True,
+            "failed": [],
+            "poll-interval": 60
+        })
+
+        self.assertEqual([r.get('query') for r in self.server.requests], [
+            {"all": "true", "since": "2016-04-05T22:26:40Z", "per_page": "50", "page": "1"},  # NOQA
+            {"all": "true", "since": "2016-04-05T22:26:40Z", "per_page": "50", "page": "2"}  # NOQA
+        ])
+        put_items = self.put_items()
+        self.assertEqual([i.get('thread_id') for i in put_items], [1, 2, 3])
+        self.assertEqual([i.get('change_version') for i in put_items],
+                         [10, 11, 12])
+        self.assertEqual(put_items[0].get('user_id'), 333333)
+        self.assertEqual(put_items[0].get('updated_at'), 1460425217)
+        self.assertEqual(put_items[0].get('subject_title'), "Thread 1")
+
+        # The next sync picks up from here
+        sync_update = self.mock_db_update.call_args[1]
+        self.assertEqual(sync_update.get('key'),
+                         {"user_id": "333333", "thread_id": 0})
+        self.assertEqual(sync_update.get('update_expression'),
+                         "set github_synced_at=:s remove github_sync_since, github_sync_before, github_sync_started_at")  # NOQA
+        self.assertEqual(sync_update.get('expr_attribute_values'),
+                         {":s": 1460500000})
+
+    def test_since(self):
+        self.mock_db_get_item.return_value = {
+            "github_synced_at": Decimal(1460400000)
+        }
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        self.assertEqual(result_json.get('data').get('meta').get('since'),
+                         1460400000)
+        self.assertEqual(self.server.requests[0].get('query').get('since'),
+                         "2016-04-11T18:40:00Z")
+
+        self.lambda_event['payload'] = {"meta": {"since": 1460000000}}
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("sync_threads")
+        self.assertEqual(self.server.requests[-1].get('query').get('since'),
+                         "2016-04-07T03:33:20Z")
+
+    def test_invalid_since(self):
+        self.lambda_event['payload'] = {"meta": {"since": "yesterday"}}
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("sync_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 400)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "'meta.since' member needs to be in epoch seconds"
+        )
+        self.assertEqual(self.server.requests, [])
+
+    def test_stored_threads(self):
+        self.mock_db_batch_get.return_value = ([
+            {
+                "user_id": Decimal(333333),
+                "thread_id": Decimal(1),
+                "reason": "subscribed",
+                "updated_at": Decimal(1460400000),
+                "tags": ["custom"],
+                "change_version": Decimal(3),
+                "github_etag": '"abc"'
+            },
+            {
+                "user_id": Decimal(333333),
+                "thread_id": Decimal(2),
+                "deleted_at": Decimal(1460440000),
+                "expires_at": Decimal(1461044800),
+                "change_version": Decimal(4)
+            },
+            {
+                "user_id": Decimal(333333),
+                "thread_id": Decimal(3),
+                "deleted_at": Decimal(1460400000),
+                "expires_at": Decimal(1461004800),
+                "change_version": Decimal(5),
+                "github_etag": '"def"'
+            }
+        ], [])
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("sync_threads")
+        put_items = self.put_items()
+        # Thread 2 was deleted after its last update on GitHub, thread 3
+        # has been updated since it was deleted
+        self.assertEqual([i.get('thread_id') for i in put_items], [1, 3])
+        self.assertEqual(put_items[0].get('tags'), ["custom"])
+        self.assertEqual(put_items[0].get('reason'), "mention")
+        self.assertEqual(put_items[1].get('tags'),
+                         ["commented", "issue", "octocat", "left-pad"])
+        self.assertFalse('deleted_at' in put_items[1])
+        self.assertFalse('expires_at' in put_items[1])
+        # GitHub's validators were for the copies stored before
+        self.assertFalse('github_etag' in put_items[0])
+        self.assertFalse('github_etag' in put_items[1])
+        keys = self.mock_db_batch_get.call_args[0][2]
+        self.assertEqual([k.get('thread_id') for k in keys], [1, 2, 3])
+
+    def test_duplicate_threads(self):
+        self.server.pages[1].append(
+            github_notification(1, "comment", "2016-04-12T02:00:00Z")
+        )
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("sync_threads")
+        put_items = self.put_items()
+        self.assertEqual([i.get('thread_id') for i in put_items], [2, 3, 1])
+        self.assertEqual(put_items[2].get('reason'), "comment")
+
+    def test_partial_sync(self):
+        self.server.statuses = {2: 500}
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        data = result_json.get('data')
+        self.assertEqual([d.get('id') for d in data.get('data')], [1, 2])
+        self.assertFalse(data.get('meta').get('complete'))
+        # Syncing again carries on with the notifications before the oldest
+        # one synced
+        sync_update = self.mock_db_update.call_args[1]
+        self.assertEqual(sync_update.get('update_expression'),
+                         "set github_sync_since=:s, github_sync_before=:b, github_sync_started_at=:t")  # NOQA
+        self.assertEqual(sync_update.get('expr_attribute_values'), {
+            ":s": 1460500000 - 604800,
+            ":b": 1460424601,
+            ":t": 1460500000
+        })
+
+    def test_resumed_sync(self):
+        self.mock_db_get_item.return_value = {
+            "github_synced_at": Decimal(1460300000),
+            "github_sync_since": Decimal(1460400000),
+            "github_sync_before": Decimal(1460424601),
+            "github_sync_started_at": Decimal(1460490000)
+        }
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        self.assertEqual(result_json.get('data').get('meta').get('since'),
+                         1460400000)
+        query = self.server.requests[0].get('query')
+        self.assertEqual(query.get('since'), "2016-04-11T18:40:00Z")
+        self.assertEqual(query.get('before'), "2016-04-12T01:30:01Z")
+        # Once done, the next sync starts from when this one did
+        self.assertEqual(self.mock_db_update.call_args[1].get('expr_attribute_values'),  # NOQA
+                         {":s": 1460490000})
+
+    def test_unchanged_threads(self):
+        stored = parse_github_thread(2, self.server.pages[0][1])
+        stored.update({
+            "user_id": Decimal(333333),
+            "tags": ["custom"],
+            "change_version": Decimal(4),
+            "github_etag": '"abc"'
+        })
+        self.mock_db_batch_get.return_value = ([stored], [])
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("sync_threads")
+        put_items = self.put_items()
+        self.assertEqual([i.get('thread_id') for i in put_items], [1, 3])
+
+    @patch('notification_backend.notification_threads.GITHUB_SYNC_MAX_PAGES', 1)  # NOQA
+    def test_max_pages(self):
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        data = result_json.get('data')
+        self.assertEqual(len(data.get('data')), 2)
+        self.assertFalse(data.get('meta').get('complete'))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_unprocessed_writes(self):
+        self.mock_db_batch_write.return_value = [
+            {"PutRequest": {"Item": {"thread_id": 2}}}
+        ]
+        self.mock_db_batch_get.return_value = ([], [{"thread_id": 3}])
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("sync_threads")
+        data = result_json.get('data')
+        self.assertEqual([d.get('id') for d in data.get('data')], [1])
+        self.assertEqual(data.get('meta').get('failed'), [2, 3])
+        self.assertFalse(data.get('meta').get('complete'))
+
+    def test_github_error(self):
+        self.server.statuses = {1: 401}
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("sync_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 502)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error fetching notifications from GitHub"
+        )
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 0)
+
+    @patch('notification_backend.notification_threads.github_get')
+    def test_github_rate_limited(self, mock_github_get):
+        mock_github_get.side_effect = GitHubRateLimited(120)
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("sync_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 503)
+        self.assertEqual(result_json.get('headers'), {"Retry-After": "120"})
+
+    def test_datastore_error(self):
+        self.mock_db_batch_write.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        with self.assertRaises(TypeError) as cm:
+            t.process_thread_event("sync_threads")
+        result_json = json.loads(str(cm.exception))
+        self.assertEqual(result_json.get('http_status'), 500)
+        self.assertEqual(
+            result_json.get('data').get('errors')[0].get('detail'),
+            "Error writing synced threads to the datastore"
+        )
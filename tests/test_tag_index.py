@@ -0,0 +1,283 @@
+import unittest
+import jwt
+from decimal import Decimal
+from mock import patch
+from boto3.exceptions import Boto3Error
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import thread_index_changes
+from notification_backend.notification_threads import rebuild_thread_index
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+
+
+class TestTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.notification_threads.dynamodb_batch_write')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_batch_write = patcher1.start()
+        self.mock_db_batch_write.return_value = []
+
+        patcher2 = patch('notification_backend.notification_threads.dynamodb_update_item')  # NOQA
+        self.addCleanup(patcher2.stop)
+        self.mock_db_update = patcher2.start()
+
+        patcher3 = patch('notification_backend.notification_threads.allocate_change_versions')  # NOQA
+        self.addCleanup(patcher3.stop)
+        self.mock_versions = patcher3.start()
+        self.mock_versions.side_effect = lambda e, t, u, count: range(1, count + 1)  # NOQA
+
+        patcher4 = patch('notification_backend.notification_threads.write_behind_queue')  # NOQA
+        self.addCleanup(patcher4.stop)
+        self.mock_queue = patcher4.start()
+        self.mock_queue.enqueue.return_value = True
+
+        # Threads read back after their index rows got written
+        patcher5 = patch('notification_backend.notification_threads.dynamodb_batch_get')  # NOQA
+        self.addCleanup(patcher5.stop)
+        self.mock_db_batch_get = patcher5.start()
+        self.mock_db_batch_get.return_value = ([], [])
+
+        self.jwt_signing_secret = "shhsekret"
+        self.token = jwt.encode({"sub": "333333"},
+                                self.jwt_signing_secret,
+                                algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": self.jwt_signing_secret,
+            "bearer_token": "Bearer %s" % self.token,
+            "resource-path": "/notification/threads/{thread-id}",
+            "threadid": "1",
+            "payload": {
+                "data": {
+                    "id": 1,
+                    "type": "threads",
+                    "attributes": {
+                        "reason": "comment",
+                        "updated-at": 1460443300,
+                        "tags": ["watching", "read"]
+                    }
+                }
+            },
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads",  # NOQA
+            "notification_user_notification_tag_dynamodb_table_name": "faketags"  # NOQA
+        }
+        self.stored = {
+            "user_id": Decimal(333333),
+            "thread_id": Decimal(1),
+            "thread_url": "http://api.example.com/fake/1",
+            "reason": "subscribed",
+            "updated_at": Decimal(1460443217),
+            "subject_title": "Fake Issue",
+            "tags": ["watching"]
+        }
+
+    def test_index_changes(self):
+        updated = dict(self.stored, reason="mention", tags=["mentioned", ""])
+        put_rows, delete_keys = thread_index_changes([self.stored], [updated])
+        self.assertEqual(
+            put_rows,
+            [
+                {
+                    "index_key": "333333#reason:mention",
+                    "user_id": 333333,
+                    "thread_id": 1,
+                    "thread_url": "http://api.example.com/fake/1",
+                    "reason": "mention",
+                    "updated_at": Decimal(1460443217),
+                    "tags": ["mentioned", ""]
+                },
+                {
+                    "index_key": "333333#tag:mentioned",
+                    "user_id": 333333,
+                    "thread_id": 1,
+                    "thread_url": "http://api.example.com/fake/1",
+                    "reason": "mention",
+                    "updated_at": Decimal(1460443217),
+                    "tags": ["mentioned", ""]
+                }
+            ]
+        )
+        self.assertEqual(delete_keys, [
+            {"index_key": "333333#reason:subscribed", "thread_id": 1},
+            {"index_key": "333333#tag:watching", "thread_id": 1}
+        ])
+
+    def test_tombstones_not_listed(self):
+        tombstone = {"user_id": 333333, "thread_id": 1, "deleted_at": 10}
+        put_rows, delete_keys = thread_index_changes([self.stored], [tombstone])  # NOQA
+        self.assertEqual(put_rows, [])
+        self.assertEqual(len(delete_keys), 2)
+
+    def test_update_thread(self):
+        self.mock_db_update.return_value = {"Attributes": self.stored}
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("update_thread")
+        self.assertEqual(self.mock_db_update.call_args[1].get('return_values'),  # NOQA
+                         "ALL_OLD")
+        self.assertEqual(self.mock_db_batch_write.call_args[0],
+                         ("http://example.com", "faketags"))
+        put_rows = self.mock_db_batch_write.call_args[1].get('put_items')
+        self.assertEqual([r['index_key'] for r in put_rows], [
+            "333333#reason:comment",
+            "333333#tag:read",
+            "333333#tag:watching"
+        ])
+        self.assertEqual(put_rows[0]['thread_url'],
+                         "http://api.example.com/fake/1")
+        self.assertEqual(put_rows[0]['updated_at'], 1460443300)
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('delete_keys'),  # NOQA
+                         [{"index_key": "333333#reason:subscribed", "thread_id": 1}])  # NOQA
+
+    def test_update_new_thread(self):
+        self.mock_db_update.return_value = {}
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        put_rows = self.mock_db_batch_write.call_args[1].get('put_items')
+        self.assertEqual(len(put_rows), 3)
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('delete_keys'),  # NOQA
+                         [])
+
+    def test_index_not_configured(self):
+        self.lambda_event.pop('notification_user_notification_tag_dynamodb_table_name')  # NOQA
+        self.mock_db_update.return_value = {"Attributes": self.stored}
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 0)
+
+    def test_index_error_does_not_fail_request(self):
+        self.mock_db_update.return_value = {"Attributes": self.stored}
+        self.mock_db_batch_write.side_effect = Boto3Error
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+
+    @patch('notification_backend.notification_threads.dynamodb_get_item')
+    @patch('notification_backend.notification_threads.dynamodb_new_item')
+    def test_delete_thread(self, mock_db_new_item, mock_db_get_item):
+        mock_db_get_item.return_value = self.stored
+        mock_db_new_item.return_value = self.stored
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("delete_thread")
+        self.assertEqual(mock_db_new_item.call_args[1].get('return_values'),
+                         "ALL_OLD")
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('put_items'),  # NOQA
+                         [])
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('delete_keys'),  # NOQA
+                         [{"index_key": "333333#reason:subscribed", "thread_id": 1},  # NOQA
+                          {"index_key": "333333#tag:watching", "thread_id": 1}])  # NOQA
+
+    def test_persisted_threads_indexed_once_written(self):
+        result = dict(self.stored, user_id=None)
+        t = NotificationThreads(self.lambda_event)
+        t.userid = "333333"
+        t.persist_thread_information(result)
+        enqueued = self.mock_queue.enqueue.call_args[0]
+        self.assertEqual(enqueued[1], "fakethreads")
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 0)
+
+        # Queued threads get listed once the queue wrote them
+        written = dict(enqueued[2], change_version=1)
+        enqueued[4](written)
+        self.assertEqual(
+            [r['index_key'] for r in self.mock_db_batch_write.call_args[1].get('put_items')],  # NOQA
+            ["333333#reason:subscribed", "333333#tag:watching"]
+        )
+
+    def test_index_reconciled(self):
+        # The thread got patched again while its rows were being written
+        self.mock_db_update.return_value = {"Attributes": self.stored}
+        self.mock_db_batch_get.return_value = ([
+            dict(self.stored, reason="mention", tags=["mentioned"],
+                 change_version=Decimal(2))
+        ], [])
+        t = NotificationThreads(self.lambda_event)
+        result_json = t.process_thread_event("update_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(self.mock_db_batch_get.call_args[1].get('consistent_read'),  # NOQA
+                         True)
+        index_writes = self.mock_db_batch_write.call_args[1]
+        self.assertEqual([r['index_key'] for r in index_writes.get('put_items')], [  # NOQA
+            "333333#reason:mention",
+            "333333#tag:mentioned"
+        ])
+        self.assertEqual([k['index_key'] for k in index_writes.get('delete_keys')], [  # NOQA
+            "333333#reason:comment",
+            "333333#tag:read",
+            "333333#tag:watching"
+        ])
+
+    def test_index_never_settles(self):
+        self.mock_db_update.return_value = {"Attributes": self.stored}
+        versions = iter(range(2, 10))
+        self.mock_db_batch_get.side_effect = lambda *a, **kw: (
+            [dict(self.stored, change_version=next(versions))], []
+        )
+        with patch('notification_backend.notification_threads.logger') as mock_logger:  # NOQA
+            t = NotificationThreads(self.lambda_event)
+            result_json = t.process_thread_event("update_thread")
+        self.assertEqual(result_json.get('http_status'), 200)
+        self.assertEqual(len(self.mock_db_batch_get.mock_calls), 3)
+        self.assertTrue("needs a rebuild" in mock_logger.error.call_args[0][0])  # NOQA
+
+    def test_bulk_update(self):
+        self.mock_db_batch_get.side_effect = [([self.stored], []), ([], [])]
+        self.lambda_event['payload']['data'] = [
+            self.lambda_event['payload']['data']
+        ]
+        t = NotificationThreads(self.lambda_event)
+        t.process_thread_event("update_threads")
+        # Threads first, then their index rows
+        self.assertEqual(self.mock_db_batch_write.mock_calls[-1][1],
+                         ("http://example.com", "faketags"))
+        index_writes = self.mock_db_batch_write.mock_calls[-1][2]
+        self.assertEqual(len(index_writes.get('put_items')), 3)
+        self.assertEqual(index_writes.get('delete_keys'),
+                         [{"index_key": "333333#reason:subscribed", "thread_id": 1}])  # NOQA
+
+
+class TestRebuildTagIndex(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        self.engine = storage_engine("http://example.com")
+        self.engine.create_table("fakethreads",
+                                 [("user_id", "N"), ("thread_id", "N")])
+        self.engine.create_table("faketags",
+                                 [("index_key", "S"), ("thread_id", "N")])
+
+    def test_rebuild(self):
+        for thread in [
+            {"user_id": 333333, "thread_id": 0, "user_version": 3},
+            {"user_id": 333333, "thread_id": 1, "reason": "mention",
+             "updated_at": 1460443217, "tags": ["mentioned"]},
+            {"user_id": 333333, "thread_id": 2, "deleted_at": 1460443217},
+            {"user_id": 444444, "thread_id": 1, "reason": "comment"}
+        ]:
+            self.engine.put_item("fakethreads", thread)
+        for index_key, thread_id, user_id in [
+            ("333333#tag:watching", 1, 333333),
+            ("333333#tag:watching", 2, 333333),
+            ("444444#reason:comment", 1, 444444)
+        ]:
+            self.engine.put_item("faketags", {"index_key": index_key,
+                                              "thread_id": thread_id,
+                                              "user_id": user_id})
+
+        self.assertEqual(
+            rebuild_thread_index("http://example.com", "fakethreads",
+                                 "faketags", 333333),
+            (2, 2)
+        )
+        rows, last_key = self.engine.scan("faketags")
+        self.assertEqual(sorted((r['index_key'], r['thread_id']) for r in rows), [  # NOQA
+            ("333333#reason:mention", 1),
+            ("333333#tag:mentioned", 1),
+            ("444444#reason:comment", 1)
+        ])
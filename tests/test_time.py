@@ -1,7 +1,12 @@
 import unittest
+import datetime
+import iso8601
+import pytz
 from freezegun import freeze_time
 from notification_backend.time import get_epoch_time
+from notification_backend.time import get_github_epoch_time
 from notification_backend.time import get_current_epoch_time
+from notification_backend.time import get_github_timestamp
 
 
 class TestTime(unittest.TestCase):
@@ -15,3 +20,31 @@ class TestTime(unittest.TestCase):
         iso_str = "2016-04-12T01:40:17Z"
         c_time = get_epoch_time(iso_str)
         self.assertEqual(c_time, 1460425217)
+
+    def test_get_epoch_time_matches_general_parser(self):
+        epoch_datetime = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+        for year in [1, 1899, 1900, 1969, 1970, 2000, 2016, 2100, 9999]:
+            for month in range(1, 13):
+                for day in [1, 28, 29, 30, 31]:
+                    iso_str = "%04d-%02d-%02dT23:59:59Z" % (year, month, day)
+                    try:
+                        expected = int((iso8601.parse_date(iso_str) - epoch_datetime).total_seconds())  # NOQA
+                    except iso8601.ParseError:
+                        self.assertEqual(get_github_epoch_time(iso_str), None)  # NOQA
+                        continue
+                    self.assertEqual(get_github_epoch_time(iso_str), expected)  # NOQA
+
+    def test_get_epoch_time_fallback(self):
+        self.assertEqual(get_github_epoch_time("2016-04-12T03:40:17+02:00"), None)  # NOQA
+        self.assertEqual(get_epoch_time("2016-04-12T03:40:17+02:00"), 1460425217)  # NOQA
+        self.assertEqual(get_epoch_time("2016-04-12T01:40:17.5Z"), 1460425217)  # NOQA
+        self.assertEqual(get_github_epoch_time("2016-04-12T01:40:+7Z"), None)  # NOQA
+
+    def test_get_epoch_time_invalid(self):
+        for iso_str in ["2016-13-12T01:40:17Z", "2015-02-29T01:40:17Z", "fake"]:  # NOQA
+            with self.assertRaises(iso8601.ParseError):
+                get_epoch_time(iso_str)
+
+    def test_get_github_timestamp(self):
+        self.assertEqual(get_github_timestamp(1460425217), "2016-04-12T01:40:17Z")  # NOQA
+        self.assertEqual(get_epoch_time(get_github_timestamp(951782400)), 951782400)  # NOQA
@@ -0,0 +1,127 @@
+import unittest
+import threading
+import jwt
+from mock import patch
+from notification_backend.entrypoint import handler
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.tracing import span
+from notification_backend.tracing import traced
+from notification_backend.tracing import start_trace
+from notification_backend.tracing import stop_trace
+from notification_backend.tracing import current_trace
+from notification_backend.tracing import NO_SPAN
+from notification_backend.invocation import bind_invocation
+
+
+@traced("lookup")
+def lookup(value):
+    return value * 2
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(stop_trace)
+
+    def counts(self, trace):
+        return dict((path, s['count'])
+                    for path, s in trace.timings()['spans'].items())
+
+    def test_not_traced(self):
+        self.assertEqual(current_trace(), None)
+        self.assertIs(span("query"), NO_SPAN)
+        self.assertEqual(lookup(2), 4)
+
+    def test_nested_spans(self):
+        trace = start_trace()
+        with span("find_thread"):
+            for page in range(3):
+                with span("query"):
+                    pass
+            self.assertEqual(lookup(2), 4)
+        with span("query"):
+            pass
+        self.assertEqual(self.counts(trace), {
+            "find_thread": 1,
+            "find_thread/query": 3,
+            "find_thread/lookup": 1,
+            "query": 1
+        })
+        self.assertEqual(list(trace.timings()['spans'].keys()), [
+            "find_thread",
+            "find_thread/query",
+            "find_thread/lookup",
+            "query"
+        ])
+        self.assertTrue(trace.timings()['total-ms'] >= 0)
+
+    def test_span_left_on_error(self):
+        trace = start_trace()
+        with self.assertRaises(ValueError):
+            with span("find_thread"):
+                raise ValueError("oops")
+        with span("query"):
+            pass
+        self.assertEqual(self.counts(trace), {"find_thread": 1, "query": 1})
+
+    def test_trace_bound_to_other_threads(self):
+        trace = start_trace()
+        with span("find_threads"):
+            worker = threading.Thread(target=bind_invocation(lookup),
+                                      args=(1,))
+            worker.start()
+            worker.join()
+        self.assertEqual(self.counts(trace), {
+            "find_threads": 1,
+            "find_threads/lookup": 1
+        })
+
+        # Handing work out leaves the invocation's own thread as it was
+        self.assertEqual(current_trace(), trace)
+
+
+class TestRouteTracing(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+
+        engine = storage_engine("http://example.com")
+        engine.create_table("fakethreads",
+                            [("user_id", "N"), ("thread_id", "N")])
+        engine.put_item("fakethreads", {
+            "user_id": 333333,
+            "thread_id": 123456,
+            "reason": "mention",
+            "updated_at": 1460443217,
+            "tags": ["mentioned"]
+        })
+        token = jwt.encode({"sub": "333333"}, "shhsekret", algorithm='HS256')
+        self.lambda_event = {
+            "jwt_signing_secret": "shhsekret",
+            "bearer_token": "Bearer %s" % token,
+            "resource-path": "/notification/threads/{thread-id}",
+            "http-method": "GET",
+            "threadid": "123456",
+            "debug_timings": "1",
+            "notification_dynamodb_endpoint_url": "http://example.com",
+            "notification_user_notification_dynamodb_table_name": "fakethreads"  # NOQA
+        }
+
+    def test_find_thread_spans(self):
+        result = handler(self.lambda_event, {})
+        spans = result.get('data').get('meta').get('timings').get('spans')
+        self.assertEqual(list(spans.keys()), [
+            "validate_jwt",
+            "find_thread",
+            "find_thread/dynamodb_query",
+            "find_thread/dynamodb_get_item",
+            "find_thread/format_thread_resource",
+            "write_behind_flush"
+        ])
+        self.assertEqual(spans['find_thread/dynamodb_query']['count'], 1)
+        self.assertEqual(current_trace(), None)
@@ -0,0 +1,279 @@
+import unittest
+from mock import patch
+from mock import MagicMock
+from boto3.exceptions import Boto3Error
+from notification_backend.http import dynamodb_batch_write
+from notification_backend.http import dynamodb_update_item
+from notification_backend.http import storage_engine
+from notification_backend.http import reset_dynamodb_connections
+from notification_backend.write_behind import WriteBehindQueue
+from notification_backend.write_behind import expected_values_condition
+from notification_backend.notification_threads import NotificationThreads
+from notification_backend.notification_threads import write_behind_queue
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.write_behind.dynamodb_batch_write')  # NOQA
+        self.addCleanup(patcher1.stop)
+        self.mock_db_batch_write = patcher1.start()
+        self.mock_db_batch_write.return_value = []
+
+        self.prepare = MagicMock()
+        self.queue = WriteBehindQueue(3, 2, ["user_id", "thread_id"],
+                                      prepare=self.prepare)
+
+    def item(self, thread_id, reason="mention"):
+        return {"user_id": 1, "thread_id": thread_id, "reason": reason}
+
+    def test_flush(self):
+        self.assertTrue(self.queue.enqueue("endpoint", "table", self.item(1)))  # NOQA
+        self.assertTrue(self.queue.enqueue("endpoint", "table", self.item(2)))  # NOQA
+        self.assertTrue(self.queue.enqueue("endpoint", "table", self.item(1, "comment")))  # NOQA
+        self.assertEqual(self.queue.stats().get('pending'), 3)
+        self.queue.flush()
+
+        # Only the latest write of each item is made
+        expected_items = [self.item(2), self.item(1, "comment")]
+        self.assertEqual(self.mock_db_batch_write.call_args[0],
+                         ("endpoint", "table"))
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('put_items'),  # NOQA
+                         expected_items)
+        self.assertEqual(self.prepare.call_args[0][2], expected_items)
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('queued'), 3)
+        self.assertEqual(stats.get('written'), 2)
+        self.assertEqual(stats.get('flushes'), 1)
+        self.assertEqual(stats.get('pending'), 0)
+
+        self.queue.flush()
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 1)
+
+    def test_bounded(self):
+        for thread_id in range(3):
+            self.queue.enqueue("endpoint", "table", self.item(thread_id))
+        self.assertFalse(self.queue.enqueue("endpoint", "table", self.item(4)))  # NOQA
+        self.assertEqual(self.queue.stats().get('overflowed'), 1)
+
+        disabled_queue = WriteBehindQueue(0, 2, ["user_id", "thread_id"])
+        self.assertFalse(disabled_queue.enqueue("endpoint", "table", self.item(1)))  # NOQA
+
+    def test_unprocessed_items_retried(self):
+        self.mock_db_batch_write.return_value = [
+            {"PutRequest": {"Item": self.item(2)}}
+        ]
+        self.queue.enqueue("endpoint", "table", self.item(1))
+        self.queue.enqueue("endpoint", "table", self.item(2))
+        self.queue.flush()
+        self.assertEqual(self.queue.stats().get('retried'), 1)
+        self.assertEqual(self.queue.stats().get('pending'), 1)
+
+        # ...up to max_attempts times
+        self.queue.flush()
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('put_items'),  # NOQA
+                         [self.item(2)])
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('written'), 1)
+        self.assertEqual(stats.get('dropped'), 1)
+        self.assertEqual(stats.get('pending'), 0)
+
+    def test_datastore_error(self):
+        self.mock_db_batch_write.side_effect = Boto3Error
+        self.queue.enqueue("endpoint", "table", self.item(1))
+        self.queue.flush()
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('flush_errors'), 1)
+        self.assertEqual(stats.get('pending'), 1)
+
+        self.mock_db_batch_write.side_effect = None
+        self.queue.flush()
+        self.assertEqual(self.queue.stats().get('written'), 1)
+
+    @patch('notification_backend.write_behind.dynamodb_batch_get')
+    def test_expected_values(self, mock_db_batch_get):
+        mock_db_batch_get.return_value = ([
+            {"user_id": 1, "thread_id": 3, "change_version": 4},
+            {"user_id": 1, "thread_id": 4, "change_version": 5}
+        ], [])
+        self.queue = WriteBehindQueue(5, 2, ["user_id", "thread_id"],
+                                      prepare=self.prepare)
+        self.queue.enqueue("endpoint", "table", self.item(1), {"thread_id": None})  # NOQA
+        self.queue.enqueue("endpoint", "table", self.item(2))
+        self.queue.enqueue("endpoint", "table", self.item(3), {"thread_id": None})  # NOQA
+        self.queue.enqueue("endpoint", "table", self.item(4), {"change_version": 5})  # NOQA
+        self.queue.flush()
+
+        # Checked in one go, and written in one batch with the others
+        self.assertEqual(len(mock_db_batch_get.mock_calls), 1)
+        self.assertEqual([k.get('thread_id') for k in mock_db_batch_get.call_args[0][2]],  # NOQA
+                         [1, 3, 4])
+        self.assertEqual(mock_db_batch_get.call_args[1].get('projection'),
+                         ["change_version", "thread_id", "user_id"])
+        self.assertTrue(mock_db_batch_get.call_args[1].get('consistent_read'))  # NOQA
+        expected_items = [self.item(1), self.item(2), self.item(4)]
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('put_items'),  # NOQA
+                         expected_items)
+        # Superseded items don't get prepared
+        self.assertEqual(self.prepare.call_args[0][2], expected_items)
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('written'), 3)
+        self.assertEqual(stats.get('superseded'), 1)
+        self.assertEqual(stats.get('pending'), 0)
+
+    @patch('notification_backend.write_behind.dynamodb_batch_get')
+    def test_expected_values_unchecked(self, mock_db_batch_get):
+        mock_db_batch_get.return_value = ([], [{"user_id": 1, "thread_id": 1}])  # NOQA
+        self.queue.enqueue("endpoint", "table", self.item(1), {"thread_id": None})  # NOQA
+        self.queue.enqueue("endpoint", "table", self.item(2))
+        self.queue.flush()
+        self.assertEqual(self.mock_db_batch_write.call_args[1].get('put_items'),  # NOQA
+                         [self.item(2)])
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('written'), 1)
+        self.assertEqual(stats.get('retried'), 1)
+
+        mock_db_batch_get.side_effect = Boto3Error
+        self.queue.flush()
+        stats = self.queue.stats()
+        self.assertEqual(stats.get('written'), 1)
+        self.assertEqual(stats.get('flush_errors'), 1)
+        self.assertEqual(stats.get('dropped'), 1)
+
+    def test_expected_values_condition(self):
+        condition = expected_values_condition({"thread_id": None})
+        self.assertEqual(condition.get_expression()['operator'],
+                         "attribute_not_exists")
+        condition = expected_values_condition({"change_version": 5,
+                                               "deleted_at": None})
+        values = condition.get_expression()['values']
+        self.assertEqual(values[0].get_expression()['operator'], "=")
+        self.assertEqual(values[1].get_expression()['operator'],
+                         "attribute_not_exists")
+
+    def test_worker(self):
+        self.queue.start(60)
+        self.assertTrue(self.queue.running())
+        self.queue.enqueue("endpoint", "table", self.item(1))
+        # Whatever is left gets flushed when the worker stops
+        self.queue.stop()
+        self.assertFalse(self.queue.running())
+        self.assertEqual(self.queue.stats().get('written'), 1)
+
+
+class TestWriteBehindStorage(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        self.engine = storage_engine("endpoint")
+        self.engine.create_table("table",
+                                 [("user_id", "N"), ("thread_id", "N")])
+        self.queue = WriteBehindQueue(3, 2, ["user_id", "thread_id"])
+
+    def test_written_meanwhile(self):
+        fetched = {"user_id": 1, "thread_id": 1, "reason": "mention"}
+        self.queue.enqueue("endpoint", "table", fetched, {"thread_id": None})
+        # Patched before the queue got flushed
+        self.engine.put_item("table", dict(fetched, reason="comment"))
+        self.queue.flush()
+        stored = self.engine.get_item("table", {"user_id": 1, "thread_id": 1})  # NOQA
+        self.assertEqual(stored.get('reason'), "comment")
+        self.assertEqual(self.queue.stats().get('superseded'), 1)
+
+    def test_written_callback(self):
+        written = MagicMock()
+        fetched = {"user_id": 1, "thread_id": 1, "reason": "mention"}
+        self.queue.enqueue("endpoint", "table", fetched, {"thread_id": None},
+                           written)
+        self.queue.enqueue("endpoint", "table",
+                           dict(fetched, thread_id=2), written=written)
+        self.engine.put_item("table", dict(fetched, reason="comment"))
+        self.queue.flush()
+        # Superseded items never got written
+        self.assertEqual([c[0][0] for c in written.call_args_list],
+                         [dict(fetched, thread_id=2)])
+
+
+class TestQueuedGitHubThreads(unittest.TestCase):
+
+    def setUp(self):
+        patcher1 = patch('notification_backend.http.STORAGE_ENGINE', 'memory')  # NOQA
+        self.addCleanup(patcher1.stop)
+        patcher1.start()
+        reset_dynamodb_connections()
+        self.addCleanup(reset_dynamodb_connections)
+        self.engine = storage_engine("endpoint")
+        self.engine.create_table("threads",
+                                 [("user_id", "N"), ("thread_id", "N")])
+
+        patcher2 = patch('notification_backend.write_behind.dynamodb_batch_write',  # NOQA
+                         wraps=dynamodb_batch_write)
+        self.addCleanup(patcher2.stop)
+        self.mock_db_batch_write = patcher2.start()
+
+        write_behind_queue.clear()
+        self.addCleanup(write_behind_queue.clear)
+        self.threads = NotificationThreads({
+            "notification_dynamodb_endpoint_url": "endpoint",
+            "notification_user_notification_dynamodb_table_name": "threads"
+        })
+        self.threads.userid = 1
+
+    def fetched(self, thread_id):
+        return {"thread_id": thread_id, "reason": "mention", "updated_at": 1}
+
+    def stored(self, thread_id):
+        return self.engine.get_item("threads", {"user_id": 1,
+                                                "thread_id": thread_id})
+
+    def test_github_threads_written(self):
+        tombstone = {"user_id": 1, "thread_id": 2, "deleted_at": 1,
+                     "change_version": 5}
+        self.engine.put_item("threads", tombstone)
+        self.engine.put_item("threads", dict(tombstone, thread_id=3))
+        self.threads.persist_thread_information(self.fetched(1))
+        self.threads.persist_thread_information(self.fetched(2), tombstone)
+        self.threads.persist_thread_information(self.fetched(3),
+                                                dict(tombstone, thread_id=3))
+        # Thread 3 got deleted again while it was looked up on GitHub
+        self.engine.put_item("threads", dict(tombstone, thread_id=3,
+                                             change_version=6))
+        superseded = write_behind_queue.stats().get('superseded')
+        write_behind_queue.flush()
+
+        # Written in a single batch
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 1)
+        self.assertEqual(self.stored(1).get('reason'), "mention")
+        self.assertEqual(self.stored(1).get('change_version'), 1)
+        self.assertEqual(self.stored(2).get('reason'), "mention")
+        self.assertEqual(self.stored(2).get('change_version'), 2)
+        self.assertFalse('deleted_at' in self.stored(2))
+        self.assertEqual(self.stored(3).get('change_version'), 6)
+        self.assertTrue('deleted_at' in self.stored(3))
+        self.assertEqual(write_behind_queue.stats().get('superseded'),
+                         superseded + 1)
+        # No version got handed out for the superseded thread
+        self.assertEqual(self.stored(0).get('user_version'), 2)
+
+    def test_github_thread_retried(self):
+        self.mock_db_batch_write.side_effect = Boto3Error
+        with patch('notification_backend.notification_threads.dynamodb_update_item',  # NOQA
+                   wraps=dynamodb_update_item) as mock_db_update:
+            self.threads.persist_thread_information(self.fetched(1))
+            write_behind_queue.flush()
+            self.assertEqual(self.stored(1), None)
+            self.mock_db_batch_write.side_effect = None
+            write_behind_queue.flush()
+
+        # The retry kept the change version it got the first time
+        self.assertEqual(len(self.mock_db_batch_write.mock_calls), 2)
+        self.assertEqual(
+            [c[1].get('key') for c in mock_db_update.call_args_list],
+            [{"user_id": 1, "thread_id": 0}]
+        )
+        self.assertEqual(self.stored(1).get('change_version'), 1)
+        self.assertEqual(self.stored(0).get('user_version'), 1)